@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+# Benchmarks for pingexp. Everything runs offline: the ping command is replaced by fakeping.py which
+# prints made up replies.
+# License: Affero GPLv3
+
+import getopt
+import sys
+import os
+import time
+import json
+import shutil
+import tempfile
+import platform
+from cStringIO import StringIO
+from subprocess import Popen, PIPE
+
+import numpy
+
+import pingexp
+import pingparse
+import pingstats
+
+# fakeping.py, which pingexp.ping() is pointed at instead of ping.
+FAKEPING = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakeping.py')
+
+# The default round trip times are RTT_MIN ms plus a gamma distribution with shape RTT_SHAPE and scale
+# RTT_SCALE, which has the long tail real round trip times have.
+RTT_MIN = 20.0
+RTT_SHAPE = 2.0
+RTT_SCALE = 2.0
+
+# The kinds of reply synthetic() makes up.
+REPLY = 0
+DUPLICATE = 1
+TRUNCATED = 2
+
+# The flood scenario's targets and the pings a second fakeping.py sends to each.
+FLOOD_TARGETS = 2
+FLOOD_RATE = 20000
+
+# The number of samples each scenario is run with, up to the -n limit.
+SIZES = (1000, 10000, 100000, 1000000, 10000000, 100000000)
+DEFAULT_MAX_SAMPLES = 1000000
+
+def synthetic(count, loss=0.0, burst=1.0, reorder=0.0, duplicates=0.0, truncated=0.0,
+		rtt=(RTT_MIN, RTT_SHAPE, RTT_SCALE), seed=0):
+	"""Function to make up the replies to count pings.
+
+	loss is the fraction of pings which are lost, in bursts of burst pings on average. reorder is the
+	fraction of replies which arrive after the reply to the next ping. duplicates is the fraction of
+	replies which arrive twice and truncated the fraction which are truncated. rtt is (min, shape,
+	scale) of the round trip times in ms. The same seed always makes up the same replies.
+
+	Returns: (seq, rtt, kind) NumPy arrays of the replies in the order they arrive, where kind is REPLY,
+	DUPLICATE or TRUNCATED.
+	"""
+	random = numpy.random.RandomState(seed)
+
+	# Lose bursts of pings with geometrically distributed lengths.
+	received = numpy.ones(count, dtype=bool)
+	starts = numpy.flatnonzero(random.random_sample(count) < loss / float(burst))
+	if len(starts):
+		lengths = random.geometric(1.0 / burst, len(starts))
+		offsets = numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+		lost = numpy.repeat(starts, lengths) + offsets
+		received[lost[lost < count]] = False
+	seq = numpy.flatnonzero(received).astype(numpy.uint32) + 1
+	rtts = rtt[0] + random.gamma(rtt[1], rtt[2], len(seq))
+
+	# Swap replies with the next one.
+	swaps = numpy.flatnonzero(random.random_sample(max(len(seq) - 1, 0)) < reorder)
+	swaps = swaps[numpy.diff(numpy.concatenate(([-2], swaps))) > 1] # Each reply only moves once.
+	order = numpy.arange(len(seq))
+	order[swaps] += 1
+	order[swaps + 1] -= 1
+	(seq, rtts) = (seq[order], rtts[order])
+
+	kind = numpy.zeros(len(seq), dtype=numpy.uint8)
+	kind[random.random_sample(len(seq)) < truncated] = TRUNCATED
+
+	# A duplicate arrives straight after the original.
+	repeat = numpy.ones(len(seq), dtype=numpy.int64)
+	repeat[(random.random_sample(len(seq)) < duplicates) & (kind == REPLY)] = 2
+	first = numpy.cumsum(repeat) - repeat
+	(seq, rtts, kind) = (numpy.repeat(seq, repeat), numpy.repeat(rtts, repeat), numpy.repeat(kind, repeat))
+	kind[first[repeat == 2] + 1] = DUPLICATE
+
+	return (seq, rtts, kind)
+
+
+def format_rtt(rtt):
+	"""Function to format a round trip time in ms the same way as ping, with 3 or 4 significant figures."""
+	if rtt >= 100:
+		return '%i' %(rtt)
+	elif rtt >= 10:
+		return '%.1f' %(rtt)
+	elif rtt >= 1:
+		return '%.2f' %(rtt)
+	return '%.3f' %(rtt)
+
+
+def send_schedule(count, seq, rtt, interval=1.0, flood=False):
+	"""Function to return when each of count pings is sent, in seconds after the first, as a NumPy array.
+	seq and rtt are the replies from synthetic(). The pings are sent every interval unless flood is
+	True, when (like ping -A) each ping is sent as soon as the reply to the one before arrives, or
+	pingexp.FLOOD_TIMEOUT after it if it was lost, but not sooner than interval after it."""
+	if not flood:
+		return numpy.arange(count) * float(interval)
+
+	gaps = numpy.ones(count) * pingexp.FLOOD_TIMEOUT
+	gaps[seq.astype(numpy.int64) - 1] = rtt / 1000.0
+	gaps = numpy.maximum(gaps, interval)
+	return numpy.concatenate(([0.0], numpy.cumsum(gaps[:-1])))[:count]
+
+
+def ping_output(count, host='127.0.0.1', interval=1.0, size=56, ttl=64, start=None, flood=False, **kwargs):
+	"""Generator which yields the lines (without line endings) Linux (iputils) ping prints for count
+	pings with the replies from synthetic(), which is passed kwargs. The pings are sent as
+	send_schedule() says. If start is passed the replies start with the time they arrived, like ping -D
+	prints, as if the first ping was sent at start."""
+	(seq, rtt, kind) = synthetic(count, **kwargs)
+	sent = send_schedule(count, seq, rtt, interval=interval, flood=flood)
+
+	yield 'PING %s (%s) %i(%i) bytes of data.' %(host, host, size, size + 28)
+	prefix = '%i bytes from %s: icmp_seq=' %(size + 8, host)
+	for (s, r, k) in zip(seq.tolist(), rtt.tolist(), kind.tolist()):
+		line = prefix
+		if start != None:
+			line = '[%.6f] %s' %(start + sent[s - 1] + r / 1000.0, prefix)
+		if k == TRUNCATED:
+			yield '%s%i ttl=%i (truncated)' %(line, s & 0xffff, ttl)
+		elif k == DUPLICATE:
+			yield '%s%i ttl=%i time=%s ms (DUP!)' %(line, s & 0xffff, ttl, format_rtt(r))
+		else:
+			yield '%s%i ttl=%i time=%s ms' %(line, s & 0xffff, ttl, format_rtt(r))
+
+	yield ''
+	yield '--- %s ping statistics ---' %(host)
+	received = int((kind != DUPLICATE).sum())
+	dups = int((kind == DUPLICATE).sum())
+	line = '%i packets transmitted, %i received, ' %(count, received)
+	if dups:
+		line += '+%i duplicates, ' %(dups)
+	line += '%i%% packet loss, time %ims' %((count - received) * 100 / max(count, 1), sent[-1:].sum() * 1000)
+	yield line
+	timed = rtt[kind != TRUNCATED]
+	if len(timed):
+		avg = timed.mean()
+		mdev = numpy.sqrt(max((timed * timed).mean() - avg * avg, 0.0))
+		yield 'rtt min/avg/max/mdev = %.3f/%.3f/%.3f/%.3f ms' %(timed.min(), avg, timed.max(), mdev)
+
+
+def write_ping_output(filename, count, **kwargs):
+	"""Function to write the output of ping_output() to filename, e.g. for fakeping.py to print."""
+	f = open(filename, 'w')
+	lines = []
+	for line in ping_output(count, **kwargs):
+		lines.append(line)
+		if len(lines) >= 10000:
+			f.write('\n'.join(lines) + '\n')
+			lines = []
+	if lines:
+		f.write('\n'.join(lines) + '\n')
+	f.close()
+
+
+def synthetic_results(count, **kwargs):
+	"""Function to make up the results of an experiment of count pings, as experiment() would return.
+	The responses are built directly from the columns rather than by parsing, so this is quick even
+	for 100 million samples. kwargs are passed to synthetic(); duplicates and truncated are ignored."""
+	(seq, rtt, kind) = synthetic(count, **kwargs)
+	received = numpy.zeros((count + 7) / 8 * 8, dtype=numpy.uint8)
+	received[seq.astype(numpy.int64) - 1] = 1
+	# packbits puts the first bit in the most significant bit; the bitmap is least significant bit first.
+	received = bytearray(numpy.packbits(received.reshape(-1, 8)[:, ::-1]).tostring())
+	responses = pingexp.Samples.from_columns(seq, numpy.ones(len(seq), dtype=numpy.uint8) * 64, rtt, received)
+
+	experiment = {'responses': responses, 'host': '127.0.0.1', 'qos': '0',
+			'summary': {'transmitted': count, 'received': len(seq),
+				'packet_loss': (count - len(seq)) * 100 / max(count, 1), 'time': count * 1000.0},
+			'rtt_summary': {'min': float(rtt.min()), 'avg': float(rtt.mean()), 'max': float(rtt.max()),
+				'mdev': float(rtt.std())}}
+	return {'experiments': {'A': experiment}, 'ping_count': count, 'ping_interval': 1.0,
+		'start-time': 0.0, 'end-time': float(count)}
+
+
+##
+# The scenarios.
+# Each is called as scenario(count, directory) to do any setup which shouldn't be timed and returns
+# a function which runs what is timed. directory is a temporary directory for files.
+##
+def fakeping_env(filename):
+	"""Function to make fakeping.py print filename when it is run by ping()."""
+	os.environ['FAKEPING_OUTPUT'] = filename
+
+
+def scenario_parser(count, directory):
+	"""Parsing ping's output with pingparse.Parser, in the sized pieces ping() reads."""
+	filename = os.path.join(directory, 'output')
+	write_ping_output(filename, count, loss=0.01, reorder=0.001)
+	f = open(filename)
+	output = f.read()
+	f.close()
+
+	def run():
+		parser = pingparse.Parser()
+		for start in xrange(0, len(output), pingexp.PING_READ_SIZE):
+			parser.feed(output[start:start + pingexp.PING_READ_SIZE])
+		parser.close()
+	return run
+
+
+def scenario_parse(count, directory):
+	"""Parsing ping's output (through a pipe from fakeping.py)."""
+	filename = os.path.join(directory, 'output')
+	write_ping_output(filename, count, loss=0.01, reorder=0.001)
+
+	def run():
+		fakeping_env(filename)
+		results = pingexp.ping_results(pingexp.ping('127.0.0.1', count=count, binary=FAKEPING))
+		assert results['summary']['transmitted'] == count
+	return run
+
+
+def scenario_ipc(count, directory):
+	"""Parsing in a worker process and passing the samples to the main process."""
+	filename = os.path.join(directory, 'output')
+	write_ping_output(filename, count, loss=0.01, reorder=0.001)
+
+	def run():
+		fakeping_env(filename)
+		stdout = sys.stdout
+		sys.stdout = open(os.devnull, 'w') # experiment() reports each experiment as it finishes.
+		try:
+			results = pingexp.experiment(count, 0.001, [('A', '127.0.0.1', '0', '')], ping_binary=FAKEPING)
+		finally:
+			sys.stdout.close()
+			sys.stdout = stdout
+		assert results['experiments']['A']['summary']['transmitted'] == count
+	return run
+
+
+def scenario_flood(count, directory):
+	"""Collecting --flood experiments with FLOOD_TARGETS targets at about FLOOD_RATE pings a second each
+	(from fakeping.py in real time), which takes about count / FLOOD_RATE seconds if the collector keeps
+	up."""
+	def run():
+		if 'FAKEPING_OUTPUT' in os.environ:
+			del os.environ['FAKEPING_OUTPUT']
+		os.environ['FAKEPING_REALTIME'] = '1'
+		os.environ['FAKEPING_RTT'] = '%f,1,0' %(1000.0 / FLOOD_RATE)
+		targets = [(str(i), '127.0.0.1', '0', '') for i in range(FLOOD_TARGETS)]
+		stdout = sys.stdout
+		sys.stdout = open(os.devnull, 'w')
+		try:
+			results = pingexp.experiment(count, 0, targets, ping_binary=FAKEPING, flood=True)
+		finally:
+			sys.stdout.close()
+			sys.stdout = stdout
+			del os.environ['FAKEPING_REALTIME']
+			del os.environ['FAKEPING_RTT']
+		for experiment in results['experiments'].values():
+			assert len(experiment['responses']) == count
+	return run
+
+
+def scenario_finish(count, directory):
+	"""Sorting the samples, finding the loss runs and calculating the statistics of an experiment."""
+	experiment = synthetic_results(count, loss=0.01, burst=3, reorder=0.001)['experiments']['A']
+	responses = experiment['responses']
+	columns = (responses.seq, responses.ttl, responses.rtt, responses.received)
+
+	def run():
+		# finish_experiment() sorts the samples so each run starts again from the unsorted columns.
+		experiment['responses'] = pingexp.Samples.from_columns(*columns)
+		pingexp.finish_experiment(experiment)
+	return run
+
+
+def scenario_loss(count, directory):
+	"""Finding the runs of lost packets."""
+	experiment = synthetic_results(count, loss=0.01, burst=3)['experiments']['A']
+
+	def run():
+		pingexp.find_loss_runs(experiment)
+	return run
+
+
+def scenario_stats(count, directory):
+	"""Calculating the statistics of an experiment."""
+	(seq, rtt, kind) = synthetic(count, loss=0.01, burst=3)
+
+	def run():
+		pingstats.compute(seq, rtt, transmitted=count)
+	return run
+
+
+def scenario_sketch(count, directory):
+	"""Adding the samples to a pingstats.Histogram in batches as they arrive."""
+	(seq, rtt, kind) = synthetic(count, loss=0.01)
+
+	def run():
+		sketch = pingstats.Histogram()
+		for start in xrange(0, len(rtt), pingexp.BATCH_SIZE):
+			sketch.add(rtt[start:start + pingexp.BATCH_SIZE])
+	return run
+
+
+def scenario_write(count, directory):
+	"""Writing a results file."""
+	results = synthetic_results(count, loss=0.01, burst=3)
+	pingexp.finish_experiment(results['experiments']['A'])
+	filename = os.path.join(directory, 'results')
+
+	def run():
+		pingexp.write_results(results, filename)
+	return run
+
+
+def scenario_read(count, directory):
+	"""Reading a results file and every value of its columns."""
+	results = synthetic_results(count, loss=0.01, burst=3)
+	pingexp.finish_experiment(results['experiments']['A'])
+	filename = os.path.join(directory, 'results')
+	pingexp.write_results(results, filename)
+
+	def run():
+		for experiment in pingexp.read_results(filename)['experiments'].values():
+			for column in experiment['responses'].columns():
+				column.sum()
+	return run
+
+
+def scenario_log(count, directory):
+	"""Logging samples as they arrive for -w."""
+	(seq, rtt, kind) = synthetic(count, loss=0.01)
+	samples = zip(seq.tolist(), [64] * len(seq), rtt.tolist())
+	filename = os.path.join(directory, 'log')
+	header = {'ping_count': count, 'ping_interval': 1.0, 'engine': 'ping', 'start-time': 0.0,
+			'targets': [['A', '127.0.0.1', '0', '']]}
+
+	def run():
+		log = pingexp.ResultsLog(filename, header)
+		for start in xrange(0, len(samples), pingexp.BATCH_SIZE):
+			log.samples('A', samples[start:start + pingexp.BATCH_SIZE])
+		log.close()
+	return run
+
+
+def scenario_graph(count, directory):
+	"""Drawing the graph to a PNG."""
+	results = synthetic_results(count, loss=0.01, burst=3)
+	pingexp.finish_experiment(results['experiments']['A'])
+
+	def run():
+		pingexp.graph(results, image_file=StringIO())
+	return run
+
+
+def scenario_render(count, directory):
+	"""Drawing the graph of a results file to a PNG again, once what it is drawn from has been kept in the file."""
+	results = synthetic_results(count, loss=0.01, burst=3)
+	pingexp.finish_experiment(results['experiments']['A'])
+	filename = os.path.join(directory, 'results')
+	pingexp.write_results(results, filename)
+	pingexp.graph(pingexp.read_results(filename), image_file=StringIO())
+
+	def run():
+		pingexp.graph(pingexp.read_results(filename), image_file=StringIO())
+	return run
+
+
+SCENARIOS = (('parser', scenario_parser),
+		('parse', scenario_parse),
+		('ipc', scenario_ipc),
+		('flood', scenario_flood),
+		('finish', scenario_finish),
+		('loss', scenario_loss),
+		('stats', scenario_stats),
+		('sketch', scenario_sketch),
+		('write', scenario_write),
+		('read', scenario_read),
+		('log', scenario_log),
+		('graph', scenario_graph),
+		('render', scenario_render))
+
+def git_commit():
+	"""Function to return the commit being benchmarked, or None if it isn't known."""
+	try:
+		p = Popen(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stdout=PIPE, stderr=PIPE)
+	except OSError:
+		return None
+	commit = p.communicate()[0].strip()
+	if p.returncode != 0:
+		return None
+	return commit
+
+
+def run(names, max_samples=DEFAULT_MAX_SAMPLES, repeat=3, output=sys.stdout):
+	"""Function to run the scenarios in names with each of SIZES samples up to max_samples. Each is
+	timed repeat times and the fastest is kept.
+	Returns: {'commit': str, 'python': str, 'time': float,
+	          'results': [{'scenario': str, 'samples': int, 'seconds': float}, ...]}
+	"""
+	report = {'commit': git_commit(), 'python': platform.python_version(), 'time': time.time(), 'results': []}
+	directory = tempfile.mkdtemp()
+	try:
+		for (name, scenario) in SCENARIOS:
+			if name not in names:
+				continue
+			for count in SIZES:
+				if count > max_samples:
+					break
+				timed = scenario(count, directory)
+				times = []
+				for i in range(repeat):
+					start = time.time()
+					timed()
+					times.append(time.time() - start)
+				report['results'].append({'scenario': name, 'samples': count, 'seconds': min(times)})
+				print >> output, '%-8s %10i samples %9.4f s %12.0f samples/s' %(name, count, min(times), count / max(min(times), 1e-9))
+	finally:
+		shutil.rmtree(directory)
+
+	return report
+
+
+def compare(old, new, output=sys.stdout):
+	"""Function to print how the times of two reports returned by run() compare."""
+	old_times = dict([((r['scenario'], r['samples']), r['seconds']) for r in old['results']])
+	print >> output, 'Comparing %s with %s' %(old['commit'], new['commit'])
+	for r in new['results']:
+		key = (r['scenario'], r['samples'])
+		if key not in old_times:
+			continue
+		change = (r['seconds'] - old_times[key]) * 100 / max(old_times[key], 1e-9)
+		print >> output, '%-8s %10i samples %9.4f s -> %9.4f s %+7.1f%%' %(key[0], key[1], old_times[key], r['seconds'], change)
+
+
+def usage(prog_name):
+	output = \
+	"""
+Usage: %s [-n MAX_SAMPLES] [-s SCENARIO]... [-r REPEAT] [-o FILE]
+       %s --compare OLD_FILE NEW_FILE
+-n MAX_SAMPLES: Run each scenario with 1000, 10000, ... samples up to MAX_SAMPLES.
+	   Default %i. The largest is 100000000; the parse and ipc scenarios
+	   write about 60 bytes of ping output per sample to a temporary file and
+	   the flood scenario takes about MAX_SAMPLES / %i seconds.
+-s SCENARIO: Only run SCENARIO. Can be passed more than once. One of:
+	   %s.
+-r REPEAT: Time each run REPEAT times and keep the fastest. Default 3.
+-o FILE: Write the times to FILE as JSON.
+--compare: Show how the times in NEW_FILE compare with those in OLD_FILE, e.g.
+	   from the commits before and after a change.
+	""" %(prog_name, prog_name, DEFAULT_MAX_SAMPLES, FLOOD_RATE, ', '.join([name for (name, scenario) in SCENARIOS]))
+
+	return output
+
+if __name__ == '__main__':
+	max_samples = DEFAULT_MAX_SAMPLES
+	names = []
+	repeat = 3
+	output_filename = None
+	do_compare = False
+
+	try:
+		opts,args = getopt.getopt(sys.argv[1:], 'n:s:r:o:', ['compare'])
+	except getopt.GetoptError:
+		print >> sys.stderr, usage(sys.argv[0])
+		print >> sys.stderr, "Error: Unknown argument."
+		raise SystemExit()
+
+	for o,a in opts:
+		if o == '-n':
+			max_samples = int(a)
+		elif o == '-s':
+			if a not in [name for (name, scenario) in SCENARIOS]:
+				print >> sys.stderr, usage(sys.argv[0])
+				print >> sys.stderr, "Error: Unknown scenario."
+				raise SystemExit()
+			names.append(a)
+		elif o == '-r':
+			repeat = int(a)
+		elif o == '-o':
+			output_filename = a
+		elif o == '--compare':
+			do_compare = True
+		else:
+			assert(False)
+
+	if do_compare:
+		if len(args) != 2:
+			print >> sys.stderr, usage(sys.argv[0])
+			print >> sys.stderr, "Error: --compare needs OLD_FILE and NEW_FILE."
+			raise SystemExit()
+		compare(json.load(open(args[0])), json.load(open(args[1])))
+		raise SystemExit()
+
+	if not names:
+		names = [name for (name, scenario) in SCENARIOS]
+
+	report = run(names, max_samples=max_samples, repeat=repeat)
+	if output_filename:
+		f = open(output_filename, 'w')
+		json.dump(report, f, indent=1, sort_keys=True)
+		f.close()
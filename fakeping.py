@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# A stand in for ping which prints made up replies so that pingexp can be benchmarked and tested
+# offline. Point pingexp.ping() at it with binary='fakeping.py'.
+#
+# It takes the same options as ping (most are ignored) and prints the replies to -c COUNT pings the
+# same way Linux (iputils) ping does, with -D starting each reply with the time it arrived and -A sending
+# each ping as soon as the last reply arrived (see bench.send_schedule()). Without -c it prints
+# FOREVER_COUNT, which is as good as forever with FAKEPING_REALTIME. The replies are made up by bench.synthetic(), set up with these
+# environment variables:
+#   FAKEPING_LOSS, FAKEPING_BURST, FAKEPING_REORDER, FAKEPING_DUPLICATES, FAKEPING_TRUNCATED - see
+#     bench.synthetic(). Default no loss, reordering, duplicates or truncation.
+#   FAKEPING_RTT - 'min,shape,scale' of the round trip times.
+#   FAKEPING_SEED - the seed of the random numbers.
+#   FAKEPING_REALTIME - if set each reply is printed when it would have arrived, like ping does,
+#     instead of as fast as possible.
+#   FAKEPING_OUTPUT - the name of a file to print instead, e.g. from bench.write_ping_output(). This
+#     takes the cost of making up the replies out of benchmarks.
+# License: Affero GPLv3
+
+import getopt
+import sys
+import os
+import time
+
+import bench
+
+FOREVER_COUNT = 1000000
+
+if __name__ == '__main__':
+	count = FOREVER_COUNT
+	interval = 1.0
+	size = 56
+	stamped = False
+	flood = False
+
+	try:
+		opts,args = getopt.getopt(sys.argv[1:], 'c:i:Q:s:t:w:W:fADnqv')
+	except getopt.GetoptError, e:
+		print >> sys.stderr, "fakeping: %s" %(e)
+		raise SystemExit(2)
+	if len(args) != 1:
+		print >> sys.stderr, "fakeping: Need one host."
+		raise SystemExit(2)
+
+	for o,a in opts:
+		# pingexp passes an option and its value as one argument, e.g. '-c 5', so the values may
+		# start with a space.
+		if o == '-c':
+			count = int(a)
+		elif o == '-i':
+			interval = float(a)
+		elif o == '-s':
+			size = int(a)
+		elif o == '-D':
+			stamped = True
+		elif o == '-A':
+			flood = True
+
+	if 'FAKEPING_OUTPUT' in os.environ:
+		f = open(os.environ['FAKEPING_OUTPUT'])
+		received = False
+		for block in iter(lambda: f.read(65536), ''):
+			sys.stdout.write(block)
+			received = received or 'bytes from' in block
+		f.close()
+		raise SystemExit(int(not received))
+
+	kwargs = {}
+	for (name, key) in (('loss', 'FAKEPING_LOSS'), ('burst', 'FAKEPING_BURST'), ('reorder', 'FAKEPING_REORDER'),
+				('duplicates', 'FAKEPING_DUPLICATES'), ('truncated', 'FAKEPING_TRUNCATED')):
+		if key in os.environ:
+			kwargs[name] = float(os.environ[key])
+	if 'FAKEPING_RTT' in os.environ:
+		kwargs['rtt'] = tuple([float(x) for x in os.environ['FAKEPING_RTT'].split(',')])
+	if 'FAKEPING_SEED' in os.environ:
+		kwargs['seed'] = int(os.environ['FAKEPING_SEED'])
+	realtime = 'FAKEPING_REALTIME' in os.environ
+
+	# The replies always have the time they arrive, which is left off without -D.
+	received = False
+	for line in bench.ping_output(count, host=args[0], interval=interval, size=size, start=time.time(), flood=flood, **kwargs):
+		if line.startswith('['):
+			(stamp, line) = line[1:].split('] ', 1)
+			if realtime:
+				# Wait for the reply to arrive, unless printing has fallen behind.
+				wait = float(stamp) - time.time()
+				if wait > 0:
+					sys.stdout.flush()
+					time.sleep(wait)
+			if stamped:
+				line = '[%s] %s' %(stamp, line)
+		received = received or 'bytes from' in line
+		sys.stdout.write(line + '\n')
+
+	# Like ping, exit with 1 if there were no replies.
+	raise SystemExit(int(not received))
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# Experiments from several vantage points at once. An Agent runs on each machine the targets are to be
+# pinged from and waits for a coordinator, run(), to connect over TCP. The coordinator works out how far
+# each agent's clock is from its own, gives every agent the targets and the same start time, and then
+# merges the samples the agents stream back into one set of results which pingexp.graph() can draw.
+#
+# The protocol is a line of JSON at a time until the experiment starts:
+#   agent: {"challenge": random hex}
+#   coordinator: {"op": "auth", "digest": HMAC-SHA256 of the challenge with the shared secret}
+#   agent: {"ok": true} or {"error": why}
+#   coordinator: {"op": "time"}      agent: {"time": the agent's clock}      (repeated)
+#   coordinator: {"op": "run", "ping_count": ..., "ping_interval": ..., "targets": [...], "flood": ...,
+#                 "start": when to start, by the agent's clock}
+#   agent: {"ok": true} or {"error": why the experiment is refused}
+# after which the agent streams the log of the experiment (see pingexp.ResultsLog) and closes the
+# connection. A message which isn't one of these, or lacks a field, is answered with {"error": why} and
+# the connection is closed.
+#
+# Since an agent pings whatever it is asked to, it only listens on loopback unless it is given another
+# address, only answers coordinators which know its secret, and refuses floods and very long or wide
+# experiments unless it is told otherwise.
+# License: Affero GPLv3
+
+import os
+import sys
+import time
+import json
+import hmac
+import socket
+import hashlib
+import threading
+
+import pingexp
+
+# How many times the coordinator asks an agent the time. The answer with the shortest round trip is used.
+CLOCK_SAMPLES = 8
+# How many seconds after the coordinator has set up the agents they all start pinging.
+START_DELAY = 2.0
+# How long in seconds the coordinator waits for an agent to connect and answer before giving up.
+CONNECT_TIMEOUT = 10.0
+# How often in seconds an agent sends the samples it has collected.
+AGENT_FLUSH_INTERVAL = 0.5
+# The address an agent listens on unless it is given another.
+AGENT_HOST = '127.0.0.1'
+# The most pings to each target, and the most targets, an agent runs in one experiment.
+MAX_COUNT = 100000
+MAX_TARGETS = 1000
+# Unless an agent is allowed to flood it refuses to ping more often than every MIN_INTERVAL seconds.
+MIN_INTERVAL = 0.2
+
+
+def write_message(f, message):
+	"""Function to send a message (a JSON object) on a line of its own."""
+	f.write(json.dumps(message) + '\n')
+	f.flush()
+
+
+def read_message(f):
+	"""Function to read a message sent with write_message(). Returns None if the connection was closed."""
+	line = f.readline()
+	if not line:
+		return None
+	return json.loads(line)
+
+
+def check_message(message):
+	"""Function to return why a message from a coordinator is malformed, or None if it has the fields
+	its op needs, of the right types."""
+	number = lambda value: isinstance(value, (int, long, float)) and not isinstance(value, bool)
+	if not isinstance(message, dict):
+		return 'not a JSON object'
+	op = message.get('op')
+	if op == 'auth':
+		if not isinstance(message.get('digest'), basestring):
+			return 'no digest'
+	elif op == 'run':
+		if not isinstance(message.get('ping_count'), (int, long)) or isinstance(message['ping_count'], bool) \
+				or message['ping_count'] < 1:
+			return 'ping_count must be a positive integer'
+		if not number(message.get('ping_interval')) or message['ping_interval'] < 0:
+			return 'ping_interval must be a number of seconds'
+		if not number(message.get('start')):
+			return 'start must be a time'
+		if not isinstance(message.get('flood', False), bool):
+			return 'flood must be true or false'
+		targets = message.get('targets')
+		if not isinstance(targets, list) or [target for target in targets if not isinstance(target, list)
+				or len(target) not in (3, 4) or [field for field in target if not isinstance(field, basestring)]]:
+			return 'targets must be a list of [ID, host, TOS] or [ID, host, TOS, size]'
+		if [target for target in targets if not target[2].isdigit()]:
+			return 'the TOS of each target must be a number'
+	elif op != 'time':
+		return 'unknown request %r' %(op)
+	return None
+
+
+def sign(secret, challenge):
+	"""Function to return the answer to an agent's challenge, a hex HMAC-SHA256 keyed with the shared
+	secret ('' if there isn't one)."""
+	return hmac.new(secret or '', str(challenge), hashlib.sha256).hexdigest()
+
+
+def authenticate(rfile, wfile, secret=None):
+	"""Function to answer an agent's challenge with secret. Raises ValueError if the agent refuses."""
+	message = read_message(rfile)
+	if message == None or 'challenge' not in message:
+		raise ValueError('not a pingexp agent')
+	write_message(wfile, {'op': 'auth', 'digest': sign(secret, message['challenge'])})
+	reply = read_message(rfile)
+	if reply == None or 'error' in reply:
+		raise ValueError('the agent refused the connection: %s' %((reply or {}).get('error', 'closed')))
+
+
+class Agent(object):
+	"""Class which waits for coordinators to connect and runs the experiments they ask for, one at a time,
+	streaming the samples back as they arrive.
+
+	Only coordinators which answer its challenge with secret are served. Experiments with more than
+	max_count pings to each target or more than max_targets targets are refused, as are floods and
+	intervals of less than MIN_INTERVAL unless flood is True.
+
+	clock is the function the agent tells the time with. It is only passed in tests, to make the clock
+	look wrong.
+	"""
+	def __init__(self, port=pingexp.AGENT_PORT, host=AGENT_HOST, secret=None, flood=False, max_count=MAX_COUNT,
+			max_targets=MAX_TARGETS, ping_binary=pingexp.PING_BINARY, max_workers=pingexp.MAX_WORKERS, max_pps=None,
+			clock=time.time):
+		self.secret = secret
+		self.flood = flood
+		self.max_count = max_count
+		self.max_targets = max_targets
+		self.ping_binary = ping_binary
+		self.max_workers = max_workers
+		self.max_pps = max_pps
+		self.clock = clock
+
+		self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.server.bind((host, port))
+		self.server.listen(5)
+		self.port = self.server.getsockname()[1]
+		self.running = False
+
+	def run(self):
+		"""Function to serve coordinators until stop() is called or the process is interrupted."""
+		self.running = True
+		# Wake up now and then so that stop() is noticed.
+		self.server.settimeout(1.0)
+		try:
+			while self.running:
+				try:
+					(conn, address) = self.server.accept()
+				except socket.timeout:
+					continue
+				# A coordinator which doesn't answer mustn't hold up the others.
+				conn.settimeout(CONNECT_TIMEOUT)
+				try:
+					refused = self.serve(conn)
+					if refused != None:
+						print >> sys.stderr, "Error: Refused the coordinator at %s: %s." %(address[0], refused)
+				except Exception, e:
+					# Whatever a coordinator sends, the agent carries on serving the others.
+					print >> sys.stderr, "Error: Lost the coordinator at %s: %s." %(address[0], e)
+				finally:
+					conn.close()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			self.server.close()
+
+	def stop(self):
+		"""Function to make run() return. Can be called from another thread."""
+		self.running = False
+
+	def serve(self, conn):
+		"""Function to answer one coordinator. Returns why it was refused, if it was."""
+		rfile = conn.makefile('rb')
+		wfile = conn.makefile('wb')
+		try:
+			challenge = os.urandom(16).encode('hex')
+			write_message(wfile, {'challenge': challenge})
+			message = read_message(rfile)
+			if message == None:
+				return
+			error = check_message(message)
+			if error == None and (message['op'] != 'auth' or
+					not hmac.compare_digest(message['digest'].encode('utf-8'), sign(self.secret, challenge))):
+				error = 'wrong secret'
+			if error != None:
+				write_message(wfile, {'error': error})
+				return error
+			write_message(wfile, {'ok': True})
+
+			while True:
+				message = read_message(rfile)
+				if message == None:
+					return
+				error = check_message(message)
+				if error == None and message['op'] == 'time':
+					write_message(wfile, {'time': self.clock()})
+					continue
+				if error == None and message['op'] == 'run':
+					error = self.refuse(message)
+				elif error == None:
+					error = 'unexpected request %r' %(message['op'])
+				if error != None:
+					write_message(wfile, {'error': error})
+					return error
+				write_message(wfile, {'ok': True})
+				conn.settimeout(None)
+				self.experiment(message, wfile)
+				return
+		finally:
+			rfile.close()
+			wfile.close()
+
+	def refuse(self, job):
+		"""Function to return why the experiment job describes, from a 'run' message check_message()
+		passed, is refused, or None if it can be run."""
+		if len(job['targets']) > self.max_targets:
+			return 'more than %i targets' %(self.max_targets)
+		if job['ping_count'] > self.max_count:
+			return 'more than %i pings to a target' %(self.max_count)
+		if not self.flood and (job.get('flood', False) or job['ping_interval'] < MIN_INTERVAL):
+			return 'floods and intervals of less than %g seconds are not allowed' %(MIN_INTERVAL)
+		try:
+			pingexp.check_ping(self.ping_binary, job['targets'], job.get('flood', False))
+		except ValueError, e:
+			return str(e)
+		return None
+
+	def experiment(self, job, wfile):
+		"""Function to run the experiment job describes, from the 'run' message, logging it to wfile."""
+		header = {'ping_count': job['ping_count'], 'ping_interval': job['ping_interval'], 'engine': 'ping',
+				'start-time': job['start'], 'targets': job['targets'], 'ping': self.ping_binary,
+				'max_workers': self.max_workers, 'max_pps': self.max_pps, 'flood': job.get('flood', False)}
+		log = pingexp.ResultsLog(wfile, header, flush_interval=AGENT_FLUSH_INTERVAL)
+		try:
+			delay = job['start'] - self.clock()
+			if delay > 0:
+				time.sleep(delay)
+			pingexp.experiment(job['ping_count'], job['ping_interval'], job['targets'], callback=log.samples,
+						done_callback=log.done, ping_binary=self.ping_binary, max_workers=self.max_workers,
+						max_pps=self.max_pps, flood=job.get('flood', False))
+		except SystemExit:
+			# pingexp gives up when ping fails. What was collected is still sent.
+			pass
+		finally:
+			log.close()
+
+
+def clock_offset(rfile, wfile, samples=CLOCK_SAMPLES):
+	"""Function to work out how far an agent's clock is ahead of this one, the way NTP does. The agent's
+	answer is taken to be from halfway through each round trip, and the one with the shortest round trip
+	is used. Returns (offset, error) in seconds where error is half of that round trip, the most the
+	offset can be wrong by."""
+	best = None
+	for i in range(samples):
+		sent = time.time()
+		write_message(wfile, {'op': 'time'})
+		reply = read_message(rfile)
+		received = time.time()
+		if reply == None:
+			raise socket.error('the agent closed the connection')
+
+		error = (received - sent) / 2
+		if best == None or error < best[1]:
+			best = (reply['time'] - (sent + error), error)
+	return best
+
+
+def run(agents, ping_count, ping_interval, targets, flood=False, secret=None, start_delay=START_DELAY,
+		timeout=CONNECT_TIMEOUT):
+	"""Function to run an experiment from each of agents, a list of (name, host, port), at the same time.
+	secret is the agents' shared secret. Raises ValueError if an agent refuses the connection or the
+	experiment.
+
+	Every agent pings all of the targets. The results are like those of pingexp.experiment() with an
+	experiment for each agent and target, named 'AGENT/ID', which has the name of its 'agent'. The times
+	the pings were sent are moved onto this machine's clock. results['agents'] has the 'clock_offset' of
+	each agent, how many ms its clock is ahead of this one, and the 'clock_error' of that.
+	"""
+	results = {}
+	results['experiments'] = {}
+	results['ping_count'] = ping_count
+	results['ping_interval'] = ping_interval
+	if flood:
+		results['flood'] = True
+	results['agents'] = {}
+
+	# Connect to all of the agents and find out their clocks before any of them start.
+	connections = []
+	try:
+		for (name, host, port) in agents:
+			conn = socket.create_connection((host, port), timeout)
+			(rfile, wfile) = (conn.makefile('rb'), conn.makefile('wb'))
+			connections.append((name, conn, rfile, wfile))
+			authenticate(rfile, wfile, secret)
+			(offset, error) = clock_offset(rfile, wfile)
+			results['agents'][name] = {'host': host, 'port': port, 'clock_offset': offset * 1000.0,
+							'clock_error': error * 1000.0}
+
+		# Start them all at the same moment, each by its own clock.
+		results['start-time'] = time.time() + start_delay
+		for (name, conn, rfile, wfile) in connections:
+			conn.settimeout(None)
+			write_message(wfile, {'op': 'run', 'ping_count': ping_count, 'ping_interval': ping_interval,
+						'targets': [list(t) for t in targets], 'flood': flood,
+						'start': results['start-time'] + results['agents'][name]['clock_offset'] / 1000.0})
+		for (name, conn, rfile, wfile) in connections:
+			reply = read_message(rfile)
+			if reply == None or 'error' in reply:
+				raise ValueError('%s refused the experiment: %s' %(name, (reply or {}).get('error', 'closed')))
+
+		# Read the streams side by side so that none of the agents is held up.
+		logs = {}
+		def read(name, rfile):
+			try:
+				logs[name] = pingexp.read_log(rfile)
+			except (socket.error, ValueError), e:
+				print >> sys.stderr, "Error: Lost the agent %s: %s." %(name, e)
+		threads = [threading.Thread(target=read, args=(name, rfile)) for (name, conn, rfile, wfile) in connections]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+		for thread in threads:
+			# A timeout keeps Ctrl-C working.
+			while thread.is_alive():
+				thread.join(1.0)
+	finally:
+		for (name, conn, rfile, wfile) in connections:
+			conn.close()
+
+	results['end-time'] = time.time()
+	merge(results, logs)
+	return results
+
+
+def merge(results, logs):
+	"""Function to add the experiments in the logs from the agents, {agent name: pingexp.read_log()},
+	to results."""
+	for name in sorted(logs):
+		(header, experiments, offset) = logs[name]
+		clock_offset = results['agents'][name]['clock_offset'] / 1000.0
+		for target in header['targets']:
+			experiment = experiments.get(target[0], {'responses': pingexp.Samples()})
+			experiment['agent'] = name
+			experiment.setdefault('host', target[1])
+			experiment.setdefault('qos', target[2])
+			experiment.setdefault('size', target[3])
+			experiment['responses'].shift_sent(-clock_offset)
+			if 'summary' not in experiment:
+				# The agent was lost before this experiment finished.
+				pingexp.summarize(experiment, results['ping_count'], results['end-time'] - results['start-time'])
+			pingexp.finish_experiment(experiment)
+			results['experiments']['%s/%s' %(name, target[0])] = experiment
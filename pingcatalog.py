@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+# A catalog of saved pingexp results. The experiments in results files (and the pickles written by older
+# versions) are indexed in an SQLite database so that runs can be found by target, TOS, time and their
+# statistics without reading every file, and compared on one graph.
+# License: Affero GPLv3
+
+import getopt
+import sys
+import os
+import time
+import sqlite3
+
+import pingexp
+
+# Where the catalog is kept unless -d is passed.
+CATALOG_FILE = os.path.expanduser('~/.pingexp-catalog.db')
+
+# How the pickles written by older versions start: protocol 2 and up, and the protocol 0 dict pingexp wrote.
+LEGACY_MAGICS = ('\x80', '(dp')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS roots (path TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS files (
+	id INTEGER PRIMARY KEY,
+	path TEXT UNIQUE NOT NULL,
+	mtime REAL NOT NULL,
+	size INTEGER NOT NULL,
+	start_time REAL,
+	end_time REAL,
+	ping_count INTEGER,
+	ping_interval REAL);
+CREATE TABLE IF NOT EXISTS experiments (
+	file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+	experiment_id TEXT NOT NULL,
+	host TEXT,
+	qos INTEGER,
+	size INTEGER,
+	transmitted INTEGER,
+	received INTEGER,
+	packet_loss REAL,
+	min REAL,
+	avg REAL,
+	max REAL,
+	mdev REAL,
+	p50 REAL,
+	p95 REAL,
+	p99 REAL,
+	p999 REAL,
+	jitter REAL,
+	loss_burst_max INTEGER);
+CREATE TABLE IF NOT EXISTS rejected (
+	path TEXT PRIMARY KEY,
+	mtime REAL NOT NULL,
+	size INTEGER NOT NULL,
+	legacy INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS files_start_time ON files(start_time);
+CREATE INDEX IF NOT EXISTS experiments_host_qos ON experiments(host, qos);
+CREATE INDEX IF NOT EXISTS experiments_experiment_id ON experiments(experiment_id);
+CREATE INDEX IF NOT EXISTS experiments_file_id ON experiments(file_id);
+"""
+
+# The columns of the experiments table which come from pingstats.compute(), and their keys.
+STATS_COLUMNS = (('min', 'min'), ('avg', 'avg'), ('max', 'max'), ('mdev', 'mdev'), ('p50', 'p50'), ('p95', 'p95'),
+		('p99', 'p99'), ('p999', 'p99.9'), ('jitter', 'jitter'), ('loss_burst_max', 'loss_burst_max'))
+
+# The columns query() returns.
+QUERY_COLUMNS = ('path', 'start_time', 'end_time', 'ping_count', 'ping_interval', 'experiment_id', 'host', 'qos',
+		'size', 'transmitted', 'received', 'packet_loss') + tuple([column for (column, key) in STATS_COLUMNS])
+
+def parse_time(text):
+	"""Function to parse a local time given as 'YYYY-MM-DD', 'YYYY-MM-DD HH:MM' or seconds since the
+	epoch. Returns seconds since the epoch."""
+	for format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+		try:
+			return time.mktime(time.strptime(text, format))
+		except ValueError:
+			pass
+	return float(text)
+
+
+def int_or_none(value):
+	"""Function to return value as an int, or None if it isn't one, e.g. the default size ''."""
+	try:
+		return int(value)
+	except (TypeError, ValueError):
+		return None
+
+
+def file_experiments(filename, legacy=False):
+	"""Function to read the results in filename. Results files only have their index read. The pickles
+	written by older versions are only loaded if legacy is True, as loading a pickle can run any code
+	in it; anything else raises ValueError.
+	Returns: (results without 'experiments', {experiment_id: (experiment, stats)})"""
+	f = open(filename, 'rb')
+	magic = f.read(len(pingexp.RESULTS_MAGIC))
+	f.close()
+	if magic != pingexp.RESULTS_MAGIC and not (legacy and magic.startswith(LEGACY_MAGICS)):
+		raise ValueError('not a results file')
+
+	experiments = {}
+	if magic == pingexp.RESULTS_MAGIC:
+		results_file = pingexp.ResultsFile(filename)
+		try:
+			index = results_file.index
+			for name in index['experiments']:
+				entry = index['experiments'][name]
+				if 'stats' not in entry:
+					# Written before the statistics were saved.
+					entry = results_file.experiment(name)
+				experiments[name] = (entry, pingexp.experiment_stats(entry))
+		finally:
+			results_file.close()
+	else:
+		index = pingexp.read_results(filename)
+		for name in index['experiments']:
+			experiment = index['experiments'][name]
+			experiment['responses'] = pingexp.as_samples(experiment['responses'])
+			experiment['responses'].sort()
+			experiments[name] = (experiment, pingexp.experiment_stats(experiment))
+
+	results = dict([(key, index[key]) for key in index if key != 'experiments'])
+	return (results, experiments)
+
+
+class Catalog(object):
+	"""Class which is an SQLite index of the experiments in results files."""
+	def __init__(self, filename=CATALOG_FILE):
+		self.db = sqlite3.connect(filename)
+		self.db.execute('PRAGMA foreign_keys = ON')
+		self.db.executescript(SCHEMA)
+
+	def close(self):
+		self.db.close()
+
+	def add_file(self, path, stat=None, legacy=False):
+		"""Function to index the results file path, replacing what was indexed for it before. Pickles
+		written by older versions are only read if legacy is True. Raises an exception if it can't be
+		read."""
+		if stat == None:
+			stat = os.stat(path)
+		(results, experiments) = file_experiments(path, legacy)
+
+		self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+		cursor = self.db.execute('INSERT INTO files (path, mtime, size, start_time, end_time, ping_count, ping_interval)'
+					' VALUES (?, ?, ?, ?, ?, ?, ?)',
+					(path, stat.st_mtime, stat.st_size, results.get('start-time'), results.get('end-time'),
+					results.get('ping_count'), results.get('ping_interval')))
+		file_id = cursor.lastrowid
+		for name in experiments:
+			(experiment, stats) = experiments[name]
+			summary = experiment.get('summary', {})
+			row = [file_id, name, experiment.get('host'), int_or_none(experiment.get('qos')),
+				int_or_none(experiment.get('size')), summary.get('transmitted'), summary.get('received'),
+				summary.get('packet_loss')]
+			row.extend([stats.get(key) for (column, key) in STATS_COLUMNS])
+			self.db.execute('INSERT INTO experiments VALUES (%s)' %(', '.join(['?'] * len(row))), row)
+
+	def scan(self, paths=None, legacy=False):
+		"""Function to bring the catalog up to date with the results files in paths (files or directories,
+		which are searched recursively). Only new and changed files are read. Files which were indexed
+		from under paths and have gone are removed. If paths isn't passed the paths scanned before are
+		scanned again. Pickles written by older versions are read if they are named in paths, and the
+		ones found in directories only if legacy is True.
+		Files which can't be read are remembered and skipped until they change, so they are only
+		returned in the errors once.
+		Returns: (files added or updated, files removed, [(path, error), ...] of files which couldn't be read)"""
+		if paths == None:
+			paths = [row[0] for row in self.db.execute('SELECT path FROM roots')]
+		paths = [os.path.abspath(path) for path in paths]
+
+		known = {}
+		for (path, mtime, size) in self.db.execute('SELECT path, mtime, size FROM files'):
+			known[path] = (mtime, size)
+		rejected = {}
+		for (path, mtime, size, was_legacy) in self.db.execute('SELECT path, mtime, size, legacy FROM rejected'):
+			rejected[path] = (mtime, size, was_legacy)
+
+		seen = set()
+		updated = 0
+		errors = []
+		for root in paths:
+			self.db.execute('INSERT OR IGNORE INTO roots VALUES (?)', (root,))
+			if os.path.isdir(root):
+				filenames = []
+				for (directory, subdirectories, names) in os.walk(root):
+					# The derived data pingexp keeps next to a results file isn't one.
+					filenames.extend([os.path.join(directory, name) for name in names
+								if not name.endswith(pingexp.DERIVED_SUFFIX)])
+				read_legacy = legacy
+			else:
+				filenames = [root]
+				read_legacy = True
+
+			for path in sorted(filenames):
+				seen.add(path)
+				try:
+					stat = os.stat(path)
+				except OSError, e:
+					errors.append((path, e))
+					continue
+				if known.get(path) == (stat.st_mtime, stat.st_size):
+					continue
+				if path in rejected and rejected[path][:2] == (stat.st_mtime, stat.st_size) \
+						and (rejected[path][2] or not read_legacy):
+					continue
+
+				try:
+					self.add_file(path, stat, read_legacy)
+					updated += 1
+					if path in rejected:
+						self.db.execute('DELETE FROM rejected WHERE path = ?', (path,))
+				except Exception, e:
+					# Not a results file, or one which is still being written.
+					errors.append((path, e))
+					self.db.execute('INSERT OR REPLACE INTO rejected VALUES (?, ?, ?, ?)',
+							(path, stat.st_mtime, stat.st_size, int(read_legacy)))
+					if path in known:
+						self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+
+		# Forget the files which have gone from under the paths.
+		removed = 0
+		for path in known.keys() + rejected.keys():
+			if path in seen:
+				continue
+			if [root for root in paths if path == root or path.startswith(root.rstrip(os.sep) + os.sep)] \
+					and not os.path.exists(path):
+				if path in known:
+					self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+					removed += 1
+				else:
+					self.db.execute('DELETE FROM rejected WHERE path = ?', (path,))
+
+		self.db.commit()
+		return (updated, removed, errors)
+
+	def query(self, experiment_id=None, host=None, qos=None, size=None, since=None, until=None, max_loss=None,
+			min_loss=None, limit=None):
+		"""Function to find the experiments which match all of the filters passed. since and until are
+		seconds since the epoch which the run must have started in. Returns a list of dicts with the
+		QUERY_COLUMNS, oldest run first."""
+		where = []
+		args = []
+		for (column, value) in (('e.experiment_id', experiment_id), ('e.host', host), ('e.qos', qos), ('e.size', size)):
+			if value != None:
+				where.append('%s = ?' %(column))
+				args.append(value)
+		for (condition, value) in (('f.start_time >= ?', since), ('f.start_time < ?', until),
+						('e.packet_loss <= ?', max_loss), ('e.packet_loss >= ?', min_loss)):
+			if value != None:
+				where.append(condition)
+				args.append(value)
+
+		sql = 'SELECT %s FROM experiments e JOIN files f ON e.file_id = f.id' \
+			%(', '.join([column in ('path', 'start_time', 'end_time', 'ping_count', 'ping_interval') and 'f.' + column
+					or 'e.' + column for column in QUERY_COLUMNS]))
+		if where:
+			sql += ' WHERE ' + ' AND '.join(where)
+		sql += ' ORDER BY f.start_time, f.path, e.experiment_id'
+		if limit != None:
+			sql += ' LIMIT %i' %(limit)
+
+		return [dict(zip(QUERY_COLUMNS, row)) for row in self.db.execute(sql, args)]
+
+
+def format_rows(rows):
+	"""Function to format the rows returned by Catalog.query() as a table."""
+	lines = ['%-19s %-12s %-24s %4s %7s %9s %9s %9s  %s' %('Start', 'ID', 'Host', 'TOS', 'Loss %', 'Avg ms',
+									'p99 ms', 'Max ms', 'File')]
+	for row in rows:
+		start = '-'
+		if row['start_time'] != None:
+			start = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row['start_time']))
+		values = []
+		for key in ('packet_loss', 'avg', 'p99', 'max'):
+			if row[key] == None:
+				values.append('-')
+			else:
+				values.append('%.2f' %(row[key]))
+		lines.append('%-19s %-12s %-24s %4s %7s %9s %9s %9s  %s' %(start, row['experiment_id'], row['host'],
+									row['qos'], values[0], values[1], values[2], values[3],
+									row['path']))
+	return '\n'.join(lines)
+
+
+def graph_rows(rows, image_file=None):
+	"""Function to graph the average and 99th percentile latency and the loss of the runs returned by
+	Catalog.query() against when they started, one series per (experiment ID, host, TOS)."""
+	pingexp.load_matplotlib(pyplot=not image_file)
+	if image_file:
+		fig = pingexp.matplotlib.figure.Figure(figsize=(10,8), facecolor='w')
+	else:
+		fig = pingexp.plt.figure(figsize=(10,8), facecolor='w')
+	latency_graph = fig.add_subplot(2, 1, 1)
+	latency_graph.set_title('Latency of the matching runs', fontsize=14, fontweight='bold')
+	latency_graph.set_ylabel('Latency (ms)')
+	loss_graph = fig.add_subplot(2, 1, 2, sharex=latency_graph)
+	loss_graph.set_title('Packet loss of the matching runs', fontsize=14, fontweight='bold')
+	loss_graph.set_ylabel('Packet loss (%)')
+	loss_graph.set_xlabel('Start of the run')
+
+	series = {}
+	for row in rows:
+		if row['start_time'] == None:
+			continue
+		series.setdefault((row['experiment_id'], row['host'], row['qos']), []).append(row)
+
+	colors = pingexp.Colors()
+	for num, key in enumerate(sorted(series)):
+		runs = series[key]
+		when = [pingexp.matplotlib.dates.epoch2num(row['start_time']) for row in runs]
+		label = '%s (%s, TOS %s)' %key
+		latency_graph.plot_date(when, [row['avg'] for row in runs], '-o', c=colors[num], markersize=3, label=label)
+		latency_graph.plot_date(when, [row['p99'] for row in runs], ':', c=colors[num])
+		loss_graph.plot_date(when, [row['packet_loss'] for row in runs], '-o', c=colors[num], markersize=3)
+
+	if series:
+		latency_graph.legend(loc='best', fontsize='small')
+	latency_graph.set_ylim(ymin=0)
+	loss_graph.set_ylim(ymin=0)
+	fig.autofmt_xdate()
+
+	if image_file:
+		canvas = pingexp.FigureCanvas(fig)
+		canvas.print_png(image_file)
+	else:
+		pingexp.plt.show()
+
+
+def usage(prog_name):
+	output = \
+	"""
+Usage: %s [-d DATABASE] --scan [--legacy] [PATH...]
+       %s [-d DATABASE] [--id ID] [--host HOST] [--qos TOS] [--size SIZE]
+	  [--since TIME] [--until TIME] [--min-loss PERCENT] [--max-loss PERCENT]
+	  [--limit N] [--graph] [-o FILE]
+-d DATABASE: The catalog. Default %s.
+--scan: Add the results files in each PATH (a file, or a directory which is
+	   searched) to the catalog. Only new and changed files are read, and files
+	   which have gone are removed. Without a PATH the paths scanned before are
+	   scanned again. Files which aren't results files are skipped until they
+	   change.
+--legacy: Also read the pickles written by older versions of pingexp which
+	   are found in the directories scanned. Loading a pickle can run any code
+	   in it, so only use this on files you trust. Pickles named as a PATH are
+	   always read.
+--id, --host, --qos, --size: Only list the experiments with this experiment
+	   ID, host, TOS value or packet size.
+--since, --until TIME: Only list the runs which started at or after (before)
+	   TIME. TIME is 'YYYY-MM-DD', 'YYYY-MM-DD HH:MM' or seconds since 1970.
+--min-loss, --max-loss PERCENT: Only list the experiments with at least (at
+	   most) this packet loss.
+--limit N: List at most N experiments, the oldest first.
+--graph: Graph the latency and loss of the listed experiments against when
+	   they were run, instead of listing them.
+-o FILE: Write the graph to FILE as a PNG.
+
+Examples:
+
+1) Index a directory of results.
+%s --scan results/
+
+2) Compare last month's runs to www.google.com with TOS 16.
+%s --host www.google.com --qos 16 --since 2024-05-01 --until 2024-06-01 --graph
+	""" %(prog_name, prog_name, CATALOG_FILE, prog_name, prog_name)
+
+	return output
+
+if __name__ == '__main__':
+	database = CATALOG_FILE
+	scan = False
+	legacy = False
+	filters = {}
+	do_graph = False
+	image_filename = None
+
+	try:
+		opts,args = getopt.getopt(sys.argv[1:], 'd:o:', ['scan', 'legacy', 'id=', 'host=', 'qos=', 'size=', 'since=', 'until=',
+								'min-loss=', 'max-loss=', 'limit=', 'graph'])
+	except getopt.GetoptError:
+		print >> sys.stderr, usage(sys.argv[0])
+		print >> sys.stderr, "Error: Unknown argument."
+		raise SystemExit()
+
+	try:
+		for o,a in opts:
+			if o == '-d':
+				database = a
+			elif o == '-o':
+				image_filename = a
+			elif o == '--scan':
+				scan = True
+			elif o == '--legacy':
+				legacy = True
+			elif o == '--id':
+				filters['experiment_id'] = a
+			elif o == '--host':
+				filters['host'] = a
+			elif o in ('--qos', '--size', '--limit'):
+				filters[o[2:]] = int(a)
+			elif o in ('--since', '--until'):
+				filters[o[2:]] = parse_time(a)
+			elif o == '--min-loss':
+				filters['min_loss'] = float(a)
+			elif o == '--max-loss':
+				filters['max_loss'] = float(a)
+			elif o == '--graph':
+				do_graph = True
+			else:
+				assert(False)
+	except ValueError, e:
+		print >> sys.stderr, usage(sys.argv[0])
+		print >> sys.stderr, "Error: %s." %(e)
+		raise SystemExit()
+
+	if not scan and args:
+		print >> sys.stderr, usage(sys.argv[0])
+		print >> sys.stderr, "Error: Only --scan takes paths."
+		raise SystemExit()
+
+	catalog = Catalog(database)
+	if scan:
+		(updated, removed, errors) = catalog.scan(args or None, legacy)
+		for (path, error) in errors:
+			print >> sys.stderr, "Skipped %s (%s)." %(path, error)
+		print "Indexed %i files, removed %i." %(updated, removed)
+	else:
+		start = time.time()
+		rows = catalog.query(**filters)
+		elapsed = time.time() - start
+		if do_graph or image_filename:
+			if image_filename:
+				f = open(image_filename, 'wb')
+				graph_rows(rows, image_file=f)
+				f.close()
+			else:
+				graph_rows(rows)
+		else:
+			print format_rows(rows)
+			print "%i experiments (%.1f ms)." %(len(rows), elapsed * 1000)
+	catalog.close()
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+# Continuous monitoring with pingexp. The targets are pinged until the daemon is stopped. The recent
+# samples of each target are kept in a fixed size RingBuffer so memory use doesn't grow however long it
+# runs, and rolling loss and latency metrics are served from them over HTTP in the Prometheus text
+# format.
+# License: Affero GPLv3
+
+import sys
+import time
+import math
+import signal
+import socket
+import threading
+from Queue import Empty
+from multiprocessing import Process, Queue
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import numpy
+
+import pingexp
+import pingstats
+import pingtargets
+
+# The port on localhost the metrics are served on.
+DAEMON_PORT = 9427
+# How many seconds of samples the rolling metrics are calculated from.
+DAEMON_WINDOW = 300
+# How long a ping has to be answered before it counts as lost.
+DAEMON_REPLY_TIMEOUT = 2.0
+# How long to wait before restarting a ping command which exited.
+DAEMON_RESTART_DELAY = 10.0
+# The maximum time in seconds a worker process holds on to samples.
+DAEMON_BATCH_INTERVAL = 0.5
+# The upper bounds (ms) of the buckets of the histogram of every round trip time since the start.
+DAEMON_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class RingBuffer(object):
+	"""Class which holds the samples of the last capacity pings sent to one target, the window, plus
+	those which might still be answered.
+
+	The samples are stored in the slot seq % size, so a slot holding a different sequence number means
+	the ping was lost. Sequence numbers carry on across restarts of the ping command and are
+	unwrapped if ping only prints 16 bits of them.
+
+	Every round trip time since the start is also added to sketch, a pingstats.Histogram.
+
+	Only the replies are seen, so the sequence number of the last ping sent is worked out from the time
+	since the highest reply arrived. That is behind by the round trip time and how long the samples
+	took to arrive so the pings in the last timeout seconds are left out of the window anyway.
+	"""
+	def __init__(self, capacity, interval, timeout=DAEMON_REPLY_TIMEOUT, now=None):
+		if now == None:
+			now = time.time()
+		self.capacity = capacity
+		self.interval = interval
+		self.grace = int(math.ceil(timeout / interval))
+		self.size = capacity + self.grace
+
+		self.seq = numpy.zeros(self.size, dtype=numpy.int64) # Sequence numbers start at 1.
+		self.ttl = numpy.zeros(self.size, dtype=numpy.uint8)
+		self.rtt = numpy.zeros(self.size, dtype=numpy.float64)
+
+		self.running = False
+		self.offset = 0 # Added to the sequence numbers of the running ping command.
+		self.run_highest = 0 # The highest sequence number of the running ping command.
+		self.anchor = (0, now) # (seq, time) the sequence number being sent is worked out from.
+		self.stopped = 0 # The last sequence number sent while the ping command isn't running.
+
+		self.starts = 0
+		self.received = 0
+		self.duplicates = 0
+		self.rtt_sum = 0.0
+		self.sketch = pingstats.Histogram()
+
+	def start(self, now):
+		"""Function to note that a ping command was started for the target at now."""
+		self.offset = self.stopped
+		self.run_highest = 0
+		self.anchor = (self.offset, now)
+		self.running = True
+		self.starts += 1
+
+	def stop(self, now):
+		"""Function to note that the ping command exited at now."""
+		self.stopped = self.sent(now)
+		self.running = False
+
+	def sent(self, now):
+		"""Function to return the sequence number of the last ping sent by now."""
+		if not self.running:
+			return self.stopped
+		return self.anchor[0] + max(int((now - self.anchor[1]) / self.interval), 0)
+
+	def add(self, samples, now):
+		"""Function to add a batch of (seq, ttl, rtt) or (seq, ttl, rtt, sent) samples from the running ping
+		command."""
+		added = []
+		for sample in samples:
+			(seq, ttl, rtt) = sample[:3]
+			# Unwrap the sequence number using the nearest to the highest so far.
+			delta = (seq - self.run_highest) & 0xffff
+			if delta >= 0x8000:
+				delta -= 0x10000
+			run_seq = self.run_highest + delta
+			if run_seq < 1:
+				continue
+			seq = run_seq + self.offset
+
+			slot = seq % self.size
+			if self.seq[slot] == seq:
+				self.duplicates += 1
+				continue
+			if self.seq[slot] > seq:
+				# Too old, the slot has been used again.
+				continue
+			self.seq[slot] = seq
+			self.ttl[slot] = ttl
+			self.rtt[slot] = rtt
+			self.received += 1
+			self.rtt_sum += rtt
+			added.append(rtt)
+
+			if run_seq > self.run_highest:
+				self.run_highest = run_seq
+				self.anchor = (seq, now)
+		self.sketch.add(added)
+
+	def window(self, now):
+		"""Function to return the (seq, rtt) of the replies to the pings in the window, with seq counted
+		from 1 at the start of the window, and the number of pings in the window."""
+		last = self.sent(now)
+		if self.running:
+			last -= self.grace
+		first = max(last - self.capacity + 1, 1)
+		if last < first:
+			return (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0), 0)
+
+		seqs = numpy.arange(first, last + 1)
+		slots = seqs % self.size
+		received = self.seq[slots] == seqs
+		return (seqs[received] - first + 1, self.rtt[slots[received]], last - first + 1)
+
+	def stats(self, now):
+		"""Function to return the pingstats of the window plus 'transmitted', the number of pings in
+		the window, 'loss', the fraction of them which were lost, and 'sent', the pings sent in all."""
+		(seq, rtt, transmitted) = self.window(now)
+		stats = pingstats.compute(seq, rtt, transmitted=transmitted)
+		stats['sent'] = self.sent(now)
+		stats['transmitted'] = transmitted
+		stats['loss'] = 0.0
+		if transmitted:
+			stats['loss'] = (transmitted - len(rtt)) / float(transmitted)
+		return stats
+
+
+##
+# The metrics. Each is (name, type, help, function) where function is called with the stats of the window
+# and the RingBuffer of a target. Times are in seconds as Prometheus prefers.
+##
+METRICS = (
+	('pingexp_up', 'gauge', 'Whether the ping command of the target is running.',
+		lambda stats, ring: int(ring.running)),
+	('pingexp_starts_total', 'counter', 'How many times the ping command of the target was started.',
+		lambda stats, ring: ring.starts),
+	('pingexp_sent_total', 'counter', 'Pings sent to the target.',
+		lambda stats, ring: stats['sent']),
+	('pingexp_received_total', 'counter', 'Replies received from the target, not counting duplicates.',
+		lambda stats, ring: ring.received),
+	('pingexp_duplicates_total', 'counter', 'Duplicate replies received from the target.',
+		lambda stats, ring: ring.duplicates),
+	('pingexp_window_sent', 'gauge', 'Pings sent to the target in the window.',
+		lambda stats, ring: stats['transmitted']),
+	('pingexp_loss_ratio', 'gauge', 'Fraction of the pings in the window which were lost.',
+		lambda stats, ring: stats['loss']),
+	('pingexp_loss_burst_max', 'gauge', 'The most consecutive pings lost in the window.',
+		lambda stats, ring: stats['loss_burst_max']),
+	('pingexp_rtt_min_seconds', 'gauge', 'Lowest round trip time in the window.',
+		lambda stats, ring: stats['min'] / 1000.0),
+	('pingexp_rtt_max_seconds', 'gauge', 'Highest round trip time in the window.',
+		lambda stats, ring: stats['max'] / 1000.0),
+	('pingexp_rtt_avg_seconds', 'gauge', 'Mean round trip time in the window.',
+		lambda stats, ring: stats['avg'] / 1000.0),
+	('pingexp_jitter_seconds', 'gauge', 'RFC 3550 jitter of the round trip times in the window.',
+		lambda stats, ring: stats['jitter'] / 1000.0),
+)
+
+def format_labels(labels):
+	"""Function to format a list of (name, value) labels."""
+	values = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+			for (name, value) in labels]
+	return '{%s}' %(','.join(['%s="%s"' %(name, value) for (name, value) in values]))
+
+
+def metrics_text(targets, rings, window, now):
+	"""Function to return the metrics of the targets in the Prometheus text format. targets is the
+	list of (experiment_id, host, qos, size) and rings the RingBuffer of each experiment_id."""
+	stats = {}
+	labels = {}
+	for target in targets:
+		stats[target[0]] = rings[target[0]].stats(now)
+		labels[target[0]] = [('target', target[0]), ('host', target[1]), ('qos', target[2])]
+
+	lines = ['# HELP pingexp_window_seconds How many seconds of pings the windowed metrics are from.',
+			'# TYPE pingexp_window_seconds gauge',
+			'pingexp_window_seconds %s' %(repr(float(window)))]
+	for (name, kind, description, value) in METRICS:
+		lines.append('# HELP %s %s' %(name, description))
+		lines.append('# TYPE %s %s' %(name, kind))
+		for target in targets:
+			lines.append('%s%s %s' %(name, format_labels(labels[target[0]]),
+						repr(float(value(stats[target[0]], rings[target[0]])))))
+
+	# A summary's quantiles are from the window but its sum and count are from the start.
+	lines.append('# HELP pingexp_rtt_seconds Round trip times. The quantiles are from the window.')
+	lines.append('# TYPE pingexp_rtt_seconds summary')
+	for target in targets:
+		for p in pingstats.PERCENTILES:
+			value = stats[target[0]][pingstats.percentile_name(p)] / 1000.0
+			lines.append('pingexp_rtt_seconds%s %s' %(format_labels(labels[target[0]] + [('quantile', p / 100.0)]),
+							repr(value)))
+		lines.append('pingexp_rtt_seconds_sum%s %s' %(format_labels(labels[target[0]]),
+								repr(rings[target[0]].rtt_sum / 1000.0)))
+		lines.append('pingexp_rtt_seconds_count%s %i' %(format_labels(labels[target[0]]),
+								rings[target[0]].received))
+
+	# Prometheus can add up histograms, e.g. of several daemons, which it can't do with summaries.
+	lines.append('# HELP pingexp_rtt_histogram_seconds Round trip times since the start.')
+	lines.append('# TYPE pingexp_rtt_histogram_seconds histogram')
+	for target in targets:
+		sketch = rings[target[0]].sketch
+		for (limit, count) in zip(DAEMON_BUCKETS, sketch.cumulative(DAEMON_BUCKETS)):
+			lines.append('pingexp_rtt_histogram_seconds_bucket%s %i'
+					%(format_labels(labels[target[0]] + [('le', limit / 1000.0)]), count))
+		lines.append('pingexp_rtt_histogram_seconds_bucket%s %i'
+				%(format_labels(labels[target[0]] + [('le', '+Inf')]), sketch.count))
+		lines.append('pingexp_rtt_histogram_seconds_sum%s %s' %(format_labels(labels[target[0]]),
+									repr(sketch.sum / 1000.0)))
+		lines.append('pingexp_rtt_histogram_seconds_count%s %i' %(format_labels(labels[target[0]]), sketch.count))
+
+	return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+	"""Class which serves the metrics at /metrics. The server's metrics attribute returns them."""
+	def do_GET(self):
+		if self.path.split('?')[0] not in ('/', '/metrics'):
+			self.send_error(404)
+			return
+
+		body = self.server.metrics()
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+
+def ping_worker(*args, **kwargs):
+	"""Function which is executed as a process to run pingexp.do_ping() until it is terminated."""
+	# Unwind on SIGTERM so that ping() stops the ping command too.
+	def terminate(signum, frame):
+		raise SystemExit()
+	signal.signal(signal.SIGTERM, terminate)
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	pingexp.do_ping(*args, **kwargs)
+
+
+class Daemon(object):
+	"""Class which pings the targets until it is stopped and serves the metrics on localhost.
+
+	One ping command is run for each target so there must be enough workers for all of them; the
+	WorkerScheduler only staggers their starts. A ping command which exits is started again after
+	restart_delay seconds. Each ping command is given the address of its host, from pingtargets.resolver,
+	so the host is only looked up again once the address has expired.
+	"""
+	def __init__(self, targets, interval, window=DAEMON_WINDOW, port=DAEMON_PORT, ping_binary=pingexp.PING_BINARY,
+			max_workers=pingexp.MAX_WORKERS, max_pps=None, restart_delay=DAEMON_RESTART_DELAY):
+		self.targets = list(targets)
+		self.interval = interval
+		self.window = window
+		self.ping_binary = ping_binary
+		self.restart_delay = restart_delay
+		pingexp.check_ping(ping_binary, self.targets)
+
+		self.scheduler = pingexp.WorkerScheduler([t[0] for t in self.targets], interval, max_workers=max_workers,
+								max_pps=max_pps)
+		if len(self.scheduler.phases) < len(self.targets):
+			raise ValueError('%i targets need %i workers but only %i are allowed' \
+					%(len(self.targets), len(self.targets), len(self.scheduler.phases)))
+
+		capacity = int(math.ceil(window / interval))
+		self.rings = dict([(t[0], RingBuffer(capacity, interval)) for t in self.targets])
+		self.lock = threading.Lock() # Held while the rings are used.
+
+		self.results_q = Queue()
+		self.workers = {}
+		self.server = HTTPServer(('127.0.0.1', port), MetricsHandler)
+		self.server.metrics = self.metrics
+		self.running = False
+
+	def metrics(self):
+		"""Function to return the metrics in the Prometheus text format."""
+		self.lock.acquire()
+		try:
+			return metrics_text(self.targets, self.rings, self.window, time.time())
+		finally:
+			self.lock.release()
+
+	def _start(self, name, scheduled):
+		target = [t for t in self.targets if t[0] == name][0]
+		try:
+			address = pingtargets.resolver.address(target[1])
+		except socket.error, e:
+			print >> sys.stderr, "Could not resolve %s (%s). Trying again in %g seconds." %(target[1], e, self.restart_delay)
+			self.scheduler.done(name, time.time() + self.restart_delay)
+			self.scheduler.add(name)
+			return
+		self.workers[name] = Process(target=ping_worker, args=(self.results_q, target[0], target[1]),
+						kwargs={'qos': target[2], 'size': target[3], 'interval': self.interval,
+							'count': None, 'batch_interval': DAEMON_BATCH_INTERVAL,
+							'binary': self.ping_binary, 'scheduled': scheduled, 'address': address})
+		self.workers[name].start()
+		self.lock.acquire()
+		self.rings[name].start(time.time())
+		self.lock.release()
+
+	def _exited(self, name, errors):
+		now = time.time()
+		print >> sys.stderr, "Ping for %s exited. Restarting it in %g seconds." %(name, self.restart_delay)
+		for line in errors:
+			sys.stderr.write(line)
+		self.workers.pop(name).join()
+		self.lock.acquire()
+		self.rings[name].stop(now)
+		self.lock.release()
+		self.scheduler.done(name, now + self.restart_delay)
+		self.scheduler.add(name)
+
+	def run(self):
+		"""Function to ping the targets until stop() is called or the process is interrupted."""
+		server_thread = threading.Thread(target=self.server.serve_forever)
+		server_thread.daemon = True
+		server_thread.start()
+
+		self.running = True
+		try:
+			while self.running:
+				for (name, when) in self.scheduler.due(time.time()):
+					self._start(name, when)
+
+				# Wake up now and then so that stop() and Ctrl-C are noticed.
+				wait = self.scheduler.wait(time.time())
+				if wait == None or wait > 1.0:
+					wait = 1.0
+				try:
+					(name, kind, value) = self.results_q.get(True, wait)
+				except Empty:
+					continue
+
+				if kind == 'samples':
+					self.lock.acquire()
+					self.rings[name].add(value, time.time())
+					self.lock.release()
+				elif kind == 'error':
+					self._exited(name, value)
+				else:
+					self._exited(name, [])
+		except KeyboardInterrupt:
+			pass
+		finally:
+			for worker in self.workers.values():
+				worker.terminate()
+			for worker in self.workers.values():
+				worker.join()
+			self.workers = {}
+			self.server.shutdown()
+			self.server.server_close()
+
+	def stop(self):
+		"""Function to make run() return. Can be called from another thread."""
+		self.running = False
@@ -8,14 +8,81 @@ import pickle
 import random
 import getopt
 import sys
+import os
 import time
+import math
+import errno
+import heapq
+import array
+import select
+import signal
+import socket
+import struct
+import itertools
+import collections
+import functools
+import json
+import mmap
+import zlib
+import threading
+import tempfile
+import glob
+from Queue import Queue as ThreadQueue, Empty
+from UserDict import DictMixin
 from subprocess import Popen, PIPE
 import re
-from multiprocessing import Process, Queue
-
-import matplotlib.pyplot as plt
-import matplotlib.mlab as mlab
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+from multiprocessing import Process, Queue, Pool, cpu_count
+
+import numpy
+
+import pingparse
+import pingstats
+import pingtargets
+
+# Matplotlib is slow to import so it is only imported, by load_matplotlib(), when there is something to
+# graph.
+matplotlib = None
+plt = None
+FigureCanvas = None
+
+# The ping command run by the 'ping' engine.
+PING_BINARY = 'ping'
+# The most bytes of ping's output read at once.
+PING_READ_SIZE = 65536
+# The port --agent listens on by default (see pingagent).
+AGENT_PORT = 9428
+# The most ping processes the 'ping' engine runs at once. The other targets wait for one to finish.
+MAX_WORKERS = 256
+
+# The maximum number of samples a worker process collects before sending them to the main process.
+BATCH_SIZE = 100
+# The maximum time in seconds a worker process holds on to samples before sending them.
+BATCH_INTERVAL = 1.0
+# The most batches which can wait for the main process. Past that the workers wait, and so does ping,
+# rather than the samples filling memory.
+MAX_QUEUED_BATCHES = 1000
+
+# Where the 'ping' engine's workers put the samples for the main process to map (see SharedSegment), and
+# how they are laid out.
+SHM_DIR = '/dev/shm'
+SEGMENT_ROWS = 4096 # The first size of the file, in samples. It doubles each time it fills up.
+SHARED_SAMPLE = numpy.dtype([('seq', '<u4'), ('ttl', 'u1'), ('rtt', '<f8'), ('sent', '<f8')])
+
+# In flood mode a ping is sent once the reply to the last one arrives or after FLOOD_TIMEOUT seconds,
+# like ping -f.
+FLOOD_TIMEOUT = 0.01
+
+HIST_BIN_SIZE_IN_MS = 2 # Size of the histogram bins in ms.
+
+# Samples.extend() only tries to add all of the responses at once if there are at least this many.
+EXTEND_FAST_MIN = 32
+
+# How many seconds of samples the --live graph shows.
+LIVE_WINDOW = 60
+# The most times a second the --live graph is redrawn.
+LIVE_FPS = 20
+# The maximum time in seconds a worker process holds on to samples when the graph is live.
+LIVE_BATCH_INTERVAL = 0.1
 
 class Colors(object):
 	"""Class to manage a list of colors for the graph."""
@@ -41,169 +108,1296 @@ class Colors(object):
 
 		return self.colors[:size]
 
+class Samples(object):
+	"""Class which stores the (seq, ttl, time) responses of one experiment as columns.
+
+	The columns are arrays so each sample costs 13 bytes instead of a tuple, two numbers and a list slot
+	(roughly 130 bytes). A bitmap with one bit per sequence number records which sequence numbers have
+	been received.
+
+	ICMP sequence numbers are 16 bits so ping's wrap from 65535 back to 0. Each appended sequence number
+	is taken to be the one closest to the highest seen so far, which turns them into a counter that
+	keeps going up. A sequence number which was already received is counted as a duplicate and not
+	stored; one lower than the highest seen so far is counted as reordered.
+
+	Responses can also be (seq, ttl, time, sent) where sent is when the ping was sent, in seconds since
+	the epoch. Once one has been appended there is a sent column too, which is NaN for the responses
+	without one.
+
+	For compatibility with code written for the old list of tuples, indexing and iterating give
+	(seq, ttl, time) tuples. That view is read-only; samples can only be added with append() and extend().
+	"""
+	def __init__(self, responses=()):
+		self.seq = array.array('I')
+		self.ttl = array.array('B')
+		self.rtt = array.array('d')
+		self.sent = array.array('d') # Empty unless some of the responses had the time they were sent.
+		self.received = bytearray() # Bit (seq - 1) is set when seq has been received.
+		self.seq_max = None # The highest (unwrapped) sequence number so far.
+		self.duplicates = 0
+		self.reordered = 0
+		self.extend(responses)
+
+	def append(self, response):
+		"""Function to add a single (seq, ttl, time) or (seq, ttl, time, sent) response."""
+		if len(response) == 3:
+			(seq, ttl, rtt) = response
+			sent = None
+		else:
+			(seq, ttl, rtt, sent) = response
+
+		# Unwrap the sequence number.
+		if self.seq_max != None:
+			diff = (seq - self.seq_max) & 0xffff
+			if diff >= 0x8000:
+				diff -= 0x10000
+			seq = self.seq_max + diff
+		if seq < 1:
+			return
+
+		byte = (seq - 1) >> 3
+		bit = 1 << ((seq - 1) & 7)
+		if byte >= len(self.received):
+			# Grow by at least double to keep appends cheap.
+			self.received.extend('\0' * max(byte + 1 - len(self.received), len(self.received)))
+		elif self.received[byte] & bit:
+			self.duplicates += 1
+			return
+		self.received[byte] |= bit
+		if seq < self.seq_max:
+			self.reordered += 1
+
+		if sent != None:
+			if len(self.sent) < len(self.seq):
+				self.sent.extend([float('nan')] * (len(self.seq) - len(self.sent)))
+			self.sent.append(sent)
+		elif self.sent:
+			self.sent.append(float('nan'))
+		self.seq.append(seq)
+		self.ttl.append(ttl)
+		self.rtt.append(rtt)
+		self.seq_max = max(seq, self.seq_max)
+
+	def extend(self, responses):
+		"""Function to add a list of (seq, ttl, time) or (seq, ttl, time, sent) responses."""
+		if isinstance(responses, list) and len(responses) >= EXTEND_FAST_MIN:
+			try:
+				values = numpy.array(responses, dtype=numpy.float64)
+			except ValueError:
+				# The responses aren't all the same length.
+				values = numpy.zeros(0)
+			if values.ndim == 2 and values.shape[1] in (3, 4):
+				sent = values[:, 3] if values.shape[1] == 4 else ()
+				if self.extend_fast(values[:, 0], values[:, 1], values[:, 2], sent):
+					return
+		for response in responses:
+			self.append(response)
+
+	def extend_columns(self, seq, ttl, rtt, sent=()):
+		"""Function to add responses given as columns (e.g. NumPy arrays), with sent empty if the
+		times they were sent aren't known."""
+		if len(seq) >= EXTEND_FAST_MIN and self.extend_fast(seq, ttl, rtt, sent):
+			return
+		if not len(sent):
+			responses = itertools.izip(seq.tolist(), ttl.tolist(), rtt.tolist())
+		else:
+			responses = itertools.izip(seq.tolist(), ttl.tolist(), rtt.tolist(), sent.tolist())
+		for response in responses:
+			self.append(response)
+
+	def extend_fast(self, seq, ttl, rtt, sent=()):
+		"""Function to add columns of responses in one go with NumPy, which only works if, once unwrapped,
+		their sequence numbers are all higher than any so far and in order. That is the usual case, and
+		then none of them can be duplicates or reordered. Returns False, without adding any, if they
+		aren't."""
+		# Unwrap each sequence number from the one before, as append() does from the highest so far.
+		# That is the same thing when each is higher than the one before.
+		raw = numpy.asarray(seq).astype(numpy.int64)
+		if self.seq_max == None:
+			start = raw[0]
+			steps = (numpy.diff(raw) & 0xffff)
+		else:
+			start = self.seq_max
+			steps = (numpy.diff(numpy.concatenate(([self.seq_max], raw))) & 0xffff)
+		if start < 1 or (steps == 0).any() or (steps >= 0x8000).any():
+			return False
+		seq = start + numpy.concatenate(([0], numpy.cumsum(steps)))
+		if self.seq_max != None:
+			seq = seq[1:]
+
+		# Set the bits of the new sequence numbers, growing the bitmap by at least double.
+		byte_max = int(seq[-1] - 1) >> 3
+		if byte_max >= len(self.received):
+			self.received.extend('\0' * max(byte_max + 1 - len(self.received), len(self.received)))
+		received = numpy.frombuffer(self.received, dtype=numpy.uint8)
+		numpy.bitwise_or.at(received, (seq - 1) >> 3, (1 << ((seq - 1) & 7)).astype(numpy.uint8))
+
+		if len(sent):
+			if len(self.sent) < len(self.seq):
+				self.sent.extend([float('nan')] * (len(self.seq) - len(self.sent)))
+			self.sent.fromstring(numpy.asarray(sent, dtype=numpy.float64).tostring())
+		elif self.sent:
+			self.sent.fromstring((numpy.nan * numpy.ones(len(seq))).tostring())
+		self.seq.fromstring(seq.astype(numpy.uint32).tostring())
+		self.ttl.fromstring(numpy.asarray(ttl).astype(numpy.uint8).tostring())
+		self.rtt.fromstring(numpy.asarray(rtt, dtype=numpy.float64).tostring())
+		self.seq_max = int(seq[-1])
+		return True
+
+	@classmethod
+	def from_columns(cls, seq, ttl, rtt, received, sent=()):
+		"""Function to create Samples over existing columns, e.g. NumPy arrays over a memory map. The
+		columns are not copied so the Samples can not be appended to."""
+		samples = cls()
+		samples.seq = seq
+		samples.ttl = ttl
+		samples.rtt = rtt
+		samples.received = received
+		if len(sent):
+			samples.sent = sent
+		if len(seq):
+			samples.seq_max = int(numpy.max(seq))
+		return samples
+
+	def columns(self):
+		"""Function to return the seq, ttl and time columns as NumPy arrays. These share memory with the
+		columns so they must not be kept across an append()."""
+		return (self._column(self.seq, numpy.uint32), self._column(self.ttl, numpy.uint8),
+			self._column(self.rtt, numpy.float64))
+
+	def _column(self, column, dtype):
+		# Columns from from_columns() are already NumPy arrays, and may not be contiguous (see
+		# SharedSegment).
+		if isinstance(column, numpy.ndarray):
+			return column
+		return numpy.frombuffer(column, dtype=dtype)
+
+	def sent_times(self):
+		"""Function to return when each response's ping was sent, in seconds since the epoch, as a NumPy
+		array (NaN where it isn't known). It is empty if none of them are known. Like columns() it shares
+		memory with the column."""
+		sent = self._column(self.sent, numpy.float64)
+		if not len(sent):
+			return sent
+		if len(sent) < len(self.seq):
+			sent = numpy.concatenate((sent, numpy.nan * numpy.ones(len(self.seq) - len(sent))))
+		return sent
+
+	def sort(self):
+		"""Function to sort the samples by sequence number. Equal sequence numbers keep their order."""
+		(seq, ttl, rtt) = self.columns()
+		if (seq[1:] >= seq[:-1]).all():
+			# Already in order, which they usually are. Leave the columns where they are (which may be
+			# a memory map).
+			return
+		order = numpy.argsort(seq, kind='mergesort')
+		(seq, ttl, rtt) = (seq[order], ttl[order], rtt[order])
+
+		self.seq = array.array('I', seq.tostring())
+		self.ttl = array.array('B', ttl.tostring())
+		self.rtt = array.array('d', rtt.tostring())
+		if len(self.sent):
+			self.sent = array.array('d', self.sent_times()[order].tostring())
+
+	def shift_sent(self, seconds):
+		"""Function to add seconds to the times the pings were sent, e.g. to move them from another
+		machine's clock to this one's."""
+		if len(self.sent):
+			self.sent = array.array('d', (self.sent_times() + seconds).tostring())
+
+	def take(self):
+		"""Function to remove the samples and return them as a NumPy array of SHARED_SAMPLE records, with
+		NaN sent times if they aren't known. The bitmap and counts are kept, so responses added later are
+		still unwrapped and checked for duplicates against the ones taken."""
+		(seq, ttl, rtt) = self.columns()
+		rows = numpy.zeros(len(seq), dtype=SHARED_SAMPLE)
+		rows['seq'] = seq
+		rows['ttl'] = ttl
+		rows['rtt'] = rtt
+		rows['sent'] = self.sent_times() if len(self.sent) else numpy.nan
+
+		self.seq = array.array('I')
+		self.ttl = array.array('B')
+		self.rtt = array.array('d')
+		self.sent = array.array('d')
+		return rows
+
+	def loss_runs(self, transmitted):
+		"""Function to find the sequence numbers in 1..transmitted which were not received.
+		Returns: A NumPy array of [first lost seq, number lost] rows, one for each run of consecutive
+		lost sequence numbers, in sequence number order."""
+		bits = numpy.unpackbits(numpy.frombuffer(self.received, dtype=numpy.uint8))
+		# unpackbits puts the most significant bit first; the bitmap is least significant bit first.
+		bits = bits.reshape(-1, 8)[:, ::-1].ravel()[:transmitted]
+
+		# Anything past the end of the bitmap wasn't received. The padding at either end makes each
+		# run of zeros start with a +1 and end with a -1 in the differences.
+		lost = numpy.zeros(transmitted + 2, dtype=numpy.int8)
+		lost[1:transmitted + 1] = 1
+		lost[1:len(bits) + 1] -= bits
+		edges = numpy.diff(lost)
+		starts = numpy.flatnonzero(edges == 1)
+		ends = numpy.flatnonzero(edges == -1)
+
+		return numpy.column_stack((starts + 1, ends - starts)).astype(numpy.uint32)
+
+	def __len__(self):
+		return len(self.seq)
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(len(self)))]
+		return (self.seq[index], self.ttl[index], self.rtt[index])
+
+	def __iter__(self):
+		return itertools.izip(self.seq, self.ttl, self.rtt)
+
+	def __eq__(self, other):
+		try:
+			return list(self) == list(other)
+		except TypeError:
+			# other isn't a sequence, e.g. None.
+			return False
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __repr__(self):
+		return 'Samples(%r)' %(list(self))
+
+
+def as_samples(responses):
+	"""Function to return responses as Samples. Results saved before Samples existed have lists."""
+	if isinstance(responses, Samples):
+		return responses
+	return Samples(responses)
+
+
 ##
 # ping()
-# Returns: {'responses': [(seq, ttl, time), ...],
-#           'losses': [seq, ...],
-#           'summary': {'transmitted': int, 'received': int, 'packet_loss': int, 'time': float}},
-#           'rtt_summary': {'min': float, 'avg': float, 'max': float, 'mdev': float},
-#           }
+# A generator which yields (kind, value) events as ping prints its output:
+#   ('responses', [(seq, ttl, time), ...]) - The replies, as soon as they arrive. Replies which arrive
+#                                            together are passed together. If ping prints when each
+#                                            reply arrived the tuples are (seq, ttl, time, sent).
+#   ('truncated', None)             - The first time a truncated reply is seen.
+#   ('summary', {'transmitted': int, 'received': int, 'packet_loss': int, 'time': float})
+#   ('rtt_summary', {'min': float, 'avg': float, 'max': float, 'mdev': float})
+#   ('dialect', str)                - Which output the pingparse.Parser recognised, e.g. 'iputils'.
+#   ('error', [line, ...])          - Ping failed. The lines are ping's standard error.
 ##
-def ping(host, qos=0, interval=1, count=5, size='', flood=False, debug_prefix=''):
-	"""Function to run the ping command and extract the results; may be Linux specific."""
-	result = {}
-	result['responses'] = []
-	truncated_responses = False
+def check_ping(binary, target_list, flood=False):
+	"""Function to raise ValueError if the ping command binary can't ping target_list as asked, e.g.
+	flood them (see pingparse.Dialect.check())."""
+	dialect = pingparse.binary_dialect(binary)
+	for target in target_list:
+		dialect.check(target[2], flood)
+
 
-	# Regular expressions to obtain the information from ping's output.
-	response_re = re.compile('icmp_[rs]eq=(?P<icmp_seq>\d+) ttl=(?P<ttl>\d+) time=(?P<time>\d+(\.\d+|)) ms')
-	response_truncated_re = re.compile('(truncated)')
-	summary_re = re.compile('(?P<transmitted>\d+) packets transmitted, (?P<received>\d+) received, (\+(?P<errors>\d+) errors, |)(?P<packet_loss>\d+)% packet loss, time (?P<time>\d+(\.\d+|))ms')
-	rtt_summary_re = re.compile('rtt min/avg/max/mdev = (?P<min>\d+(\.\d+|))/(?P<avg>\d+(\.\d+|))/(?P<max>\d+(\.\d+|))/(?P<mdev>\d+(\.\d+|)) ms')
+def ping(host, qos=0, interval=1, count=5, size='', flood=False, debug_prefix='', binary=PING_BINARY, dialect=None,
+		overhead=None):
+	"""Generator which runs the ping command and yields the results as they are output (see pingparse).
+
+	binary is the command to run, e.g. fping, busybox or a stand in for ping such as fakeping.py. The
+	arguments it is run with depend on its name. dialect is the name of the pingparse dialect of its
+	output; by default it is picked from the output. If count is None ping runs until the generator is
+	closed. If overhead is passed the 'read' and 'parse' phases are added to it (see Overhead).
+	"""
+	truncated_responses = False
 
 	# Construct the arguments to Popen.
-	args = ['ping'] # The binary to execute.
-	args.append('-i %.3f'%(interval))
-	args.append('-Q %i'%(int(qos)))
-	args.append('-c %i'%(count))
-	if size != '':
-		args.append('-s %i' %(int(size)))
-	if flood:
-		args.append('-f')
-	args.append(host)
+	if dialect != None:
+		args = pingparse.dialect_class(dialect).arguments(binary, host, qos=qos, interval=interval, count=count, size=size, flood=flood)
+	else:
+		args = pingparse.binary_dialect(binary).arguments(binary, host, qos=qos, interval=interval, count=count, size=size, flood=flood)
 
 	# Run the ping command.
+	start = time.time()
 	try:
 		p = Popen(args, shell=False, stdout=PIPE, stderr=PIPE)
 	except OSError:
 		# Could not execute
-		return None
-
-	# Extract the required fields as they are output by ping.
-	for line in p.stdout.readlines():
-		line = line.rstrip()
-		#print debug_prefix, line
-
-		# Match the response lines.
-		m = response_re.search(line)
-		if m != None:
-			result['responses'].append((int(m.group('icmp_seq')), int(m.group('ttl')), float(m.group('time'))))
-			continue
-
-		# Look for response lines with truncated responses. These lines do not have a response time so print
-		# an error message.
-		# TODO - It would be better to pass the fact that we saw a truncated response back in the results
-		# vs print an error here.
-		m = response_truncated_re.search(line)
-		if m != None and truncated_responses == False:
-			print "Error: Truncated responses for %s. No response times recorded." %(host)
-			truncated_responses = True
-			continue
-
-		# Match the packet summary line.
-		m = summary_re.search(line)
-		if m != None:
-			result['summary'] = {'transmitted': int(m.group('transmitted')),
-						'received': int(m.group('received')),
-						'packet_loss': int(m.group('packet_loss')),
-						'time': float(m.group('time'))}
-			continue
-
-		# Match the RTT summary line.
-		m = rtt_summary_re.search(line)
-		if m != None:
-			result['rtt_summary'] = {'min': float(m.group('min')),
-						'avg': float(m.group('avg')),
-						'max': float(m.group('max')),
-						'mdev': float(m.group('mdev'))}
-			continue
-
-		# If we got here this is a line that didn't match.
-		#print "UNMATCHED: ", line
-
-	# Wait for ping to exit (which is should have already happened since readlines got an EOF).
+		yield ('error', [])
+		return
+
+	# Read whatever ping has output so far rather than a line at a time. A read returns as soon as there
+	# is anything to read so replies aren't held back, and when they come quickly lots of lines are
+	# parsed together.
+	parser = pingparse.Parser(dialect)
+	fd = p.stdout.fileno()
+	try:
+		while True:
+			data = os.read(fd, PING_READ_SIZE)
+			read_at = time.time()
+			if data:
+				events = parser.feed(data)
+			else:
+				events = parser.close()
+			if overhead != None:
+				overhead.add('parse', time.time() - read_at)
+
+			for kind, value in events:
+				if kind == 'truncated':
+					# Truncated responses do not have a response time. Only pass on the first.
+					if truncated_responses:
+						continue
+					truncated_responses = True
+				elif kind == 'summary' and 'time' not in value:
+					# Not every ping prints how long it took.
+					value['time'] = (time.time() - start) * 1000.0
+				elif kind == 'responses' and overhead != None:
+					# The replies with the time they were printed (sent plus the round trip time) show
+					# how long they waited in the pipe.
+					overhead.add('read', [max(read_at - (r[3] + r[2] / 1000.0), 0.0) for r in value if len(r) > 3])
+				yield (kind, value)
+
+			if not data:
+				break
+	except BaseException:
+		# Closed early or the worker is being stopped. Don't leave ping running.
+		if p.poll() == None:
+			p.kill()
+		p.wait()
+		raise
+
+	# Wait for ping to exit (which is should have already happened since the read got an EOF).
 	# 0 - At least one response received.
 	# 1 - No responses received. DNS lookup etc was OK. Still get summary line.
 	# 2 - Error.
 	ret = p.wait()
+	errors = p.stderr.read()
 	if ret >= 2:
-		# Ping failed. Dump the output ping sent to stderr.
-		print "Ping failed. Ping standard error output follows this message."
-		for line in p.stderr.readlines():
-			print line
-
-		return None # No results.
-	elif ret == 1:
+		# Ping failed. Pass back the output ping sent to stderr.
+		yield ('error', errors.splitlines(True))
+		return
+
+	# Some pings (fping) print the summary to stderr.
+	rtt_summary = False
+	for kind, value in parser.dialect.parse(errors):
+		if kind == 'summary' and 'time' not in value:
+			value['time'] = (time.time() - start) * 1000.0
+		rtt_summary = rtt_summary or kind == 'rtt_summary'
+		yield (kind, value)
+
+	if ret == 1 and not rtt_summary:
 		# Need to populate empty summary result fields since ping doesn't output them in this case.
-		result['rtt_summary'] = {'min': 0.0, 'avg': 0.0, 'max': 0.0, 'mdev': 0.0}
+		yield ('rtt_summary', {'min': 0.0, 'avg': 0.0, 'max': 0.0, 'mdev': 0.0})
+
+
+##
+# ping_results()
+# Collects the events from ping() into a single results dict.
+# Returns: {'responses': Samples([(seq, ttl, time), ...]),
+#           'summary': {'transmitted': int, 'received': int, 'packet_loss': int, 'time': float}},
+#           'rtt_summary': {'min': float, 'avg': float, 'max': float, 'mdev': float},
+#           'dialect': str,
+#           }
+#          or None if ping failed.
+##
+def ping_results(events):
+	"""Function to collect the events yielded by ping() into a results dict."""
+	result = {}
+	result['responses'] = Samples()
+
+	for kind, value in events:
+		if kind == 'responses':
+			result['responses'].extend(value)
+		elif kind == 'response':
+			result['responses'].append(value)
+		elif kind == 'error':
+			return None
+		elif kind != 'truncated':
+			result[kind] = value
 
 	return result
 
 
+##
+# IcmpEngine
+# An alternative to running one ping process per target. The engine sends the echo requests and
+# receives the replies itself for any number of targets from a single poll() loop. Unprivileged ICMP
+# datagram sockets are used where the kernel allows them (see net.ipv4.ping_group_range) otherwise
+# raw sockets are used, which requires root.
+#
+# run() returns {key: results, ...} where each results dict has the same form as ping_results().
+##
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+ICMP_HEADER = struct.Struct('!BBHHH') # type, code, checksum, id, seq
+ICMP_PAYLOAD = struct.Struct('!IId') # magic, target index, send time
+ICMP_PAYLOAD_MAGIC = 0x70657870
+DEFAULT_PING_SIZE = 56 # Same default as ping.
+
+# Adaptive targets (see IcmpEngine.add()) are pinged twice as often each time a ping goes unanswered for
+# the engine's timeout, or their round trip times vary by more than ADAPTIVE_JITTER of the round trip
+# time and at least ADAPTIVE_JITTER_MIN ms (smoothed the way TCP does). Once neither has happened for
+# ADAPTIVE_CALM of their slowest intervals they are pinged half as often again.
+ADAPTIVE_JITTER = 0.25
+ADAPTIVE_JITTER_MIN = 1.0
+ADAPTIVE_CALM = 10
+# How many times -c COUNT pings per target --adaptive sends at most, unless --budget is passed.
+ADAPTIVE_BUDGET = 2
+
+
+def halvings(interval, fast_interval):
+	"""Function to return how many times interval has to be halved to get fast_interval, or None if it
+	isn't a whole number of times. Adaptive targets go between the two by halving and doubling, so every
+	interval they are pinged at is fast_interval times a power of 2 and the time each ping stands for is
+	a whole number of fast_intervals (see experiment_sketch())."""
+	if fast_interval <= 0 or fast_interval > interval:
+		return None
+	times = math.log(float(interval) / fast_interval, 2)
+	if abs(times - round(times)) > 1e-9:
+		return None
+	return int(round(times))
+
+def icmp_checksum(data):
+	"""Function to calculate the Internet checksum (RFC 1071) of data."""
+	if len(data) % 2:
+		data += '\0'
+	s = sum(array.array('H', data))
+	s = (s >> 16) + (s & 0xffff)
+	s += s >> 16
+	# The sum was done in host byte order; the result is swapped back to network order by '!H' below.
+	return socket.ntohs(~s & 0xffff)
+
+
+class IcmpTarget(object):
+	"""The state of one target of the IcmpEngine."""
+	def __init__(self, index, key, host, address, qos, interval, count, size, seq_offset=0, responses=None, flood=False,
+			fast_interval=None):
+		self.index = index
+		self.key = key
+		self.host = host
+		self.address = address
+		self.qos = int(qos)
+		self.interval = interval
+		self.count = count
+		self.flood = flood
+		self.due = None # When the next request is due in flood mode. Earlier entries in the schedule are stale.
+		if size == '' or size == None:
+			size = DEFAULT_PING_SIZE
+		# The payload must at least hold the engine's own header.
+		self.size = max(int(size), ICMP_PAYLOAD.size)
+
+		self.sent = 0
+		self.last_sent = None # When the last request was sent.
+		self.received = 0
+		self.duplicates = 0
+		self.seen = bytearray((count + 7) // 8) # One bit per sequence number.
+		self.seq_offset = seq_offset # Added to the sequence numbers which are reported.
+		if responses == None:
+			responses = Samples()
+		self.responses = responses
+		self.rtt_sum = 0.0
+		self.rtt_sum2 = 0.0
+		# How late, in seconds, the first, last and latest requests were sent.
+		self.drift_start = 0.0
+		self.drift_end = 0.0
+		self.drift_max = 0.0
+
+		# Adaptive targets are pinged every interval down to every fast_interval, for as long as count
+		# pings every interval would take, so count is raised to the most which could be sent.
+		self.fast_interval = fast_interval
+		self.planned = count # The requests it sends at one every interval.
+		if fast_interval != None:
+			self.duration = count * interval
+			self.count = int(math.ceil(self.duration / fast_interval))
+			self.seen = bytearray((self.count + 7) // 8)
+		self.end = None # When to stop sending.
+		self.current = interval # Seconds between requests now.
+		self.intervals = [[seq_offset + 1, interval]] # The [first seq, interval] of each change of rate.
+		self.pending = collections.deque() # (seq, when sent) of the requests which might still be answered.
+		self.alarm = False # Whether the path has misbehaved since the rate was last decided.
+		self.calm_since = None # When the rate was last decided after the path misbehaved, or slowed down.
+		self.srtt = None # Smoothed round trip time and its variation, in ms.
+		self.rttvar = 0.0
+
+
+class IcmpEngine(object):
+	"""Class which pings many targets from one event loop. Not thread safe.
+
+	budget is the most requests the targets send between them. Adaptive targets only speed up while it
+	allows; the targets which aren't adaptive must fit in it. If overhead is passed how late each
+	request was sent is added to its 'schedule' phase.
+	"""
+	def __init__(self, timeout=1.0, rcvbuf=4*1024*1024, budget=None, overhead=None):
+		self.timeout = timeout # How long to wait for replies after the last request was sent.
+		self.rcvbuf = rcvbuf
+		self.budget = budget
+		self.overhead = overhead
+		self.spare = None # How many more requests than every interval the adaptive targets can still send.
+		self.targets = []
+		self.schedule = [] # (when, target index) of the next requests.
+		self.sockets = {} # TOS -> socket
+		self.raw = None # Whether raw sockets are in use. Decided when the first socket is opened.
+		self.ident = os.getpid() & 0xffff
+
+	def add(self, key, host, qos=0, interval=1, count=5, size='', seq_offset=0, responses=None, flood=False,
+			address=None, fast_interval=None):
+		"""Function to add a target. host is resolved here, unless its address is passed, so that lookups
+		are not timed.
+		seq_offset is added to the reported sequence numbers and the replies are appended to the
+		Samples responses if passed. If flood is True each request is sent as soon as the reply to the
+		one before arrives, or FLOOD_TIMEOUT after it, but at least interval after it.
+		If fast_interval is passed the target is adaptive: it is pinged for as long as count pings every
+		interval take, but as often as every fast_interval while the path is misbehaving (see
+		ADAPTIVE_JITTER). fast_interval must be interval halved a whole number of times (see halvings()).
+		The results have the 'intervals' it was pinged at.
+		Returns the IcmpTarget."""
+		if fast_interval != None and halvings(interval, fast_interval) == None:
+			raise ValueError('the fast interval %g is not %g halved a whole number of times' %(fast_interval, interval))
+		if address == None:
+			address = socket.gethostbyname(host)
+		if pingtargets.is_ipv6(address):
+			raise socket.error('%s has no IPv4 address, which the native engine needs' %(host))
+		target = IcmpTarget(len(self.targets), key, host, address, qos, interval, count, size,
+					seq_offset=seq_offset, responses=responses, flood=flood, fast_interval=fast_interval)
+		self.targets.append(target)
+		return target
+
+	def _open_socket(self, qos):
+		"""Function to open a socket for the TOS value qos. TOS is a socket option so one socket is
+		needed for each different TOS value."""
+		s = None
+		if self.raw != True:
+			try:
+				s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+				self.raw = False
+			except socket.error:
+				if self.raw == False:
+					raise
+		if s == None:
+			s = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+			self.raw = True
+
+		s.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, qos)
+		s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+		s.setblocking(0)
+		return s
+
+	def _send(self, target):
+		"""Function to send the next echo request to target. Returns the time it was sent."""
+		target.sent += 1
+		seq = target.sent & 0xffff
+		# The time is taken for each request, not once for all of those due together, so that the time
+		# spent sending the others isn't counted in its round trip.
+		sent = time.time()
+		payload = ICMP_PAYLOAD.pack(ICMP_PAYLOAD_MAGIC, target.index, sent)
+		payload += '\0' * (target.size - len(payload))
+		checksum = icmp_checksum(ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, self.ident, seq) + payload)
+		packet = ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, checksum, self.ident, seq) + payload
+		if target.fast_interval != None:
+			target.pending.append((target.sent, sent))
+		try:
+			self.sockets[target.qos].sendto(packet, (target.address, 0))
+		except socket.error:
+			# Counts as a loss, same as ping does when sendto() fails.
+			pass
+		return sent
+
+	def _adapt(self, target, now):
+		"""Function to decide how many seconds after the request sent now the adaptive target sends its
+		next one. Requests sent more often than every interval come out of the spare budget."""
+		# Requests which are still unanswered after the timeout are lost.
+		while target.pending and target.pending[0][1] + self.timeout <= now:
+			seq = target.pending.popleft()[0]
+			if not target.seen[(seq - 1) >> 3] & (1 << ((seq - 1) & 7)):
+				target.alarm = True
+
+		interval = target.current
+		if target.calm_since == None:
+			target.calm_since = now
+		if target.alarm:
+			target.alarm = False
+			target.calm_since = now
+			interval = max(target.current / 2, target.fast_interval)
+		elif now - target.calm_since >= ADAPTIVE_CALM * target.interval:
+			target.calm_since = now
+			interval = min(target.current * 2, target.interval)
+
+		# A request sent after a fraction f of the interval costs 1 - f from the budget on top of the
+		# one request every interval which is allowed for.
+		cost = 1 - interval / target.interval
+		if cost > self.spare:
+			(interval, cost) = (target.interval, 0)
+		self.spare -= cost
+
+		if interval != target.current:
+			target.current = interval
+			target.intervals.append([target.sent + 1 + target.seq_offset, interval])
+		return interval
+
+	def _receive(self, s, callback):
+		"""Function to read every packet waiting on socket s."""
+		while True:
+			try:
+				data = s.recv(65535)
+			except socket.error, e:
+				if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+					return
+				raise
+			now = time.time()
+
+			# Raw sockets include the IP header. Datagram sockets do not and the kernel has already
+			# filtered the replies down to those for this socket.
+			ttl = 0
+			if self.raw:
+				header_len = (ord(data[0]) & 0x0f) * 4
+				ttl = ord(data[8])
+				data = data[header_len:]
+			if len(data) < ICMP_HEADER.size + ICMP_PAYLOAD.size:
+				continue
+			(icmp_type, code, checksum, ident, seq) = ICMP_HEADER.unpack_from(data)
+			if icmp_type != ICMP_ECHO_REPLY or (self.raw and ident != self.ident):
+				continue
+			(magic, index, sent_time) = ICMP_PAYLOAD.unpack_from(data, ICMP_HEADER.size)
+			if magic != ICMP_PAYLOAD_MAGIC or index >= len(self.targets):
+				continue
+
+			target = self.targets[index]
+			# Recover the full sequence number from the 16 bits on the wire. A reply can only be
+			# for a request which has already been sent.
+			seq = target.sent - ((target.sent - seq) & 0xffff)
+			if seq < 1:
+				continue
+			bit = 1 << ((seq - 1) & 7)
+			if target.seen[(seq - 1) >> 3] & bit:
+				target.duplicates += 1
+				target.responses.duplicates += 1
+				continue
+			target.seen[(seq - 1) >> 3] |= bit
+
+			rtt = (now - sent_time) * 1000.0
+			if target.fast_interval != None:
+				# RFC 6298's smoothed round trip time and variation.
+				if target.srtt == None:
+					target.srtt = rtt
+				target.rttvar += (abs(target.srtt - rtt) - target.rttvar) / 4
+				target.srtt += (rtt - target.srtt) / 8
+				if target.rttvar > max(ADAPTIVE_JITTER * target.srtt, ADAPTIVE_JITTER_MIN):
+					target.alarm = True
+			response = (seq + target.seq_offset, ttl, rtt, sent_time)
+			target.received += 1
+			target.rtt_sum += rtt
+			target.rtt_sum2 += rtt * rtt
+			target.responses.append(response)
+			if callback:
+				callback(target.key, response)
+
+			# In flood mode the reply to the last request sends the next.
+			if target.flood and seq == target.sent and target.sent < target.count:
+				target.due = max(now, target.last_sent + target.interval)
+				heapq.heappush(self.schedule, (target.due, index))
+
+	def _results(self, target, elapsed):
+		"""Function to build the results dict for target. Same form as ping_results()."""
+		result = {}
+		result['responses'] = target.responses
+
+		packet_loss = 0
+		if target.sent:
+			packet_loss = int((target.sent - target.received) * 100 / target.sent)
+		result['summary'] = {'transmitted': target.sent,
+					'received': target.received,
+					'packet_loss': packet_loss,
+					'time': elapsed * 1000.0}
+
+		if target.received:
+			avg = target.rtt_sum / target.received
+			mdev = math.sqrt(max(target.rtt_sum2 / target.received - avg * avg, 0.0))
+			rtts = target.responses.rtt[-target.received:]
+			result['rtt_summary'] = {'min': min(rtts), 'avg': avg, 'max': max(rtts), 'mdev': mdev}
+		else:
+			result['rtt_summary'] = {'min': 0.0, 'avg': 0.0, 'max': 0.0, 'mdev': 0.0}
+
+		result['drift'] = {'start': target.drift_start * 1000.0, 'end': target.drift_end * 1000.0,
+					'max': target.drift_max * 1000.0}
+		if target.fast_interval != None:
+			result['intervals'] = target.intervals
+
+		return result
+
+	def run(self, callback=None):
+		"""Function to ping all of the targets until each has sent its count. If callback is passed it
+		is called as callback(key, (seq, ttl, time, sent)) for each reply as it arrives."""
+		# The adaptive targets can send more than once every interval with what the budget has left over
+		# after every target has sent that many.
+		self.spare = float('inf')
+		if self.budget != None:
+			planned = sum([target.planned for target in self.targets])
+			if self.budget < planned:
+				raise ValueError('a budget of %i requests is less than the %i the targets need' %(self.budget, planned))
+			# Rounding can let each adaptive target send one more request than it paid for.
+			self.spare = self.budget - planned - len([t for t in self.targets if t.fast_interval != None])
+
+		poller = select.poll()
+		by_fd = {} # The sockets replies are read from.
+		for target in self.targets:
+			if target.qos not in self.sockets:
+				s = self._open_socket(target.qos)
+				self.sockets[target.qos] = s
+				# Every raw socket gets a copy of every reply, which would look like duplicates, so the
+				# replies are only read from the first. The others just send and keep as little as they can.
+				if self.raw and by_fd:
+					s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 0)
+					continue
+				by_fd[s.fileno()] = s
+				poller.register(s.fileno(), select.POLLIN)
+
+		# Spread the first request of each target across its interval so that all of the targets
+		# are not probed in one burst.
+		start = time.time()
+		schedule = self.schedule
+		for target in self.targets:
+			if target.count > 0:
+				target.due = start + target.interval * target.index / len(self.targets)
+				schedule.append((target.due, target.index))
+				if target.fast_interval != None:
+					# Half an interval early so that adding up the intervals can't fit in another request.
+					target.end = target.due + target.duration - target.interval / 2
+		heapq.heapify(schedule)
+
+		end = None # When to stop waiting for replies. Set once the last request has been sent.
+		while schedule or time.time() < end:
+			now = time.time()
+			while schedule and schedule[0][0] <= now:
+				(when, index) = heapq.heappop(schedule)
+				target = self.targets[index]
+				if target.flood and when != target.due:
+					# The reply came first and the request has been sent already.
+					continue
+				sent = self._send(target)
+				target.last_sent = sent
+				if self.overhead != None:
+					self.overhead.add('schedule', sent - when)
+				if not target.flood:
+					target.drift_end = sent - when
+					target.drift_max = max(target.drift_max, target.drift_end)
+					if target.sent == 1:
+						target.drift_start = target.drift_end
+				if target.sent >= target.count:
+					target.due = None
+				elif target.flood:
+					target.due = sent + max(FLOOD_TIMEOUT, target.interval)
+					heapq.heappush(schedule, (target.due, index))
+				elif target.fast_interval != None:
+					when += self._adapt(target, sent)
+					if when < target.end:
+						heapq.heappush(schedule, (when, index))
+					else:
+						target.due = None
+				else:
+					heapq.heappush(schedule, (when + target.interval, index))
+			if schedule:
+				wait = schedule[0][0] - now
+			else:
+				if end == None:
+					end = now + self.timeout
+				wait = end - now
+
+			for fd, event in poller.poll(max(wait, 0) * 1000):
+				self._receive(by_fd[fd], callback)
+
+		for s in self.sockets.values():
+			s.close()
+		self.sockets = {}
+
+		elapsed = time.time() - start
+		return dict([(target.key, self._results(target, elapsed)) for target in self.targets])
+
+
+def find_loss_runs(results):
+    """Function to identify the lost packets of an experiment. Duplicate, reordered and wrapped
+        sequence numbers are handled by Samples.
+        Returns: A NumPy array of [first lost seq, number lost] rows. See Samples.loss_runs()."""
+    return as_samples(results['responses']).loss_runs(results['summary']['transmitted'])
+
+
+def expand_runs(runs):
+    """Function to turn [first, length] rows as returned by find_loss_runs() into a NumPy array of
+        every sequence number in the runs."""
+    runs = numpy.asarray(runs, dtype=numpy.int64).reshape(-1, 2)
+    if len(runs) == 0:
+        return numpy.array([], dtype=numpy.int64)
+
+    # Start with all ones, then at the start of each run jump from the end of the previous run.
+    seqs = numpy.ones(runs[:, 1].sum(), dtype=numpy.int64)
+    offsets = numpy.concatenate(([0], numpy.cumsum(runs[:-1, 1])))
+    seqs[0] = runs[0, 0]
+    seqs[offsets[1:]] = runs[1:, 0] - (runs[:-1, 0] + runs[:-1, 1] - 1)
+    return numpy.cumsum(seqs)
+
+
+def collapse_runs(seqs):
+    """Function to turn a sorted list of lost sequence numbers into [first, length] rows. The opposite
+        of expand_runs()."""
+    seqs = numpy.asarray(seqs, dtype=numpy.int64)
+    if len(seqs) == 0:
+        return numpy.zeros((0, 2), dtype=numpy.uint32)
+
+    # A run starts wherever the sequence numbers are not consecutive.
+    starts = numpy.flatnonzero(numpy.diff(seqs) != 1) + 1
+    starts = numpy.concatenate(([0], starts))
+    lengths = numpy.diff(numpy.concatenate((starts, [len(seqs)])))
+    return numpy.column_stack((seqs[starts], lengths)).astype(numpy.uint32)
+
+
 def find_lost_sequence_numbers(results):
-    """Function to identify the ICMP sequence numbers of lost packets.
-        Requires that the input is sorted."""
+    """Function to identify the ICMP sequence numbers of lost packets."""
 
     # If there were no losses exit early.
     if results['summary']['transmitted'] == results['summary']['received']:
         return []
 
-    # Build a list of all transmitted sequence numbers.
-    all_seqs = set(range(1, results['summary']['transmitted']+1))
+    return expand_runs(find_loss_runs(results)).tolist()
 
-    # Build a set of all the sequence numbers which were not lost.
-    returned_seqs = set([response[0] for response in results['responses']])
 
-    lost_seqs = list(all_seqs - returned_seqs)
+# Numbers the run_workers() calls of this process so that each has its own SharedSegment files.
+shared_runs = itertools.count()
 
-    assert(len(lost_seqs) + results['summary']['received'] == results['summary']['transmitted'])
 
-    return lost_seqs
+def shared_dir():
+	"""Function to return the directory for SharedSegment files: SHM_DIR, which is memory, if there is one."""
+	if os.path.isdir(SHM_DIR):
+		return SHM_DIR
+	return tempfile.gettempdir()
 
 
-def do_ping(results_q, experiment_id, host, qos=0, interval=1, count=5, size='', flood=False):
-	"""Function which is executed as a process to run the ping experiment."""
-	results = ping(host, qos=qos, interval=interval, count=count, size=size, flood=flood,
-											debug_prefix=experiment_id)
+class SegmentWriter(object):
+	"""Class which a worker process uses to put its samples in a SharedSegment file, and tell the main
+	process about them with a small message instead of sending the samples themselves.
+
+	The worker does the work of Samples (unwrapping the sequence numbers and dropping duplicates) and
+	appends the samples it keeps to the file as SHARED_SAMPLE records. The file is made bigger,
+	doubling, ahead of the records so that the main process doesn't need to map it again every time.
+	"""
+	def __init__(self, results_q, experiment_id, prefix):
+		self.results_q = results_q
+		self.experiment_id = experiment_id
+		self.prefix = prefix
+		self.samples = Samples()
+		self.file = None
+		self.path = None
+		self.count = 0
+		self.timed = False
+
+	def put(self, responses):
+		"""Function to add a list of responses and tell the main process about the ones which were kept."""
+		self.samples.extend(responses)
+		self.timed = self.timed or len(self.samples.sent) > 0
+		rows = self.samples.take()
+		if not len(rows):
+			return
+
+		if self.file == None:
+			(fd, self.path) = tempfile.mkstemp(prefix=self.prefix, dir=shared_dir())
+			self.file = os.fdopen(fd, 'wb')
+		size = os.fstat(self.file.fileno()).st_size
+		if (self.count + len(rows)) * SHARED_SAMPLE.itemsize > size:
+			rows_max = max(SEGMENT_ROWS, size // SHARED_SAMPLE.itemsize)
+			while rows_max < self.count + len(rows):
+				rows_max *= 2
+			self.file.truncate(rows_max * SHARED_SAMPLE.itemsize)
+		self.file.seek(self.count * SHARED_SAMPLE.itemsize)
+		self.file.write(rows.tostring())
+		self.file.flush()
+		self.count += len(rows)
+		self.results_q.put((self.experiment_id, 'samples', {'path': self.path, 'count': self.count, 'timed': self.timed,
+									'time': time.time()}))
+
+	def close(self, results):
+		"""Function to close the file and add what the main process needs to finish the Samples to the
+		experiment's results, as results['shared']."""
+		if self.file != None:
+			self.file.close()
+		results['shared'] = {'received': str(self.samples.received), 'duplicates': self.samples.duplicates,
+					'reordered': self.samples.reordered}
+
+
+class SharedSegment(object):
+	"""Class which maps the samples a worker process puts in a file with a SegmentWriter, so that they
+	are used where they are rather than being pickled, sent through a pipe and unpickled.
+
+	The file is unlinked as soon as it is opened, so it goes away once this process has closed it and
+	nothing maps it any more, however the experiment ends.
+	"""
+	def __init__(self, path):
+		self.file = open(path, 'rb')
+		os.unlink(path)
+		self.rows = numpy.zeros(0, dtype=SHARED_SAMPLE)
+		self.count = 0
+		self.timed = False
+
+	def update(self, message):
+		"""Function to return the records added since the last update, from the worker's 'samples'
+		message, mapping the file again if it has grown. Their sent times are NaN unless self.timed."""
+		count = message['count']
+		self.timed = message['timed']
+		if count > len(self.rows):
+			size = os.fstat(self.file.fileno()).st_size
+			self.rows = numpy.frombuffer(mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ),
+							dtype=SHARED_SAMPLE, count=size // SHARED_SAMPLE.itemsize)
+		rows = self.rows[self.count:count]
+		self.count = count
+		return rows
+
+	def samples(self, shared):
+		"""Function to return Samples over the records, with the rest of the state from
+		SegmentWriter.close()."""
+		rows = self.rows[:self.count]
+		samples = Samples.from_columns(rows['seq'], rows['ttl'], rows['rtt'], bytearray(shared['received']),
+						sent=(rows['sent'] if self.timed else ()))
+		samples.duplicates = shared['duplicates']
+		samples.reordered = shared['reordered']
+		return samples
+
+	def close(self):
+		self.file.close()
+
+
+def do_ping(results_q, experiment_id, host, qos=0, interval=1, count=5, size='', flood=False,
+		batch_size=BATCH_SIZE, batch_interval=BATCH_INTERVAL, binary=PING_BINARY, scheduled=None,
+		shared_prefix=None, address=None, profile=False):
+	"""Function which is executed as a process to run the ping experiment.
+
+	If address is passed ping is given it instead of host, so that ping doesn't look host up again.
+	IPv6 addresses aren't, since some pings need another command or option for them.
+	If profile is True the results have the 'overhead' of the worker's phases (see Overhead.phases).
+
+	scheduled is the time the worker was meant to start (see WorkerScheduler). If it is passed the
+	results have a 'drift' dict of how late, in ms, ping started ('start') and how much longer than
+	planned it took to send the pings ('end', which is left at 0 in flood mode where there is no plan).
+
+	Responses are sent to the main process in batches once there are batch_size samples (more if ping
+	output more at once), or sooner if batch_interval seconds have passed, so that memory use stays flat
+	and the results are available
+	while the experiment is still running. If shared_prefix is passed they are put in a SharedSegment
+	file whose name starts with it instead. Every message put onto results_q is a tuple of
+	(experiment_id, kind, value) where kind is one of:
+	  'samples' - value is a list of (seq, ttl, time) or (seq, ttl, time, sent) tuples, or with
+	              shared_prefix a dict of the file's 'path', the number of records in it ('count'),
+	              whether their sent times are known ('timed') and when it was sent ('time').
+	  'done'    - value is a dict with the remaining results. See ping_results() and
+	              SegmentWriter.close().
+	  'error'   - value is a list of ping's standard error output lines.
+	"""
+	results = {}
 
 	# Store details about this experiment in the results.
 	results['host'] = host
+	if address != None:
+		results['address'] = address
 	results['qos'] = qos
-
-        # This is a good place to calculate statistics since this is in a separate process.
-
-        # Sort the results by the ICMP sequence # in case some responses came back out of order.
-        def get_ttl(response):
-            return response[0]
-        results['responses'] = sorted(results['responses'], key=get_ttl)
-
-        # Get a list of all the sequence numbers of packets which were dropped.
-        results['losses'] = find_lost_sequence_numbers(results)
-
-        # Calculate the min and max response times.
-        min = results['responses'][0][2]
-        max = results['responses'][0][2]
-        for response in results['responses']:
-            if response[2] < min:
-                min = response[2]
-            if response[2] > max:
-                max = response[2]
-
-        results['min'] = min
-        results['max'] = max
-
-        # Put the results onto the results Queue to be collected by the main process.
-	results_q.put((experiment_id, results))
-
-
-def graph(results, line_graph=False, image_file=None):
-	"""Function to graph the results of a ping experiment."""
+	results['size'] = size
+	results['interval'] = interval
+	if flood:
+		results['flood'] = True
+
+	batch = []
+	writer = None
+	if shared_prefix != None:
+		writer = SegmentWriter(results_q, experiment_id, shared_prefix)
+	overhead = None
+	if profile:
+		overhead = Overhead()
+	last_put = started = time.time()
+	if address != None and pingtargets.is_ipv6(address):
+		address = None
+	for kind, value in ping(address or host, qos=qos, interval=interval, count=count, size=size, flood=flood,
+										debug_prefix=experiment_id, binary=binary, overhead=overhead):
+		if kind == 'responses':
+			batch.extend(value)
+			if len(batch) >= batch_size or time.time() - last_put >= batch_interval:
+				if writer:
+					writer.put(batch)
+				else:
+					results_q.put((experiment_id, 'samples', batch))
+				batch = []
+				last_put = time.time()
+		elif kind == 'truncated':
+			# TODO - It would be better to pass the fact that we saw a truncated response back in the
+			# results vs print an error here.
+			print "Error: Truncated responses for %s. No response times recorded." %(host)
+		elif kind == 'error':
+			results_q.put((experiment_id, 'error', value))
+			return
+		else:
+			results[kind] = value
+
+	if writer:
+		writer.put(batch)
+		writer.close(results)
+	elif batch:
+		results_q.put((experiment_id, 'samples', batch))
+
+	if overhead != None:
+		if scheduled != None:
+			overhead.add('schedule', started - scheduled)
+		results['overhead'] = overhead.phases
+
+	if scheduled != None:
+		results['drift'] = {'start': (started - scheduled) * 1000.0, 'end': 0.0}
+		# ping's time is from the first ping to the last (iputils) or to when it exited.
+		if 'summary' in results and results['summary']['transmitted'] > 1 and not flood:
+			planned = (results['summary']['transmitted'] - 1) * interval * 1000.0
+			results['drift']['end'] = max(results['summary']['time'] - planned, 0.0)
+
+	# Put the rest of the results onto the results Queue to be collected by the main process.
+	results_q.put((experiment_id, 'done', results))
+
+
+def finish_experiment(results):
+	"""Function to calculate the statistics of a single experiment once all of its responses are in."""
+	# Sort the results by the ICMP sequence # in case some responses came back out of order.
+	results['responses'] = as_samples(results['responses'])
+	results['responses'].sort()
+	# The samples may have changed since their digest was worked out.
+	results.pop('digest', None)
+
+	# Find the runs of packets which were dropped.
+	results['loss_runs'] = find_loss_runs(results)
+	results['duplicates'] = results['responses'].duplicates
+	results['reordered'] = results['responses'].reordered
+
+	# Calculate the statistics of the response times and losses.
+	experiment_stats(results, update=True)
+	experiment_sketch(results)
+
+
+def experiment_loss_runs(results):
+	"""Function to return the loss runs of a single experiment. They are found if the results don't have
+	them yet, e.g. results saved by an older version."""
+	if 'loss_runs' not in results:
+		results['loss_runs'] = find_loss_runs(results)
+	return results['loss_runs']
+
+
+def experiment_stats(results, update=False):
+	"""Function to return the statistics of a single experiment (see pingstats.compute(), and
+	pingstats.timing() if the responses have the times they were sent). They are calculated if the
+	results don't have them yet, e.g. results saved by an older version, or if update is True. The
+	responses must be sorted."""
+	if update or 'stats' not in results:
+		samples = as_samples(results['responses'])
+		(seq, ttl, rtt) = samples.columns()
+		transmitted = results['summary']['transmitted']
+		weights = experiment_weights(results, numpy.arange(1, transmitted + 1))
+		results['stats'] = pingstats.compute(seq, rtt, transmitted=transmitted, weights=weights)
+		sent = samples.sent_times()
+		if len(sent):
+			# Flood and adaptive modes have no fixed schedule to drift from.
+			interval = results.get('interval')
+			if results.get('flood') or 'intervals' in results:
+				interval = None
+			results['stats'].update(pingstats.timing(seq, sent, interval))
+		results['min'] = results['stats']['min']
+		results['max'] = results['stats']['max']
+
+	return results['stats']
+
+
+def experiment_sketch(results, update=False):
+	"""Function to return the pingstats.Histogram of the round trip times of a single experiment. It
+	is made from the responses if the results don't have one yet, e.g. results saved by an older
+	version, or if update is True."""
+	if update or 'sketch' not in results:
+		(seq, ttl, rtt) = as_samples(results['responses']).columns()
+		# The round trip times of adaptive experiments are counted once for each of the fastest intervals
+		# they stand for, which is always a whole number (see halvings()).
+		counts = experiment_weights(results, seq)
+		if len(counts):
+			counts = numpy.rint(counts / min([interval for (first, interval) in results['intervals']]))
+		results['sketch'] = pingstats.Histogram()
+		results['sketch'].add(rtt, counts)
+	return results['sketch']
+
+
+def experiment_weights(results, seqs):
+	"""Function to return how long, in seconds, each of the pings with sequence numbers seqs of a single
+	adaptive experiment stands for: the interval it was sent after (see IcmpEngine.add()). Returns () if
+	the experiment wasn't adaptive, when every ping stands for the same time."""
+	if 'intervals' not in results:
+		return ()
+	changes = numpy.array(results['intervals'], dtype=numpy.float64)
+	which = numpy.searchsorted(changes[:, 0], numpy.asarray(seqs, dtype=numpy.float64), side='right') - 1
+	return changes[numpy.maximum(which, 0), 1]
+
+
+def experiment_digest(results):
+	"""Function to return a digest of the samples of a single experiment, which derived() uses to tell
+	when data worked out from them is stale. Results files store it; otherwise it is worked out the
+	first time it is needed and kept until finish_experiment()."""
+	if 'digest' not in results:
+		samples = as_samples(results['responses'])
+		crc = 0
+		for column in samples.columns() + (samples.sent_times(),):
+			crc = zlib.crc32(numpy.ascontiguousarray(column), crc)
+		results['digest'] = '%08x' %(crc & 0xffffffff)
+	return results['digest']
+
+
+def derived(results, kind, params, compute):
+	"""Function to return data derived from the samples of a single experiment, a dict of NumPy arrays
+	which compute() works out. params is a dict of what else (apart from the samples) it depends on.
+
+	It is memoized in results['derived'] under kind and params with the digest of the samples it was
+	worked out from, so it is only worked out again if either changes. If the experiment was read from a
+	results file the data is kept next to the file too (see ResultsFile.save_derived())."""
+	key = json.dumps([kind, params], sort_keys=True)
+	digest = experiment_digest(results)
+	cache = results.setdefault('derived', {})
+	if key not in cache or cache[key][0] != digest:
+		cache[key] = (digest, compute())
+	return cache[key][1]
+
+
+def experiment_points(results, interval, start):
+	"""Function to return the points of the latency vs time graph of a single experiment: when each
+	ping was sent, in seconds since start, and its round trip time. They are sorted by x."""
+	(seq, ttl, rtt) = as_samples(results['responses']).columns()
+	points = (send_times(results, seq, interval, start), rtt)
+	if (numpy.diff(points[0]) < 0).any():
+		# Sent out of order, at least as far as the times can tell.
+		order = numpy.argsort(points[0], kind='mergesort')
+		points = (points[0][order], points[1][order])
+	return points
+
+
+def send_times(results, seqs, interval, start=None):
+	"""Function to return when the pings with sequence numbers seqs of a single experiment were sent, in
+	seconds since start (by default when ping 0 would have been sent), as a NumPy array. Where the
+	responses have the times they were sent those are used and the times of the other pings, e.g. the
+	lost ones, are interpolated between them (and go on every interval seconds before the first and
+	after the last). Without any the pings are taken to have been sent every interval seconds from
+	start. The responses must be sorted."""
+	seqs = numpy.asarray(seqs, dtype=numpy.float64)
+	samples = as_samples(results['responses'])
+	sent = samples.sent_times()
+	known = ~numpy.isnan(sent)
+	if not known.any():
+		return seqs * interval
+
+	seq = samples.columns()[0][known].astype(numpy.float64)
+	sent = sent[known]
+	if start == None:
+		start = sent[0] - seq[0] * interval
+	times = numpy.interp(seqs, seq, sent)
+	before = seqs < seq[0]
+	times[before] = sent[0] - (seq[0] - seqs[before]) * interval
+	after = seqs > seq[-1]
+	times[after] = sent[-1] + (seqs[after] - seq[-1]) * interval
+	return times - start
+
+
+def decimate(x, y, buckets):
+	"""Function to reduce the points (x, y) to the minimum and maximum y of each of buckets equal width
+	slices of x, so that spikes are kept however many points there are. x must be sorted.
+	Returns (x, y) as NumPy arrays of at most 2 * buckets points."""
+	x = numpy.asarray(x)
+	y = numpy.asarray(y)
+	if len(x) <= 2 * buckets:
+		return (x, y)
+
+	# Where each non-empty bucket starts and ends.
+	edges = numpy.linspace(x[0], x[-1], buckets + 1)[:-1]
+	starts = numpy.unique(numpy.searchsorted(x, edges))
+	ends = numpy.concatenate((starts[1:], [len(x)]))
+
+	# Each bucket becomes two points, its minimum at the start and its maximum at the end.
+	y_min = numpy.minimum.reduceat(y, starts)
+	y_max = numpy.maximum.reduceat(y, starts)
+	return (numpy.column_stack((x[starts], x[ends - 1])).ravel(),
+		numpy.column_stack((y_min, y_max)).ravel())
+
+
+def decimate_runs(starts, ends, xmin, xmax, buckets):
+	"""Function to reduce runs of events from x = starts to x = ends to one point at the middle of each
+	of buckets equal width slices of xmin..xmax which has an event in it, however long or many the
+	runs are. Returns the x values as a NumPy array."""
+	if xmax <= xmin or len(starts) == 0:
+		return numpy.array([])
+
+	width = (xmax - xmin) / float(buckets)
+	first = numpy.clip(((numpy.asarray(starts) - xmin) / width).astype(numpy.int64), 0, buckets)
+	last = numpy.clip(((numpy.asarray(ends) - xmin) / width).astype(numpy.int64), -1, buckets - 1)
+	keep = first <= last
+
+	# Mark the buckets each run covers: +1 where it starts and -1 after where it ends.
+	covered = numpy.zeros(buckets + 1, dtype=numpy.int64)
+	numpy.add.at(covered, first[keep], 1)
+	numpy.add.at(covered, last[keep] + 1, -1)
+	hits = numpy.flatnonzero(numpy.cumsum(covered)[:buckets] > 0)
+	return xmin + (hits + 0.5) * width
+
+
+class LevelOfDetail(object):
+	"""Class which keeps the latency vs time and loss vs time plots decimated to the resolution of the
+	axes. Only about two points per pixel column are drawn however many samples there are, and when
+	the viewer is zoomed the visible range is decimated again from the full data."""
+	def __init__(self, ax):
+		self.ax = ax
+		self.series = []
+		ax.callbacks.connect('xlim_changed', lambda ax: self.update())
+
+	def add_points(self, artist, points, scatter, view=None):
+		"""Function to add an artist (from plot() or scatter()) which shows the points returned by
+		points(), sorted (x, y). points() is only called if they are needed: view is (x, y), all of the
+		points already decimated to buckets(), which is drawn instead while the whole range is visible."""
+		self.series.append(('points', artist, [points, view], self.buckets(), scatter))
+
+	def add_runs(self, artist, starts, ends, y):
+		"""Function to add an artist (from scatter()) which marks runs of events from x = starts to
+		x = ends at height y."""
+		self.series.append(('runs', artist, starts, ends, y))
+
+	def buckets(self):
+		return max(int(self.ax.bbox.width), 1)
+
+	def update(self):
+		"""Function to redo the decimation for the visible range."""
+		(xmin, xmax) = self.ax.get_xlim()
+		buckets = self.buckets()
+		for (kind, artist, a, b, c) in self.series:
+			if kind == 'points':
+				(points, view) = a
+				if view != None and buckets == b and xmin <= view[0][0] and view[0][-1] <= xmax:
+					(x, y) = view
+				else:
+					if callable(points):
+						# Work out the points once, the first time they are needed.
+						points = a[0] = points()
+					# Include one point either side of the visible range so lines run off the edges.
+					(start, end) = points[0].searchsorted([xmin, xmax])
+					(x, y) = decimate(points[0][max(start - 1, 0):end + 1], points[1][max(start - 1, 0):end + 1], buckets)
+				if c:
+					artist.set_offsets(numpy.column_stack((x, y)))
+				else:
+					artist.set_data(x, y)
+			else:
+				x = decimate_runs(a, b, xmin, xmax, buckets)
+				artist.set_offsets(numpy.column_stack((x, numpy.ones(len(x)) * c)))
+
+
+def load_matplotlib(pyplot=True):
+	"""Function to import Matplotlib the first time there is something to graph. pyplot is only needed
+	to show the graph in a window; drawing to a FigureCanvas (e.g. for a PNG) works without it."""
+	global matplotlib, plt, FigureCanvas
+	if matplotlib == None:
+		import matplotlib.colors
+		import matplotlib.patches
+		import matplotlib.collections
+		import matplotlib.dates
+		import matplotlib.figure
+		from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+	if pyplot and plt == None:
+		import matplotlib.pyplot as plt
+
+
+def graph_axes(fig):
+	"""Function to create the axes of the graph in fig.
+	Returns: (latency vs time, packet loss, latency avg, latency mdev, histogram, loss vs time)."""
 	TITLE_FONT = {'family': 'sans-serif', 'weight': 'bold', 'size': 14}
-	colors = Colors()
-        HIST_BIN_SIZE_IN_MS = 2 # Size of the histogram bins in ms.
 
-	# Create the figure.
-	fig = plt.figure(figsize=(10,10), facecolor='w')
 	fig.subplots_adjust(left=0.09, right=0.96, top=0.92, bottom=0.07, wspace=.4, hspace=.4)
 
 	# Create the response time graph.
@@ -233,22 +1427,45 @@ def graph(results, line_graph=False, image_file=None):
 	mdev_graph.set_ylabel('Mean deviation (ms)')
 	mdev_graph.set_xticks([]) # Disables x ticks.
 
-        # Create the latency histogram.
-        hist1_graph = fig.add_subplot(4,1,3)
+	# Create the latency histogram.
+	hist1_graph = fig.add_subplot(4,1,3)
 	hist1_graph.set_title('Latency histogram (%i ms bins)' %(HIST_BIN_SIZE_IN_MS), TITLE_FONT)
 	hist1_graph.set_xlabel('Latency')
 	hist1_graph.set_ylabel('Samples')
 
-        # Create the loss graph.
-        loss_time_graph = fig.add_subplot(4,1,4)
+	# Create the loss graph.
+	loss_time_graph = fig.add_subplot(4,1,4, sharex=ax)
 	loss_time_graph.set_title('Loss vs time', TITLE_FONT)
 	loss_time_graph.set_xlabel('Time (s)')
 	loss_time_graph.set_ylabel('Loss event')
 	loss_time_graph.set_yticks([]) # Disables y ticks.
 
+	return (ax, loss_graph, latency_graph, mdev_graph, hist1_graph, loss_time_graph)
+
+
+def graph(results, line_graph=False, image_file=None):
+	"""Function to graph the results of a ping experiment."""
+	colors = Colors()
+
+	# Create the figure. An image is drawn without pyplot so that no display is needed and the figure
+	# is freed when it is done with.
+	load_matplotlib(pyplot=not image_file)
+	if image_file:
+		fig = matplotlib.figure.Figure(figsize=(10,10), facecolor='w')
+	else:
+		fig = plt.figure(figsize=(10,10), facecolor='w')
+	(ax, loss_graph, latency_graph, mdev_graph, hist1_graph, loss_time_graph) = graph_axes(fig)
+
 	# For convenience get a ref to the experiment results.
 	experiments = results['experiments']
 
+	# The time graphs are drawn decimated to the width of the axes in pixels.
+	lod = LevelOfDetail(ax)
+
+	# The time graphs are in seconds since the run started. Pings are put at when they were actually
+	# sent if that is known.
+	start = results.get('start-time')
+
         ####
 	# Plot the response time data and keep track of the largest time (X-axis) value.
         ####
@@ -258,16 +1475,22 @@ def graph(results, line_graph=False, image_file=None):
 			# No ping responses were received. 100% loss. No points to graph.
 			continue
 
-		points = [(icmp_seq / (1 / results['ping_interval']), time) for (icmp_seq, ttl, time) in experiments[result]['responses']]
-		points = zip(*points)
+		# Only the points decimated for the whole graph are kept. The rest are worked out again if the
+		# viewer is zoomed in.
+		points = functools.partial(experiment_points, experiments[result], results['ping_interval'], start)
+		view = derived(experiments[result], 'points', {'interval': results['ping_interval'], 'start': start,
+				'buckets': lod.buckets()}, lambda: dict(zip(('x', 'y'), decimate(*points(), buckets=lod.buckets()))))
+		(x, y) = (view['x'], view['y'])
 
 		if line_graph:
-			ret = ax.plot(points[0], points[1], c=colors[num], linewidth=0.6)
+			ret = ax.plot(x, y, c=colors[num], linewidth=0.6)
+			lod.add_points(ret[0], points, False, view=(x, y))
 		else:
-			ret = ax.scatter(points[0], points[1], c=colors[num], s=3, linewidths=0)
+			ret = ax.scatter(x, y, c=colors[num], s=3, linewidths=0)
+			lod.add_points(ret, points, True, view=(x, y))
 
-		if points[0][-1:][0] > x_max:
-			x_max = points[0][-1:][0]
+		if x[-1] > x_max:
+			x_max = x[-1]
 
 	# Set the axis since auto leaves too much padding.
 	ax.axis(xmin=0,ymin=0,xmax=x_max)
@@ -275,60 +1498,81 @@ def graph(results, line_graph=False, image_file=None):
         ####
 	# Plot the packet loss graph.
         ####
-	loss = [experiments[key]['summary']['packet_loss'] for key in sorted(experiments)]
+	# Adaptive experiments send more pings when there is loss so the time lost is graphed instead.
+	loss = [experiment_stats(experiments[key]).get('time_loss', experiments[key]['summary']['packet_loss'])
+		for key in sorted(experiments)]
 	ret = loss_graph.bar([x for x in range(len(loss))], loss, width=1, color=colors.list(len(loss)))
 
         ####
 	# Plot the average latency graph.
         ####
-	latency = [experiments[key]['rtt_summary']['avg'] for key in sorted(experiments)]
+	latency = [experiment_stats(experiments[key])['avg'] for key in sorted(experiments)]
 	ret = latency_graph.bar([x for x in range(len(latency))], latency, width=1, color=colors.list(len(latency)))
 
         ####
 	# Plot the latency mean deviation graph.
         ####
-	mdev = [experiments[key]['rtt_summary']['mdev'] for key in sorted(experiments)]
+	mdev = [experiment_stats(experiments[key])['mdev'] for key in sorted(experiments)]
 	ret = mdev_graph.bar([x for x in range(len(mdev))], mdev, width=1, color=colors.list(len(mdev)))
 
         ####
 	# Add the legend (beside the loss, average and mean latency graphs).
         ####
-	plt.legend(ret, [key for key in sorted(experiments)], loc=(.75,2.8))
+	loss_time_graph.legend(ret, [key for key in sorted(experiments)], loc=(.75,2.8))
 
         ####
         # Plot the latency histograms (for now all on one chart which is weird).
         ####
 
-        # Collect the data into the form that Matplotlib wants and identify the largest sample in
-        # all experiments.
-        times = []
+        # Identify the largest sample in all experiments.
         max_latency = 0
         for num,result in enumerate(sorted(experiments)):
-            times.append([time for (icmp_seq, ttl, time) in experiments[result]['responses']])
-            if experiments[result]['max'] > max_latency:
-                max_latency = experiments[result]['max']
+            if experiment_stats(experiments[result])['max'] > max_latency:
+                max_latency = experiment_stats(experiments[result])['max']
 
         # How many bins should we have? Approximately HIST_BIN_SIZE_IN_MS sized bins.
-        bins = int(max_latency / HIST_BIN_SIZE_IN_MS)
+        bins = max(int(max_latency / HIST_BIN_SIZE_IN_MS), 1)
+
+        # Bin each experiment. The histograms are made from the sketches, not the samples, so there is
+        # one value (weighted by its count) per sketch bucket. The binned counts are then drawn as
+        # one value (weighted by the count) in the middle of each bin.
+        weights = []
+        for num,result in enumerate(sorted(experiments)):
+            sketch = experiment_sketch(experiments[result])
+            binned = derived(experiments[result], 'histogram', {'bins': bins, 'range': max_latency},
+                             lambda: {'counts': numpy.histogram(sketch.values()[0], weights=sketch.values()[1], bins=bins,
+                                                                range=(0, max_latency))[0]})
+            weights.append(binned['counts'])
+        edges = numpy.histogram([], bins=bins, range=(0, max_latency))[1]
+        times = [(edges[:-1] + edges[1:]) / 2] * len(weights)
 
         # Plot the histogram.
-        n, bins, patches = hist1_graph.hist(times, bins=bins, normed=True, range=(0,max_latency), color=colors.list(len(times)))
+        n, bins, patches = hist1_graph.hist(times, weights=weights, bins=edges, normed=True, range=(0,max_latency), color=colors.list(len(times)))
 
         ####
         # Plot the loss chart.
         ####
 	for num,result in enumerate(sorted(experiments)):
-		if len(experiments[result]['losses']) == 0:
+		loss_runs = experiment_loss_runs(experiments[result])
+		if len(loss_runs) == 0:
                         # No loss. Nothing to do.
 			continue
 
-		points = [icmp_seq / (1 / results['ping_interval']) for icmp_seq in experiments[result]['losses']]
+		times = derived(experiments[result], 'loss_times', {'interval': results['ping_interval'], 'start': start},
+				lambda: {'starts': send_times(experiments[result], loss_runs[:, 0], results['ping_interval'], start),
+					'ends': send_times(experiments[result], loss_runs[:, 0] + loss_runs[:, 1] - 1, results['ping_interval'], start)})
+		(starts, ends) = (times['starts'], times['ends'])
 
-                t = [num+1 for y in points] # Set the Y-value to the exeriment ID.
-
-		ret = loss_time_graph.scatter(points, t, c=colors[num], s=3, linewidths=0)
+		# The points are filled in by the level of detail update below. The Y-value is the
+		# experiment ID.
+		ret = loss_time_graph.scatter([], [], c=colors[num], s=3, linewidths=0)
+		lod.add_runs(ret, starts, ends, num+1)
 
 	loss_time_graph.axis(xmin=0,ymin=0,xmax=x_max,ymax=num+2)
+	lod.update()
+
+	# Keep what was worked out for next time.
+	save_derived(results)
 
         ####
 	# Write out the image if requested otherwise show it.
@@ -340,61 +1584,1512 @@ def graph(results, line_graph=False, image_file=None):
 		plt.show()
 
 
-def experiment(ping_count, ping_interval, target_list):
-	"""Function to define and run the ping experiment."""
-	# Create a queue for receiving the results from the work processes.
-	results_q = Queue()
+class LiveSeries(object):
+	"""The samples of one experiment which a LiveGraph has in its window plus running totals."""
+	def __init__(self):
+		self.pending = [] # (seq, ttl, time) or (seq, ttl, time, sent) samples which haven't been drawn yet.
+		self.x = numpy.array([])
+		self.y = numpy.array([])
+		self.loss_starts = numpy.array([])
+		self.loss_ends = numpy.array([])
+		self.last_point = None # The last point drawn, so that new line segments join on to it.
+		self.seq_max = 0
+		self.x_last = None # The x of seq_max.
+		self.count = 0
+		self.rtt_sum = 0.0
+		self.rtt_sum2 = 0.0
+		self.hist = numpy.zeros(1, dtype=numpy.int64)
+
+
+class LiveGraph(object):
+	"""Class which draws the graph while the experiment is running. Pass add() as experiment()'s callback.
+
+	The cost of each update is bounded however many samples arrive and however long the run is:
+	- Redraws are limited to fps per second and use blitting. The latency and loss vs time graphs are
+	  append-only; just the samples which are new since the last redraw are drawn, on top of a saved
+	  copy of what was there before, which is then saved again. The histogram and bar graphs are
+	  single artists drawn over a saved background.
+	- Only the last window seconds are kept. Everything, including the axes, is only drawn again when
+	  the window moves on (by half a window at a time) or a value goes past the limits of the axes.
+	  That draws the window decimated to the width of the axes.
+	- The histogram counts are updated with just the new samples.
+	"""
+	def __init__(self, names, ping_interval, window=LIVE_WINDOW, fps=LIVE_FPS, line_graph=False, fig=None, start=None):
+		"""Function to create the graph. start is when the run started, in seconds since the epoch, which
+		samples with the time they were sent are drawn relative to. By default it is now."""
+		self.names = sorted(names)
+		self.ping_interval = ping_interval
+		if start == None:
+			start = time.time()
+		self.start = start
+		self.window = window
+		self.line_graph = line_graph
+		self.min_redraw_interval = 1.0 / fps
+		self.last_draw = 0
+		self.series = dict([(name, LiveSeries()) for name in self.names])
+		self.own_figure = fig == None
+		load_matplotlib(pyplot=self.own_figure)
+		self.colors = numpy.array([matplotlib.colors.to_rgba(c) for c in Colors().list(len(self.names))])
+
+		if self.own_figure:
+			plt.ion()
+			fig = plt.figure(figsize=(10,10), facecolor='w')
+			plt.show(block=False)
+		self.fig = fig
+		(self.ax, loss_graph, latency_graph, mdev_graph, self.hist_graph, self.loss_time_graph) = graph_axes(fig)
+		self.bar_graphs = (loss_graph, latency_graph, mdev_graph)
+
+		# There is one artist per graph rather than one per experiment since most of the cost of drawing
+		# is per artist. The window artists are only drawn in full redraws. The others are animated so
+		# that they are left out of the saved backgrounds.
+		self.window_points = self._points_artist(False)
+		self.new_points = self._points_artist(True)
+		self.window_losses = self.loss_time_graph.scatter([], [], s=3, linewidths=0)
+		self.new_losses = self.loss_time_graph.scatter([], [], s=3, linewidths=0, animated=True)
+		self.hist_lines = matplotlib.collections.LineCollection([], colors=self.colors, animated=True)
+		self.hist_graph.add_collection(self.hist_lines)
+		self.bars = []
+		for bar_graph in self.bar_graphs:
+			bars = matplotlib.collections.PolyCollection([], facecolors=self.colors, animated=True)
+			bar_graph.add_collection(bars)
+			bar_graph.axis(xmin=0, xmax=len(self.names))
+			self.bars.append(bars)
+		legend = [matplotlib.patches.Rectangle((0, 0), 1, 1, fc=color) for color in self.colors]
+		# The legend overlaps the latency vs time graph so a copy of it is put back on top of the new points.
+		self.legend = loss_graph.legend(legend, self.names, loc=(3.8, 0), framealpha=1)
+
+		self.ax.axis(xmin=0, xmax=window, ymin=0, ymax=1)
+		self.loss_time_graph.axis(ymin=0, ymax=len(self.names) + 1)
+		loss_graph.axis(ymin=0, ymax=100)
+		latency_graph.axis(ymin=0, ymax=1)
+		mdev_graph.axis(ymin=0, ymax=1)
+		self.hist_graph.axis(xmin=0, xmax=HIST_BIN_SIZE_IN_MS, ymin=0, ymax=1)
+
+		# The saved backgrounds are the wrong size once the window has been resized.
+		self.backgrounds = None
+		fig.canvas.mpl_connect('resize_event', self.resized)
+
+	def resized(self, event):
+		self.backgrounds = None
+
+	def close(self):
+		"""Function to close the window, if LiveGraph opened it, so the final graph can be shown."""
+		if self.own_figure:
+			plt.close(self.fig)
+			plt.ioff()
+
+	def _points_artist(self, animated):
+		if self.line_graph:
+			artist = matplotlib.collections.LineCollection([], linewidths=0.6, animated=animated)
+			self.ax.add_collection(artist)
+		else:
+			artist = self.ax.scatter([], [], s=2, linewidths=0, animated=animated)
+		return artist
+
+	def _set_points(self, artist, points):
+		"""Function to set the [(x, y), ...] arrays of points, one per experiment, drawn by artist."""
+		if self.line_graph:
+			artist.set_segments(points)
+			artist.set_color(self.colors)
+		else:
+			colors = [numpy.repeat(self.colors[num:num + 1], len(p), axis=0) for (num, p) in enumerate(points)]
+			artist.set_offsets(numpy.concatenate(points).reshape(-1, 2))
+			artist.set_facecolors(numpy.concatenate(colors).reshape(-1, 4))
+
+	def _set_losses(self, artist, losses):
+		"""Function to set the x values of the loss marks, one array per experiment, drawn by artist."""
+		points = [numpy.column_stack((x, numpy.ones(len(x)) * (num + 1))) for (num, x) in enumerate(losses)]
+		colors = [numpy.repeat(self.colors[num:num + 1], len(x), axis=0) for (num, x) in enumerate(losses)]
+		artist.set_offsets(numpy.concatenate(points).reshape(-1, 2))
+		artist.set_facecolors(numpy.concatenate(colors).reshape(-1, 4))
+
+	def add(self, name, samples, results=None):
+		"""Function to add a list of (seq, ttl, time) or (seq, ttl, time, sent) samples for experiment name."""
+		series = self.series[name]
+		series.pending.extend(samples)
+
+		now = time.time()
+		if now - self.last_draw >= self.min_redraw_interval:
+			self.draw()
+			self.last_draw = now
+
+	def _take_pending(self, series):
+		"""Function to move the pending samples of series into its window and running totals.
+		Returns (x, y, loss_starts, loss_ends) of what was new."""
+		pending = series.pending
+		series.pending = []
+		if len(pending) == 0:
+			return (numpy.array([]), numpy.array([]), numpy.array([]), numpy.array([]))
+		widths = set(map(len, pending))
+		if len(widths) > 1:
+			# Some have the time they were sent and some don't.
+			pending = [tuple(sample) + (float('nan'),) * (4 - len(sample)) for sample in pending]
+		samples = numpy.array(pending, dtype=numpy.float64).reshape(len(pending), -1)
+		samples = samples[numpy.argsort(samples[:, 0], kind='mergesort')]
+		(seq, rtt) = (samples[:, 0], samples[:, 2])
+
+		# Samples are drawn at when they were sent, if that is known.
+		x = seq * self.ping_interval
+		if samples.shape[1] == 4:
+			x = numpy.where(numpy.isnan(samples[:, 3]), x, samples[:, 3] - self.start)
+
+		# A jump in the sequence numbers is a loss (unless the replies turn up later out of order). The
+		# lost pings are from an interval after the reply before to an interval before the reply after.
+		if series.x_last == None:
+			series.x_last = x[0] - (seq[0] - series.seq_max) * self.ping_interval
+		edges = numpy.concatenate(([series.seq_max], seq))
+		edges_x = numpy.concatenate(([series.x_last], x))
+		gaps = numpy.flatnonzero(numpy.diff(edges) > 1)
+		loss_starts = edges_x[gaps] + self.ping_interval
+		loss_ends = edges_x[gaps + 1] - self.ping_interval
+		series.loss_starts = numpy.concatenate((series.loss_starts, loss_starts))
+		series.loss_ends = numpy.concatenate((series.loss_ends, loss_ends))
+		if seq[-1] > series.seq_max:
+			series.seq_max = int(seq[-1])
+			series.x_last = x[-1]
+
+		if (numpy.diff(x) < 0).any():
+			order = numpy.argsort(x, kind='mergesort')
+			(x, rtt) = (x[order], rtt[order])
+		if len(series.x) and x[0] < series.x[-1]:
+			# Out of order with what is already in the window.
+			series.x = numpy.concatenate((series.x, x))
+			series.y = numpy.concatenate((series.y, rtt))
+			order = numpy.argsort(series.x, kind='mergesort')
+			(series.x, series.y) = (series.x[order], series.y[order])
+		else:
+			series.x = numpy.concatenate((series.x, x))
+			series.y = numpy.concatenate((series.y, rtt))
+
+		series.count += len(rtt)
+		series.rtt_sum += rtt.sum()
+		series.rtt_sum2 += numpy.dot(rtt, rtt)
+
+		bins = (rtt / HIST_BIN_SIZE_IN_MS).astype(numpy.int64)
+		if bins.max() >= len(series.hist):
+			series.hist = numpy.concatenate((series.hist, numpy.zeros(bins.max() + 1 - len(series.hist), dtype=numpy.int64)))
+		series.hist += numpy.bincount(bins, minlength=len(series.hist))
+
+		return (x, rtt, loss_starts, loss_ends)
+
+	def _grow(self, ax, ymax=None, xmax=None):
+		"""Function to make room for ymax and/or xmax on ax. Returns True if the limits changed."""
+		changed = False
+		(bottom, top) = ax.get_ylim()
+		if ymax != None and ymax > top:
+			ax.set_ylim(bottom, ymax * 1.5)
+			changed = True
+		(left, right) = ax.get_xlim()
+		if xmax != None and xmax > right:
+			ax.set_xlim(left, xmax * 1.5)
+			changed = True
+		return changed
+
+	def draw(self):
+		"""Function to bring the window up to date."""
+		stale = self.backgrounds == None
+		(left, right) = self.ax.get_xlim()
+		buckets = max(int(self.ax.bbox.width), 1)
+
+		new_points = []
+		new_losses = []
+		hist = []
+		bars = numpy.zeros((3, len(self.names)))
+		x_newest = 0
+		y_max = 0
+		for num, name in enumerate(self.names):
+			series = self.series[name]
+			(x, y, loss_starts, loss_ends) = self._take_pending(series)
+
+			# Only the new points are drawn, decimated to the pixels they span.
+			if len(x):
+				(x, y) = decimate(x, y, int(buckets * (x[-1] - x[0]) / self.window) + 1)
+				x_newest = max(x_newest, x[-1])
+				y_max = max(y_max, y.max())
+			points = numpy.column_stack((x, y))
+			if self.line_graph and series.last_point != None and len(points):
+				points = numpy.concatenate(([series.last_point], points))
+			if len(points):
+				series.last_point = tuple(points[-1])
+			new_points.append(points)
+			new_losses.append(decimate_runs(loss_starts, loss_ends, left, right, buckets))
+
+			if series.count:
+				# Draw the histogram as steps along the edges of the bins.
+				density = series.hist / float(series.count * HIST_BIN_SIZE_IN_MS)
+				edges = numpy.arange(len(density) + 1) * HIST_BIN_SIZE_IN_MS
+				hist.append(numpy.column_stack((numpy.repeat(edges, 2)[1:-1], numpy.repeat(density, 2))))
+
+				avg = series.rtt_sum / series.count
+				mdev = numpy.sqrt(max(series.rtt_sum2 / series.count - avg * avg, 0.0))
+				loss = 100.0 * max(series.seq_max - series.count, 0) / series.seq_max
+				bars[:, num] = (loss, avg, mdev)
+			else:
+				hist.append(numpy.zeros((0, 2)))
+
+		# Move the window on by half a window at a time so the background only changes now and then.
+		if x_newest > right:
+			left = max(x_newest - self.window / 2.0, 0)
+			right = left + self.window
+			self.ax.set_xlim(left, right)
+			stale = True
+		stale |= self._grow(self.ax, ymax=y_max)
+
+		self.hist_lines.set_segments(hist)
+		stale |= self._grow(self.hist_graph, ymax=max([h[:, 1].max() for h in hist if len(h)] + [0]),
+						xmax=max([h[-1, 0] for h in hist if len(h)] + [0]))
+		for (collection, heights, bar_graph) in zip(self.bars, bars, self.bar_graphs):
+			collection.set_verts([[(num, 0), (num, h), (num + 1, h), (num + 1, 0)] for (num, h) in enumerate(heights)])
+			if bar_graph != self.bar_graphs[0]:
+				stale |= self._grow(bar_graph, ymax=heights.max())
+
+		canvas = self.fig.canvas
+		append_axes = (self.ax, self.loss_time_graph)
+		other_axes = (self.hist_graph,) + self.bar_graphs
+		if stale:
+			# Draw everything, with the whole window, from scratch.
+			points = []
+			losses = []
+			for name in self.names:
+				series = self.series[name]
+
+				# Drop what has scrolled out of the window.
+				start = series.x.searchsorted(left)
+				(series.x, series.y) = (series.x[start:], series.y[start:])
+				keep = series.loss_ends >= left
+				(series.loss_starts, series.loss_ends) = (series.loss_starts[keep], series.loss_ends[keep])
+
+				points.append(numpy.column_stack(decimate(series.x, series.y, buckets)))
+				losses.append(decimate_runs(series.loss_starts, series.loss_ends, left, right, buckets))
+			self._set_points(self.window_points, points)
+			self._set_losses(self.window_losses, losses)
+			self._set_points(self.new_points, [numpy.zeros((0, 2))] * len(self.names))
+			self._set_losses(self.new_losses, [[]] * len(self.names))
+
+			canvas.draw()
+			self.backgrounds = dict([(ax, canvas.copy_from_bbox(ax.bbox)) for ax in append_axes + other_axes])
+			self.legend_image = canvas.copy_from_bbox(self.legend.get_window_extent())
+		else:
+			# Add the new points to the time graphs and save them as part of the background.
+			self._set_points(self.new_points, new_points)
+			self._set_losses(self.new_losses, new_losses)
+			for ax in append_axes:
+				canvas.restore_region(self.backgrounds[ax])
+				for artist in ax.collections:
+					if artist.get_animated():
+						ax.draw_artist(artist)
+				self.backgrounds[ax] = canvas.copy_from_bbox(ax.bbox)
+				canvas.blit(ax.bbox)
+
+		for ax in other_axes:
+			canvas.restore_region(self.backgrounds[ax])
+			for artist in ax.collections:
+				ax.draw_artist(artist)
+			canvas.blit(ax.bbox)
+		canvas.restore_region(self.legend_image)
+		canvas.blit(self.legend.get_window_extent())
+		canvas.flush_events()
+
+
+def summarize(results, transmitted, elapsed):
+	"""Function to fill in the summary and rtt_summary of results from the responses, for when they can
+	not come from ping, e.g. when the experiment was resumed. elapsed is in seconds."""
+	(seq, ttl, rtt) = as_samples(results['responses']).columns()
+	received = len(numpy.unique(seq))
+
+	packet_loss = 0
+	if transmitted:
+		packet_loss = int((transmitted - received) * 100 / transmitted)
+	results['summary'] = {'transmitted': transmitted,
+				'received': received,
+				'packet_loss': packet_loss,
+				'time': elapsed * 1000.0}
+
+	stats = pingstats.compute(seq, rtt)
+	results['rtt_summary'] = {'min': stats['min'], 'avg': stats['avg'], 'max': stats['max'], 'mdev': stats['mdev']}
+
+
+class WorkerScheduler(object):
+	"""Class which decides when the worker process of each target is started.
+
+	At most max_workers workers run at once and, if max_pps is passed, together they send at most max_pps
+	pings a second (but there is always at least one worker). Each running worker has a slot and each
+	slot has a phase, spread across the ping interval with some jitter, so the workers neither start
+	nor send their pings all at once. Targets which don't get a slot are queued, in order, and start
+	when a slot's phase next comes around after it is freed.
+	"""
+	def __init__(self, keys, interval, max_workers=MAX_WORKERS, max_pps=None, start=None, seed=None):
+		self.interval = interval
+		self.queue = list(reversed(keys)) # Popped from the end.
+		self.running = {} # key -> slot
+
+		slots = min(max_workers, len(keys))
+		if max_pps != None and interval > 0:
+			slots = min(slots, int(max_pps * interval))
+		slots = max(slots, 1)
+
+		if start == None:
+			start = time.time()
+		random_state = random.Random(seed)
+		self.phases = [start + (i + random_state.random()) * interval / slots for i in range(slots)]
+		# (when, slot) of the free slots.
+		self.free = [(phase, i) for i, phase in enumerate(self.phases)]
+		heapq.heapify(self.free)
+
+	def due(self, now):
+		"""Function to return a list of the (key, scheduled time) of the workers to start now."""
+		started = []
+		while self.queue and self.free and self.free[0][0] <= now:
+			(when, slot) = heapq.heappop(self.free)
+			key = self.queue.pop()
+			self.running[key] = slot
+			started.append((key, when))
+		return started
+
+	def wait(self, now):
+		"""Function to return how many seconds until the next worker is due, or None if that depends on
+		a running worker finishing first."""
+		if not self.queue or not self.free:
+			return None
+		return max(self.free[0][0] - now, 0.0)
+
+	def add(self, key):
+		"""Function to queue key, after the keys which are already queued."""
+		self.queue.insert(0, key)
+
+	def done(self, key, now):
+		"""Function to free the slot of the worker of key, which finished at now. The slot is used again
+		at its first phase after now."""
+		slot = self.running.pop(key)
+		when = self.phases[slot]
+		if self.interval > 0 and now > when:
+			when += math.ceil((now - when) / self.interval) * self.interval
+		heapq.heappush(self.free, (when, slot))
+
+
+def report_drift(experiments):
+	"""Function to print how far the experiments strayed from when they were scheduled to send. The
+	experiments must be finished."""
+	drifts = [experiments[name]['drift'] for name in experiments if 'drift' in experiments[name]]
+	if drifts:
+		start = numpy.array([d['start'] for d in drifts])
+		end = numpy.array([d['end'] for d in drifts])
+		print "Schedule drift: start %.1f ms mean, %.1f ms max; end %.1f ms mean, %.1f ms max" \
+			%(start.mean(), start.max(), end.mean(), end.max())
+
+	# How far the pings were sent from when they should have been, where the send times are known.
+	timed = [(experiment_stats(experiments[name]), name) for name in sorted(experiments)]
+	timed = [(stats, name) for (stats, name) in timed if 'send_drift_max' in stats]
+	if timed:
+		(worst, worst_name) = max(timed, key=lambda t: t[0]['send_drift_max'])
+		print "Send drift: %.1f ms mean, %.1f ms max (%s) behind schedule; a ping every %.3f ms on average (%.3f ms configured)" \
+			%(numpy.mean([stats['send_drift_avg'] for (stats, name) in timed]), worst['send_drift_max'], worst_name,
+			numpy.mean([stats['send_interval'] for (stats, name) in timed]),
+			experiments[worst_name]['interval'] * 1000.0)
+
+
+def run_workers(results, ping_count, ping_interval, target_list, callback=None, done_callback=None, offsets=None,
+		batch_interval=BATCH_INTERVAL, ping_binary=PING_BINARY, max_workers=MAX_WORKERS, max_pps=None, flood=False,
+		addresses=None, overhead=None):
+	"""Function to run the experiment with one ping process per target. The processes are started
+	by a WorkerScheduler with max_workers and max_pps. If overhead is passed the time each phase takes
+	is added to it.
+
+	The workers put the samples in SharedSegment files. Unless an experiment is being resumed, its
+	Samples are over the file, so the samples are never copied into this process.
+	"""
+	# Create a queue for receiving the results from the work processes. It is bounded so that if this
+	# process falls behind the workers wait instead of the samples piling up in memory.
+	results_q = Queue(MAX_QUEUED_BATCHES)
+	# Runs in other threads of the same process have their own files.
+	shared_prefix = 'pingexp-%i-%i-' %(os.getpid(), next(shared_runs))
+	try:
+		run_worker_queue(results, results_q, shared_prefix, ping_count, ping_interval, target_list, callback=callback,
+				done_callback=done_callback, offsets=offsets, batch_interval=batch_interval,
+				ping_binary=ping_binary, max_workers=max_workers, max_pps=max_pps, flood=flood, addresses=addresses,
+				overhead=overhead)
+	finally:
+		# Remove the files of any workers which didn't get as far as sending a message about them.
+		for path in glob.glob(os.path.join(shared_dir(), shared_prefix + '*')):
+			os.unlink(path)
+
+
+def run_worker_queue(results, results_q, shared_prefix, ping_count, ping_interval, target_list, callback=None,
+		done_callback=None, offsets=None, batch_interval=BATCH_INTERVAL, ping_binary=PING_BINARY,
+		max_workers=MAX_WORKERS, max_pps=None, flood=False, addresses=None, overhead=None):
+	"""Function which starts the workers and collects their messages for run_workers()."""
+	if offsets == None:
+		offsets = {}
+	if addresses == None:
+		addresses = {}
 
 	# Setup the experiments.
-	experiments = []
+	experiments = {}
+	for target in target_list:
+		experiments[target[0]] = {'args': (results_q, target[0], target[1]), 'kwargs': {'qos': target[2], 'size': target[3], 'interval': ping_interval, 'count': ping_count - offsets.get(target[0], 0), 'batch_interval': batch_interval, 'binary': ping_binary, 'flood': flood, 'shared_prefix': shared_prefix, 'address': addresses.get(target[1]), 'profile': overhead != None}}
+		if target[0] not in results['experiments']:
+			results['experiments'][target[0]] = {'responses': Samples()}
+		experiment_sketch(results['experiments'][target[0]])
+
+	scheduler = WorkerScheduler([target[0] for target in target_list], ping_interval, max_workers=max_workers,
+					max_pps=max_pps)
+	workers = {}
+	segments = {}
+
+	# Collect the samples as they arrive until each experiment is done, starting the experiments as
+	# they are due.
+	remaining = len(experiments)
+	while remaining > 0:
+		for (name, when) in scheduler.due(time.time()):
+			experiment = experiments[name]
+			experiment['kwargs']['scheduled'] = when
+			workers[name] = Process(target=do_ping, args=experiment['args'], kwargs=experiment['kwargs'])
+			workers[name].start()
+
+		try:
+			(name, kind, value) = results_q.get(True, scheduler.wait(time.time()))
+		except Empty:
+			continue
+
+		if kind == 'samples':
+			if overhead != None:
+				overhead.add('ipc', time.time() - value['time'])
+			if name not in segments:
+				segments[name] = SharedSegment(value['path'])
+			rows = segments[name].update(value)
+			sent = rows['sent'] if value['timed'] else ()
+
+			# ping always starts at 1 so resumed experiments need their sequence numbers moved along,
+			# and their samples added to the ones from before. Otherwise the Samples are made over the
+			# file when the experiment is done.
+			offset = offsets.get(name, 0)
+			seq = rows['seq'].astype(numpy.int64) + offset
+			responses = results['experiments'][name]['responses']
+			if offset or len(responses):
+				responses.extend_columns(seq, rows['ttl'], rows['rtt'], sent)
+
+			# The sketch is kept up to date with the samples which were stored (not the duplicates).
+			results['experiments'][name]['sketch'].add(rows['rtt'])
+			if callback:
+				if len(sent):
+					samples = zip(seq.tolist(), rows['ttl'].tolist(), rows['rtt'].tolist(), sent.tolist())
+				else:
+					samples = zip(seq.tolist(), rows['ttl'].tolist(), rows['rtt'].tolist())
+				callback(name, samples, results)
+		elif kind == 'done':
+			if 'dialect' in value:
+				print "Got results for %(name)s (%(dialect)s output)" %{'name': name, 'dialect': value['dialect']}
+			else:
+				print "Got results for %(name)s" %{'name': name}
+
+			# Store all of the results.
+			shared = value.pop('shared')
+			if overhead != None:
+				overhead.merge(value.pop('overhead'))
+			responses = results['experiments'][name]['responses']
+			if name in segments:
+				segment = segments.pop(name)
+				if offsets.get(name, 0) or len(responses):
+					responses.duplicates += shared['duplicates']
+					responses.reordered += shared['reordered']
+				else:
+					results['experiments'][name]['responses'] = segment.samples(shared)
+				segment.close()
+			results['experiments'][name].update(value)
+			if name in offsets:
+				summarize(results['experiments'][name], ping_count, value['summary']['time'] / 1000.0 + offsets[name] * ping_interval)
+			finished = time.time()
+			finish_experiment(results['experiments'][name])
+			if overhead != None:
+				overhead.add('stats', time.time() - finished)
+			if done_callback:
+				done_callback(name, results['experiments'][name])
+			remaining -= 1
+
+			# Make way for the next worker.
+			workers.pop(name).join()
+			scheduler.done(name, time.time())
+		else:
+			# The ping command failed. Dump the output ping sent to stderr and bail.
+			print "Ping failed. Ping standard error output follows this message."
+			for line in value:
+				print line
+			print "No results for %(name)s. Exiting." %{'name': name}
+			raise SystemExit()
+
+	report_drift(dict([(name, results['experiments'][name]) for name in experiments]))
+
+
+def run_native(results, ping_count, ping_interval, target_list, callback=None, done_callback=None, offsets=None,
+		flood=False, addresses=None, adaptive=None, budget=None, overhead=None):
+	"""Function to run the experiment with the in-process IcmpEngine."""
+	if offsets == None:
+		offsets = {}
+	if addresses == None:
+		addresses = {}
+	engine = IcmpEngine(budget=budget, overhead=overhead)
+	for target in target_list:
+		if target[0] not in results['experiments']:
+			results['experiments'][target[0]] = {'responses': Samples()}
+		results['experiments'][target[0]].update({'host': target[1], 'qos': target[2], 'size': target[3],
+								'interval': ping_interval})
+		if flood:
+			results['experiments'][target[0]]['flood'] = True
+		if adaptive != None:
+			results['experiments'][target[0]]['adaptive'] = adaptive
+		try:
+			# The engine appends to the experiment's Samples as the replies arrive.
+			engine.add(target[0], target[1], qos=target[2], interval=ping_interval, size=target[3],
+					count=ping_count - offsets.get(target[0], 0), seq_offset=offsets.get(target[0], 0),
+					responses=results['experiments'][target[0]]['responses'], flood=flood,
+					address=addresses.get(target[1]), fast_interval=adaptive)
+		except socket.error, e:
+			print "No results for %(name)s (%(error)s). Exiting." %{'name': target[0], 'error': e}
+			raise SystemExit()
+
+	def on_response(name, response):
+		callback(name, [response], results)
+
+	try:
+		engine_results = engine.run(callback=(callback and on_response))
+	except socket.error, e:
+		print "Could not open an ICMP socket (%s). Exiting." %(e)
+		raise SystemExit()
+
+	for name in engine_results:
+		print "Got results for %(name)s" %{'name': name}
+		results['experiments'][name].update(engine_results[name])
+		if name in offsets:
+			summarize(results['experiments'][name], ping_count, engine_results[name]['summary']['time'] / 1000.0 + offsets[name] * ping_interval)
+		finished = time.time()
+		finish_experiment(results['experiments'][name])
+		if overhead != None:
+			overhead.add('stats', time.time() - finished)
+		if done_callback:
+			done_callback(name, results['experiments'][name])
+
+	report_drift(dict([(name, results['experiments'][name]) for name in engine_results]))
+
+
+def combine_callbacks(callbacks):
+	"""Function to return a callback which calls each of callbacks in turn, or None if there are none."""
+	callbacks = [c for c in callbacks if c]
+	if not callbacks:
+		return None
+
+	def callback(*args):
+		for c in callbacks:
+			c(*args)
+	return callback
+
+
+def resolve_targets(results, target_list, resolver=None):
+	"""Function to look up the hosts of target_list, all at once, with resolver (pingtargets.resolver by
+	default). Every experiment gets the 'address' of its host and how long, in ms, the lookup took
+	('resolve_time'), and results gets how long all of the lookups took. Exits if a host can't be found.
+	Returns {host: address}."""
+	if resolver == None:
+		resolver = pingtargets.resolver
+	started = time.time()
+	lookups = resolver.resolve([target[1] for target in target_list])
+	results['resolve_time'] = (time.time() - started) * 1000.0
+
+	failed = sorted([host for host in lookups if 'error' in lookups[host]])
+	for host in failed:
+		print "Could not resolve %(host)s (%(error)s)." %{'host': host, 'error': lookups[host]['error']}
+	if failed:
+		print "Exiting."
+		raise SystemExit()
+
+	addresses = {}
 	for target in target_list:
-		experiments.append({'args': (results_q, target[0], target[1]), 'kwargs': {'qos': target[2], 'size': target[3], 'interval': ping_interval, 'count': ping_count}})
+		lookup = lookups[target[1]]
+		addresses[target[1]] = lookup['address']
+		if target[0] not in results['experiments']:
+			results['experiments'][target[0]] = {'responses': Samples()}
+		results['experiments'][target[0]].update({'address': lookup['address'], 'resolve_time': lookup['time']})
+	return addresses
+
+
+def experiment(ping_count, ping_interval, target_list, callback=None, engine='ping', done_callback=None, resumed=None,
+		batch_interval=BATCH_INTERVAL, ping_binary=PING_BINARY, max_workers=MAX_WORKERS, max_pps=None, flood=False,
+		resolver=None, adaptive=None, budget=None, overhead=None):
+	"""Function to define and run the ping experiment.
+
+	engine is either 'ping', to run one ping_binary process per target, or 'native' to send and receive
+	the echo requests with the in-process IcmpEngine. The 'ping' engine runs at most max_workers
+	processes at once, which send at most max_pps pings a second between them (see WorkerScheduler).
+
+	If flood is True each ping is sent as soon as the reply to the one before arrives (or after
+	FLOOD_TIMEOUT), but at least ping_interval after it.
 
-	# Start each experiment.
-	for num,experiment in enumerate(experiments):
-		w = Process(target=do_ping, args=experiment['args'], kwargs=experiment['kwargs'])
-		w.start()
+	If adaptive is passed (only with the 'native' engine) it is the shortest interval: each target is
+	pinged for ping_count * ping_interval seconds, more often than every ping_interval while its path is
+	misbehaving, and all of them send at most budget pings between them (see IcmpEngine).
+
+	If overhead is passed the time pingexp's own work takes is added to it (see Overhead).
+
+	If callback is passed it is called as callback(experiment_id, samples, results) every time a
+	batch of samples arrives, while the experiment is still running. If done_callback is passed it is
+	called as done_callback(experiment_id, experiment_results) when each experiment finishes. With the
+	'ping' engine the samples are passed on at least every batch_interval seconds.
+
+	resumed is a dict of {experiment_id: experiment_results} recovered from an interrupted run (see
+	read_log()). Those experiments only send the pings which are left, carrying on from the highest
+	sequence number recovered. Experiments which had already finished are not run again.
+
+	The hosts are looked up with resolver before any pings are sent (see resolve_targets()) and each
+	target of a host pings the same address.
+	"""
+	# Whatever ping can't do is refused before anything is pinged, rather than the results saying it was.
+	if engine == 'ping':
+		check_ping(ping_binary, target_list, flood)
 
 	# A place to store the results.
 	results = {}
 	results['experiments'] = {}
-	results['start-time'] = time.time() # Store approximately when the experiment started.
 
-	# Wait for a result from each experiment and store them.
-	for num in range(len(experiments)):
-		tmp = results_q.get()
-		print "Got results for %(name)s" %{'name': tmp[0]}
-		if tmp[1] == None:
-			# The ping command failed. Bail.
-			print "No results for %(name)s. Exiting." %{'name': tmp[0]}
-			raise SystemExit()
+	# Store the ping_count and ping_interval in results. These are global values.
+	results['ping_count'] = ping_count
+	results['ping_interval'] = ping_interval
+	if flood:
+		results['flood'] = True
+	if adaptive != None:
+		results['adaptive'] = adaptive
+		results['budget'] = budget
+
+	# Work out where each resumed experiment carries on from.
+	offsets = {}
+	if resumed:
+		remaining_targets = []
+		for target in target_list:
+			if target[0] not in resumed:
+				remaining_targets.append(target)
+				continue
+
+			previous = resumed[target[0]]
+			results['experiments'][target[0]] = previous
+			offset = 0
+			if len(previous['responses']):
+				offset = int(as_samples(previous['responses']).columns()[0].max())
+
+			if 'summary' not in previous and offset < ping_count:
+				offsets[target[0]] = offset
+				remaining_targets.append(target)
+				continue
+
+			# Nothing left to send.
+			if 'summary' not in previous:
+				summarize(previous, ping_count, ping_count * ping_interval)
+			finish_experiment(previous)
+		target_list = remaining_targets
+
+	# The lookups are done first so that they don't hold up the pings or count towards their times.
+	addresses = resolve_targets(results, target_list, resolver)
+	results['start-time'] = time.time() # Store approximately when the experiment started.
 
-		# Store all of the results.
-		results['experiments'][tmp[0]] = tmp[1]
+	if engine == 'native':
+		run_native(results, ping_count, ping_interval, target_list, callback=callback, done_callback=done_callback, offsets=offsets,
+				flood=flood, addresses=addresses, adaptive=adaptive, budget=budget, overhead=overhead)
+	else:
+		run_workers(results, ping_count, ping_interval, target_list, callback=callback, done_callback=done_callback, offsets=offsets,
+				batch_interval=batch_interval, ping_binary=ping_binary, max_workers=max_workers, max_pps=max_pps,
+				flood=flood, addresses=addresses, overhead=overhead)
 
 	# Store (roughly) when the experiment ends.
 	results['end-time'] = time.time()
 
-	# Store the ping_count and ping_interval in results. These are global values.
-	results['ping_count'] = ping_count
-	results['ping_interval'] = ping_interval
+	return results
+
+
+##
+# Overhead
+# How long pingexp's own work takes. With --calibrate the targets are first swapped for loopback and
+# pinged with the same interval, engine and concurrency as the experiment, timing each of the phases:
+#   'schedule' - how late the ping commands (or the native engine's requests) were started
+#   'send'     - how far ping sent behind its own schedule (only known where ping prints when replies
+#                arrive)
+#   'read'     - from ping getting a reply to the worker reading it from the pipe (likewise)
+#   'parse'    - parsing each read of ping's output
+#   'ipc'      - from a worker passing on samples to experiment() getting them
+#   'stats'    - working out the statistics of each experiment once it is done
+# The round trip times to loopback are what the tool and the load on the host add to every sample.
+##
+OVERHEAD_PHASES = ('schedule', 'send', 'read', 'parse', 'ipc', 'stats')
+# The calibration run pings for at most CALIBRATION_TIME seconds but sends at least CALIBRATION_COUNT
+# pings to each target (unless -c COUNT is fewer).
+CALIBRATION_TIME = 5.0
+CALIBRATION_COUNT = 5
+# How many pings to each target the calibration run sends at most with --flood or -i 0, since how long
+# those take depends on the replies.
+CALIBRATION_FLOOD_COUNT = 1000
+# If 1% of the round trip times to loopback are more than this many ms the host is too loaded for the
+# measurements to be trusted to within a millisecond.
+CALIBRATION_LOADED = 1.0
+
+
+class Overhead(object):
+	"""Class which adds up the times each phase of pingexp's own work takes."""
+	def __init__(self):
+		self.phases = {} # phase -> [count, total seconds, longest seconds]
+
+	def add(self, phase, seconds):
+		"""Function to add how many seconds phase took once, or a list of times it took."""
+		seconds = numpy.atleast_1d(numpy.asarray(seconds, dtype=numpy.float64))
+		if len(seconds) == 0:
+			return
+		totals = self.phases.setdefault(phase, [0, 0.0, 0.0])
+		totals[0] += len(seconds)
+		totals[1] += float(seconds.sum())
+		totals[2] = max(totals[2], float(seconds.max()))
+
+	def merge(self, phases):
+		"""Function to add the phases of another Overhead, e.g. from a worker process."""
+		for phase in phases:
+			(count, total, longest) = phases[phase]
+			totals = self.phases.setdefault(phase, [0, 0.0, 0.0])
+			totals[0] += count
+			totals[1] += total
+			totals[2] = max(totals[2], longest)
+
+	def profile(self):
+		"""Function to return {phase: {'count': int, 'avg': float, 'max': float}} with the times in ms."""
+		profile = {}
+		for phase in self.phases:
+			(count, total, longest) = self.phases[phase]
+			profile[phase] = {'count': count, 'avg': total / count * 1000.0, 'max': longest * 1000.0}
+		return profile
+
+
+def measure_overhead(ping_count, ping_interval, target_list, engine='ping', batch_interval=BATCH_INTERVAL,
+		ping_binary=PING_BINARY, max_workers=MAX_WORKERS, max_pps=None, flood=False):
+	"""Function to measure pingexp's own overhead by running the experiment against loopback: one
+	target for each of target_list, with the same TOS and size, interval, engine and concurrency.
+
+	Returns the overhead profile: {phase: {'count': int, 'avg': float, 'max': float}, ...} (see Overhead)
+	plus 'rtt', the {'avg', 'p99', 'max'} of the round trip times to loopback, and 'loaded' which is True
+	if they show the host is too busy to trust (see CALIBRATION_LOADED). The times are in ms.
+	"""
+	count = ping_count
+	if ping_interval > 0:
+		count = min(count, max(int(CALIBRATION_TIME / ping_interval), CALIBRATION_COUNT))
+	if flood or ping_interval <= 0:
+		count = min(count, CALIBRATION_FLOOD_COUNT)
+	loopback = [('calibration-%i' %(num), '127.0.0.1', target[2], target[3]) for num, target in enumerate(target_list)]
+
+	overhead = Overhead()
+	results = experiment(count, ping_interval, loopback, engine=engine, batch_interval=batch_interval,
+				ping_binary=ping_binary, max_workers=max_workers, max_pps=max_pps, flood=flood, overhead=overhead)
+	experiments = results['experiments'].values()
+
+	# ping's own drift from its schedule, where the send times are known.
+	stats = [experiment_stats(e) for e in experiments]
+	stats = [s for s in stats if 'send_drift_max' in s]
+	profile = overhead.profile()
+	if stats and not flood:
+		profile['send'] = {'count': sum([e['summary']['transmitted'] for e in experiments]),
+				'avg': float(numpy.mean([s['send_drift_avg'] for s in stats])),
+				'max': max([s['send_drift_max'] for s in stats])}
+
+	rtt = numpy.concatenate([as_samples(e['responses']).columns()[2] for e in experiments])
+	profile['rtt'] = {'avg': 0.0, 'p99': 0.0, 'max': 0.0}
+	if len(rtt):
+		profile['rtt'] = {'avg': float(rtt.mean()), 'p99': float(numpy.percentile(rtt, 99)), 'max': float(rtt.max())}
+	profile['loaded'] = profile['rtt']['p99'] > CALIBRATION_LOADED
+	profile['targets'] = len(target_list)
+	profile['count'] = count
+	return profile
+
+
+def report_overhead(profile):
+	"""Function to print the overhead profile returned by measure_overhead()."""
+	print "Overhead with %i targets: loopback round trip %.3f ms mean, %.3f ms 99th percentile, %.3f ms max" \
+		%(profile['targets'], profile['rtt']['avg'], profile['rtt']['p99'], profile['rtt']['max'])
+	for phase in OVERHEAD_PHASES:
+		if phase in profile:
+			print "  %-8s %.3f ms mean, %.3f ms max (%i)" %(phase, profile[phase]['avg'], profile[phase]['max'], profile[phase]['count'])
+	if profile['loaded']:
+		print "Warning: This host is too loaded to measure round trip times to within %g ms." %(CALIBRATION_LOADED)
+
 
+##
+# Results file format.
+#
+# A results file starts with a fixed size header:
+#   magic (8 bytes), version (uint32), padding (4 bytes), index offset (uint64), index length (uint64)
+# followed by the column blocks and then the index. All numbers are little endian. Every column block
+# starts on an 8 byte boundary. The index is a JSON document:
+#   {'start-time': float, 'end-time': float, 'ping_count': int, 'ping_interval': float, ...,
+#    'experiments': {experiment_id: {'host': str, 'qos': str, 'summary': {...}, ...,
+#                                    'columns': {name: {'offset': int, 'count': int, 'dtype': str}, ...}}}}
+# The columns of each experiment are 'seq', 'ttl', 'rtt' (the responses sorted by seq), 'received'
+# (the bitmap of received sequence numbers) and 'loss_runs' (the [first lost seq, number lost] rows
+# returned by find_loss_runs(), flattened). Version 1 files have a 'losses' column with every lost
+# sequence number instead of 'loss_runs'. Files written since sketches were added also have a 'sketch'
+# column with the bucket counts of the pingstats.Histogram of the round trip times; the rest of it is
+# the 'sketch' dict in the experiment's index entry. Experiments whose responses had the times the
+# pings were sent have a 'sent' column, in the same order as 'seq', of those times.
+#
+# Keeping the index at the end means blocks can be added to an existing file by writing them over the
+# old index, writing a new index after them and then updating the header.
+##
+RESULTS_MAGIC = 'PINGEXP\0'
+RESULTS_VERSION = 2
+RESULTS_HEADER = struct.Struct('<8sI4xQQ')
+RESULTS_COLUMNS = {'seq': '<u4', 'ttl': 'u1', 'rtt': '<f8', 'received': 'u1', 'loss_runs': '<u4', 'sketch': '<i8',
+			'sent': '<f8'}
+# The derived data of a results file (see ResultsFile.save_derived()) is kept in the file with this
+# added to its name, which is laid out like a results file but starts with DERIVED_MAGIC.
+DERIVED_SUFFIX = '.derived'
+DERIVED_MAGIC = 'PINGDRV\0'
+# The type of the blocks of derived data.
+DERIVED_DTYPE = '<f8'
+# How many sets of each kind of derived data, e.g. histogram bins for different bin sizes, are kept for
+# each experiment.
+DERIVED_KEEP = 4
+
+def experiment_columns(experiment):
+	"""Function to return the columns of an experiment's results as a dict of NumPy arrays."""
+	samples = as_samples(experiment['responses'])
+	(seq, ttl, rtt) = samples.columns()
+	columns = {'seq': seq, 'ttl': ttl, 'rtt': rtt,
+		'received': numpy.frombuffer(samples.received, dtype=numpy.uint8),
+		'loss_runs': numpy.asarray(experiment_loss_runs(experiment), dtype=numpy.uint32).ravel(),
+		'sketch': experiment_sketch(experiment).state()[1]}
+	sent = samples.sent_times()
+	if len(sent):
+		columns['sent'] = sent
+	return columns
+
+
+def write_blocks(f, columns, dtype=None):
+	"""Function to write each of the NumPy arrays in columns at the current position of f, as dtype or
+	else the column's type in RESULTS_COLUMNS. Returns the index entries of the blocks."""
+	index = {}
+	for name in sorted(columns):
+		column_dtype = dtype or RESULTS_COLUMNS[name]
+		# Pad to keep each block aligned.
+		f.write('\0' * (-f.tell() % 8))
+		index[name] = {'offset': f.tell(), 'count': len(columns[name]), 'dtype': column_dtype}
+		f.write(numpy.asarray(columns[name]).astype(column_dtype).tostring())
+	return index
+
+
+def write_index(f, index, magic=RESULTS_MAGIC):
+	"""Function to write index at the current position of f and point the header at it."""
+	f.write('\0' * (-f.tell() % 8))
+	offset = f.tell()
+	data = json.dumps(index)
+	f.write(data)
+	f.truncate()
+	f.seek(0)
+	f.write(RESULTS_HEADER.pack(magic, RESULTS_VERSION, offset, len(data)))
+
+
+def write_results(results, filename):
+	"""Function to write results to filename in the results file format."""
+	index = {}
+	for key in results:
+		if key != 'experiments':
+			index[key] = results[key]
+	index['experiments'] = {}
+
+	f = open(filename, 'wb')
+	f.write(RESULTS_HEADER.pack(RESULTS_MAGIC, RESULTS_VERSION, 0, 0))
+	for name in sorted(results['experiments']):
+		experiment = results['experiments'][name]
+		entry = {}
+		for key in experiment:
+			if key not in ('responses', 'losses', 'loss_runs', 'sketch', 'derived', 'digest'):
+				entry[key] = experiment[key]
+		entry['columns'] = write_blocks(f, experiment_columns(experiment))
+		entry['sketch'] = experiment_sketch(experiment).state()[0]
+		entry['digest'] = experiment_digest(experiment)
+		index['experiments'][name] = entry
+	write_index(f, index)
+	f.close()
+
+
+class ResultsFile(object):
+	"""Class to read a results file. The file is memory mapped and the columns are NumPy arrays over the
+	map so only the parts of the file which are used get read. The file is never written; the derived
+	data is kept in FILE.derived (see save_derived())."""
+	def __init__(self, filename, magic=RESULTS_MAGIC):
+		self.filename = filename
+		self.derived_file = None
+		self.file = open(filename, 'rb')
+		if os.fstat(self.file.fileno()).st_size < RESULTS_HEADER.size:
+			self.file.close()
+			raise ValueError('%s is not a results file' %(filename))
+		self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+		(file_magic, version, offset, length) = RESULTS_HEADER.unpack_from(self.map)
+		if file_magic != magic:
+			self.close()
+			raise ValueError('%s is not a results file' %(filename))
+		if version > RESULTS_VERSION:
+			raise ValueError('%s is version %i, only version %i and older are supported' %(filename, version, RESULTS_VERSION))
+		if offset + length > len(self.map):
+			raise ValueError('%s is truncated' %(filename))
+		self.version = version
+		self.index = json.loads(self.map[offset:offset + length])
+
+	def close(self):
+		self.map.close()
+		self.file.close()
+		if self.derived_file:
+			self.derived_file.close()
+
+	def derived_data(self):
+		"""Function to return the ResultsFile of the derived data kept for this file, or None if there
+		isn't any which can be read."""
+		if self.derived_file == None:
+			try:
+				self.derived_file = ResultsFile(self.filename + DERIVED_SUFFIX, magic=DERIVED_MAGIC)
+			except (IOError, ValueError):
+				self.derived_file = False
+		return self.derived_file or None
+
+	def experiment_ids(self):
+		return self.index['experiments'].keys()
+
+	def column(self, experiment_id, name):
+		"""Function to return one column of an experiment as a read-only NumPy array."""
+		return self.block(self.index['experiments'][experiment_id]['columns'][name])
+
+	def block(self, block):
+		return numpy.frombuffer(self.map, dtype=block['dtype'], count=block['count'], offset=block['offset'])
+
+	def experiment(self, experiment_id, first=None, last=None):
+		"""Function to load one experiment. If first and/or last are passed only the responses and loss
+		runs with sequence numbers in first..last are included."""
+		entry = self.index['experiments'][experiment_id]
+		result = {}
+		for key in entry:
+			if key not in ('columns', 'derived'):
+				result[key] = entry[key]
+		result['derived'] = {}
+		derived_file = self.derived_data()
+		if derived_file and experiment_id in derived_file.index['experiments']:
+			for (key, data) in derived_file.index['experiments'][experiment_id]['derived'].items():
+				result['derived'][key] = (data['digest'], dict([(name, derived_file.block(block))
+										for (name, block) in data['columns'].items()]))
+
+		seq = self.column(experiment_id, 'seq')
+		ttl = self.column(experiment_id, 'ttl')
+		rtt = self.column(experiment_id, 'rtt')
+		sent = ()
+		if 'sent' in entry['columns']:
+			sent = self.column(experiment_id, 'sent')
+		if 'loss_runs' in entry['columns']:
+			loss_runs = self.column(experiment_id, 'loss_runs').reshape(-1, 2)
+		else:
+			loss_runs = collapse_runs(self.column(experiment_id, 'losses'))
+
+		# seq is sorted so the range can be found without reading the whole column.
+		if first != None or last != None:
+			if first == None:
+				first = 0
+			if last == None:
+				last = 0xffffffff
+			(start, end) = seq.searchsorted([first, last + 1])
+			(seq, ttl, rtt, sent) = (seq[start:end], ttl[start:end], rtt[start:end], sent[start:end])
+
+			# Keep the parts of the runs which are in the range.
+			starts = loss_runs[:, 0].astype(numpy.int64)
+			ends = starts + loss_runs[:, 1] - 1
+			keep = (ends >= first) & (starts <= last)
+			starts = numpy.maximum(starts[keep], first)
+			ends = numpy.minimum(ends[keep], last)
+			loss_runs = numpy.column_stack((starts, ends - starts + 1)).astype(numpy.uint32)
+
+		result['responses'] = Samples.from_columns(seq, ttl, rtt, self.column(experiment_id, 'received'), sent=sent)
+		result['loss_runs'] = loss_runs
+
+		# The sketch, digest and derived data are of all of the responses.
+		if 'sketch' in entry['columns'] and first == None and last == None:
+			result['sketch'] = pingstats.Histogram.from_state(entry['sketch'], self.column(experiment_id, 'sketch'))
+		else:
+			result.pop('sketch', None)
+		if first != None or last != None:
+			result.pop('digest', None)
+			result.pop('derived')
+		return result
+
+	def save_derived(self, experiments):
+		"""Function to keep the derived data (see derived()) of experiments, a dict of experiments loaded in
+		full from this file, in FILE.derived. Entries of samples with another digest are dropped, as are
+		the oldest of each kind beyond DERIVED_KEEP. FILE.derived is written again in full and renamed over
+		the old one, so a reader always sees a whole file, and FILE itself is left alone. If it can't be
+		written the data just isn't kept."""
+		derived_file = self.derived_data()
+		kept = {}
+		if derived_file:
+			kept = derived_file.index['experiments']
+		index = {'experiments': dict(kept)}
+		new = {} # (experiment ID, key) -> arrays which aren't in FILE.derived yet
+		changed = False
+		for (experiment_id, experiment) in experiments.items():
+			entry = kept.get(experiment_id, {})
+			digest = experiment_digest(experiment)
+			saved = dict([(key, data) for (key, data) in entry.get('derived', {}).items() if data['digest'] == digest])
+			added = [(key, arrays) for (key, (data_digest, arrays)) in experiment.get('derived', {}).items()
+				if data_digest == digest and key not in saved]
+			if not added and len(saved) == len(entry.get('derived', {})):
+				continue
+			for (key, arrays) in added:
+				saved[key] = {'digest': digest, 'saved': time.time()}
+				new[(experiment_id, key)] = arrays
+
+			# Keep the newest of each kind, e.g. the histogram bins for the last few bin sizes.
+			kinds = {}
+			for key in saved:
+				kinds.setdefault(json.loads(key)[0], []).append(key)
+			for keys in kinds.values():
+				keys.sort(key=lambda key: saved[key].get('saved', 0), reverse=True)
+				for key in keys[DERIVED_KEEP:]:
+					del saved[key]
+					new.pop((experiment_id, key), None)
+
+			index['experiments'][experiment_id] = {'derived': saved}
+			changed = True
+		if not changed:
+			return
+
+		filename = self.filename + DERIVED_SUFFIX
+		try:
+			f = open(filename + '.tmp', 'wb')
+			f.write(RESULTS_HEADER.pack(DERIVED_MAGIC, RESULTS_VERSION, 0, 0))
+			for experiment_id in sorted(index['experiments']):
+				entry = {'derived': {}}
+				for (key, data) in index['experiments'][experiment_id]['derived'].items():
+					arrays = new.get((experiment_id, key))
+					if arrays == None:
+						arrays = dict([(name, derived_file.block(block)) for (name, block) in data['columns'].items()])
+					entry['derived'][key] = dict(data, columns=write_blocks(f, arrays, dtype=DERIVED_DTYPE))
+				index['experiments'][experiment_id] = entry
+			write_index(f, index, magic=DERIVED_MAGIC)
+			f.close()
+			os.rename(filename + '.tmp', filename)
+		except (IOError, OSError):
+			if os.path.exists(filename + '.tmp'):
+				os.unlink(filename + '.tmp')
+			return
+
+		# Read the new file next time. The arrays which are already loaded stay over the old map.
+		if derived_file:
+			derived_file.file.close()
+		self.derived_file = None
+
+	def results(self):
+		"""Function to return the results dict. The experiments are only loaded when they are used."""
+		results = {}
+		for key in self.index:
+			if key != 'experiments':
+				results[key] = self.index[key]
+		results['experiments'] = LazyExperiments(self)
+		return results
+
+
+class LazyExperiments(DictMixin):
+	"""Class which looks like the 'experiments' dict of the results but loads each experiment from a
+	ResultsFile the first time it is used."""
+	def __init__(self, results_file):
+		self.results_file = results_file
+		self.loaded = {}
+
+	def __getitem__(self, key):
+		if key not in self.loaded:
+			if key not in self.results_file.index['experiments']:
+				raise KeyError(key)
+			self.loaded[key] = self.results_file.experiment(key)
+		return self.loaded[key]
+
+	def keys(self):
+		return self.results_file.experiment_ids()
+
+
+def save_derived(results):
+	"""Function to keep the derived data (see derived()) of results next to the results file they were
+	read from. Results which weren't read from a results file are left alone."""
+	if isinstance(results['experiments'], LazyExperiments):
+		experiments = results['experiments']
+		experiments.results_file.save_derived(experiments.loaded)
+
+
+def replace_results(results, filename):
+	"""Function to write results to filename without the old contents, e.g. a log, ever being lost."""
+	write_results(results, filename + '.tmp')
+	os.rename(filename + '.tmp', filename)
+
+
+def read_results(filename):
+	"""Function to read the results from filename. Both results files and the pickle files written by
+	older versions are supported."""
+	f = open(filename, 'rb')
+	magic = f.read(len(RESULTS_MAGIC))
+	if magic == RESULTS_MAGIC:
+		f.close()
+		return ResultsFile(filename).results()
+
+	f.seek(0)
+	results = pickle.load(f)
+	f.close()
 	return results
 
 
+def convert_results(pickle_filename, filename):
+	"""Function to convert a pickle file written by an older version to the results file format."""
+	f = open(pickle_filename, 'rb')
+	results = pickle.load(f)
+	f.close()
+
+	write_results(results, filename)
+
+
+def render_file(job):
+	"""Function to write a PNG of the graph of a results file. job is (filename, image_filename,
+	line_graph) so that it can be passed to Pool.imap_unordered().
+	Returns: (filename, error message or None)"""
+	(filename, image_filename, line_graph) = job
+	try:
+		results = read_results(filename)
+		f = open(image_filename, 'wb')
+		graph(results, line_graph=line_graph, image_file=f)
+		f.close()
+	except (IOError, ValueError, KeyError, EOFError, pickle.UnpicklingError), e:
+		# EOFError is an empty or cut off pickle file.
+		return (filename, str(e) or '%s is empty or truncated' %(filename))
+	return (filename, None)
+
+
+def render_files(filenames, line_graph=False, processes=None):
+	"""Function to write FILE.png with the graph of each results file in filenames. The files are
+	rendered in parallel by processes worker processes, one per CPU by default.
+	Returns the number of files which could not be rendered."""
+	if processes == None:
+		processes = cpu_count()
+	processes = max(min(processes, len(filenames)), 1)
+	jobs = [(filename, filename + '.png', line_graph) for filename in filenames]
+
+	pool = None
+	if processes > 1:
+		pool = Pool(processes)
+		rendered = pool.imap_unordered(render_file, jobs)
+	else:
+		rendered = itertools.imap(render_file, jobs)
+
+	failed = 0
+	for (filename, error) in rendered:
+		if error:
+			print "Could not render %(name)s (%(error)s)." %{'name': filename, 'error': error}
+			failed += 1
+		else:
+			print "Rendered %(name)s.png" %{'name': filename}
+
+	if pool:
+		pool.close()
+		pool.join()
+	return failed
+
+
+##
+# Results log format.
+#
+# While an experiment written with -w is running, the file is a log which the samples are appended to as
+# they arrive. Once the experiment is finished the log is replaced by a results file. The log starts with:
+#   magic (8 bytes), version (uint32), header length (uint32), header (JSON)
+# where the header has what is needed to resume the run:
+#   {'ping_count': int, 'ping_interval': float, 'engine': str, 'start-time': float,
+#    'targets': [[experiment_id, host, qos, size], ...], 'ping': str, 'max_workers': int,
+#    'max_pps': float or null, 'flood': bool}
+# It is followed by records which each start with:
+#   type (4 bytes), target index (uint32), count (uint32), CRC-32 of the payload (uint32)
+# 'SMPL' records hold count samples packed as (seq uint32, ttl uint8, rtt float64). 'SMPT' records are the
+# same but each sample is followed by when it was sent (float64), for responses which have that. All
+# but the last record of a target hold LOG_CHUNK_SAMPLES samples. 'DONE' records mark the end of a target and hold
+# count bytes of JSON with the rest of its results (summary, rtt_summary, ...).
+#
+# A record is only used if all of it made it to disk and its CRC matches, so a run which was killed can
+# be resumed from the last complete record.
+##
+LOG_MAGIC = 'PINGLOG\0'
+LOG_VERSION = 1
+LOG_HEADER = struct.Struct('<8sII')
+LOG_RECORD = struct.Struct('<4sIII')
+LOG_SAMPLE = numpy.dtype([('seq', '<u4'), ('ttl', 'u1'), ('rtt', '<f8')])
+LOG_TIMED_SAMPLE = numpy.dtype([('seq', '<u4'), ('ttl', 'u1'), ('rtt', '<f8'), ('sent', '<f8')])
+LOG_CHUNK_SAMPLES = 512
+LOG_FLUSH_INTERVAL = 1.0 # Default seconds between flushes to disk.
+
+class ResultsLog(object):
+	"""Class which appends the samples of a running experiment to a log file.
+
+	samples() and done() only put the data onto a queue. A separate thread packs it into records and
+	writes them, and calls fsync() once every flush_interval seconds rather than after every write,
+	so logging does not hold up the collection of samples.
+	"""
+	def __init__(self, filename, header, flush_interval=LOG_FLUSH_INTERVAL, offset=None):
+		"""Function to create the log. If offset is passed the existing log is opened instead and
+		any data after offset (an incomplete record) is discarded. filename can also be a file object
+		which is already open, e.g. to stream the log over a socket (see pingagent), which is flushed
+		instead of synced."""
+		self.header = header
+		self.flush_interval = flush_interval
+		self.target_index = dict([(target[0], num) for num, target in enumerate(header['targets'])])
+
+		self.stream = not isinstance(filename, basestring)
+		if self.stream:
+			self.file = filename
+			data = json.dumps(header)
+			self.file.write(LOG_HEADER.pack(LOG_MAGIC, LOG_VERSION, len(data)))
+			self.file.write(data)
+		elif offset == None:
+			self.file = open(filename, 'wb')
+			data = json.dumps(header)
+			self.file.write(LOG_HEADER.pack(LOG_MAGIC, LOG_VERSION, len(data)))
+			self.file.write(data)
+		else:
+			self.file = open(filename, 'r+b')
+			self.file.seek(offset)
+			self.file.truncate()
+		self.sync()
+
+		self.queue = ThreadQueue()
+		self.thread = threading.Thread(target=self._run)
+		self.thread.setDaemon(True)
+		self.thread.start()
+
+	def samples(self, name, samples, results=None):
+		"""Function to log a list of (seq, ttl, time) or (seq, ttl, time, sent) samples. Can be passed as
+		experiment()'s callback."""
+		self.queue.put(('samples', name, samples))
+
+	def done(self, name, experiment):
+		"""Function to log that experiment name finished. Can be passed as experiment()'s done_callback."""
+		rest = {}
+		for key in ('host', 'address', 'resolve_time', 'qos', 'size', 'interval', 'flood', 'adaptive', 'intervals',
+				'summary', 'rtt_summary', 'dialect', 'drift'):
+			if key in experiment:
+				rest[key] = experiment[key]
+		self.queue.put(('done', name, rest))
+
+	def close(self):
+		"""Function to write everything which is queued, sync it to disk and close the log."""
+		self.queue.put(None)
+		self.thread.join()
+		self.file.close()
+
+	def sync(self):
+		self.file.flush()
+		if not self.stream:
+			os.fsync(self.file.fileno())
+
+	def _write_record(self, kind, index, count, payload):
+		self.file.write(LOG_RECORD.pack(kind, index, count, zlib.crc32(payload) & 0xffffffff))
+		self.file.write(payload)
+
+	def _write_samples(self, index, samples):
+		if len(samples[0]) == 4:
+			chunk = numpy.array(samples, dtype=LOG_TIMED_SAMPLE)
+			self._write_record('SMPT', index, len(chunk), chunk.tostring())
+		else:
+			chunk = numpy.array(samples, dtype=LOG_SAMPLE)
+			self._write_record('SMPL', index, len(chunk), chunk.tostring())
+
+	def _run(self):
+		"""Function which runs in the writer thread."""
+		pending = {} # target index -> samples which don't fill a chunk yet
+		next_flush = time.time() + self.flush_interval
+		while True:
+			try:
+				item = self.queue.get(timeout=max(next_flush - time.time(), 0))
+			except Empty:
+				item = False
+
+			if item:
+				(kind, name, value) = item
+				index = self.target_index[name]
+				if kind == 'samples':
+					samples = pending.setdefault(index, [])
+					samples.extend(value)
+					while len(samples) >= LOG_CHUNK_SAMPLES:
+						self._write_samples(index, samples[:LOG_CHUNK_SAMPLES])
+						del samples[:LOG_CHUNK_SAMPLES]
+				else:
+					if pending.get(index):
+						self._write_samples(index, pending.pop(index))
+					data = json.dumps(value)
+					self._write_record('DONE', index, len(data), data)
+
+			# Partial chunks are only written when it is time to flush.
+			if item == None or time.time() >= next_flush:
+				for index in pending:
+					if pending[index]:
+						self._write_samples(index, pending[index])
+				pending = {}
+				self.sync()
+				next_flush = time.time() + self.flush_interval
+				if item == None:
+					return
+
+
+def read_log(filename):
+	"""Function to read back a log written by ResultsLog. filename can also be a file object, e.g. a
+	stream from a socket, which is read to the end.
+
+	Returns (header, experiments, offset) where experiments is {experiment_id: experiment_results} for
+	each target with anything in the log and offset is where the last complete record ends.
+	"""
+	if isinstance(filename, basestring):
+		f = open(filename, 'rb')
+	else:
+		f = filename
+	data = f.read(LOG_HEADER.size)
+	if len(data) < LOG_HEADER.size:
+		raise ValueError('%s is not a log of an unfinished experiment' %(filename))
+	(magic, version, length) = LOG_HEADER.unpack(data)
+	if magic != LOG_MAGIC:
+		raise ValueError('%s is not a log of an unfinished experiment' %(filename))
+	header = json.loads(f.read(length))
+	targets = header['targets']
+
+	experiments = {}
+	offset = LOG_HEADER.size + length
+	while True:
+		data = f.read(LOG_RECORD.size)
+		if len(data) < LOG_RECORD.size:
+			break
+		(kind, index, count, crc) = LOG_RECORD.unpack(data)
+		if kind == 'SMPL':
+			length = count * LOG_SAMPLE.itemsize
+		elif kind == 'SMPT':
+			length = count * LOG_TIMED_SAMPLE.itemsize
+		elif kind == 'DONE':
+			length = count
+		else:
+			break
+		payload = f.read(length)
+		if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc or index >= len(targets):
+			break
+
+		name = targets[index][0]
+		experiment = experiments.setdefault(name, {'responses': Samples()})
+		if kind == 'SMPL':
+			chunk = numpy.frombuffer(payload, dtype=LOG_SAMPLE)
+			experiment['responses'].extend(itertools.izip(chunk['seq'].tolist(), chunk['ttl'].tolist(), chunk['rtt'].tolist()))
+		elif kind == 'SMPT':
+			chunk = numpy.frombuffer(payload, dtype=LOG_TIMED_SAMPLE)
+			experiment['responses'].extend(itertools.izip(chunk['seq'].tolist(), chunk['ttl'].tolist(), chunk['rtt'].tolist(),
+									chunk['sent'].tolist()))
+		else:
+			experiment.update(json.loads(payload))
+		offset += LOG_RECORD.size + length
+	f.close()
+
+	return (header, experiments, offset)
+
+
 def usage(prog_name):
 	output = \
 	"""
-Usage: %s [-t TARGET [-w FILE ] | -r FILE ] [-i INTERVAL] [-c COUNT]
-	  [-l] [-o FILE]"
+Usage: %s [-t TARGET | -T FILE [-w FILE ] | -r FILE | --resume FILE] [-i INTERVAL]
+	  [-c COUNT] [-e ENGINE] [--ping COMMAND] [--max-workers N] [--max-pps PPS]
+	  [--flood] [--adaptive INTERVAL [--budget PINGS]] [--flush-interval SECONDS]
+	  [--calibrate] [--live] [-l] [-o FILE]"
+       %s --convert OLD_FILE NEW_FILE
+       %s --render [-l] FILE...
+       %s -t TARGET [-i INTERVAL] [--ping COMMAND] --daemon PORT
+	  [--window SECONDS]
+       %s -t TARGET --from AGENT... [-i INTERVAL] [-c COUNT] [--flood]
+	  [--secret FILE] [-w FILE] [-l] [-o FILE]
+       %s [--ping COMMAND] [--max-workers N] [--max-pps PPS] [--flood]
+	  [--secret FILE] --agent [ADDRESS:]PORT
 -t TARGET: Specify the ping target information. TARGET string is 'ID,FQDN,TOS'
 	   (see below). Cannot be used with -r.
--w FILE: Write the results to FILE. Only valid with -t.
--r FILE: Read results from FILE. Cannot be used with -t.
--i INTERVAL: Time in seconds between pings. Default .2 seconds.
+-T FILE: Read targets from FILE, one per line, like -t TARGET or just a host
+	   (pinged with TOS 0, with the host as its ID). Anything after a # is
+	   ignored. Can be passed with -t and more than once; repeated targets are
+	   only pinged once. The hosts are all looked up at once before the pings
+	   start, and every target of a host pings the same address.
+-w FILE: Write the results to FILE. Only valid with -t. The samples are logged to
+	 FILE as they arrive so an interrupted run can be resumed.
+-r FILE: Read results from FILE. Cannot be used with -t. Files written by older
+	 versions (pickles) can be read too. What the graph is worked out from
+	 (the latency points, loss times and histogram bins) is kept in
+	 FILE.derived, if it can be written, so that the graph is drawn faster
+	 next time. Only the last few sets of each are kept. FILE itself is never
+	 written.
+-i INTERVAL: Time in seconds between pings. Default .2 seconds. Intervals of
+	   less than 1 ms can be used (Linux ping needs root for less than 2 ms).
 -c COUNT: Number of pings to transmit. Default 400.
+-e ENGINE: How to send the pings. 'ping' runs the ping command once per target
+	   (the default). 'native' sends them from this process which scales to
+	   thousands of targets; needs ICMP datagram sockets or root.
+--ping COMMAND: The ping command the 'ping' engine runs. Default ping. Linux
+	   (iputils), busybox and fping output is understood. busybox ping can't
+	   set the TOS so only TOS 0 can be used with it. Linux ping and fping
+	   print when each reply arrived (-D) so the samples are graphed at when
+	   they were actually sent, and how far the pings drifted from the interval
+	   is reported. Otherwise they are taken to be sent every interval.
+--max-workers N: The most ping commands which run at once. Other targets wait
+	   for one to finish. Default %i. Their start times are staggered across
+	   the interval so that they don't all ping at once.
+--max-pps PPS: The most pings a second the running ping commands send between
+	   them. At least one ping command always runs.
+--flood: Send each ping as soon as the reply to the one before arrives, or
+	   after 10 ms if it is lost, but no sooner than -i INTERVAL after it. Every
+	   reply is still recorded. Linux ping is run with -A (which needs root
+	   for intervals of less than 2 ms); busybox ping and fping can't flood, so
+	   --flood is refused with them.
+--adaptive INTERVAL: Ping each target more often, down to every INTERVAL, while
+	   pings to it are lost or its latency varies a lot, and every -i INTERVAL
+	   again once it settles down. The run takes as long as -c COUNT pings every
+	   -i INTERVAL would. Needs -e native. INTERVAL must be -i INTERVAL halved
+	   a whole number of times, e.g. a quarter of it. The intervals each
+	   target was pinged at are saved, and its statistics and loss are
+	   weighted by the time each ping stands for, so the extra pings don't
+	   skew them.
+--budget PINGS: The most pings --adaptive sends to all of the targets between
+	   them. At least -c COUNT per target. Default twice that.
+--calibrate: Before the experiment, ping loopback once for each target with the
+	   same interval, engine and concurrency (for up to 5 seconds, or 1000
+	   pings each with --flood or -i 0) and report how long pingexp's own
+	   scheduling, reading, parsing, passing on and statistics take, and how
+	   slow loopback replies are. The profile is
+	   saved with the results and reported again by -r. A warning is printed
+	   if the host is too loaded to trust the measurements.
 -o FILE: Name of a file to output a PNG of the graph to.
 -l: Plot a line graph instead of a scatter plot.
+--resume FILE: Carry on with the run which was writing to FILE with -w when it
+	   was interrupted. The targets, count, interval and engine of the original
+	   run are used.
+--flush-interval SECONDS: How often the samples logged for -w and --resume are
+	   synced to disk. Default 1 second.
+--live: Graph the last %i seconds of samples while the experiment runs. The
+	   graph of all of the results is shown (or written to -o) at the end.
+--convert: Convert OLD_FILE, written by an older version, to the current results
+	   file format which loads much faster.
+--render: Write FILE.png with the graph of each results FILE. The files are
+	   rendered in parallel, one process per CPU. Like -r, this keeps what
+	   the graph is worked out from in FILE.derived.
+--daemon PORT: Ping the targets until stopped and serve rolling loss and
+	   latency metrics at http://127.0.0.1:PORT/metrics in the Prometheus text
+	   format. Memory use does not grow the longer it runs.
+--window SECONDS: How many seconds of pings the --daemon metrics are from.
+	   Default 300 seconds.
+--from AGENT: Ping the targets from AGENT, 'NAME,HOST[,PORT]', instead of from
+	   here. Can be passed more than once to ping them from several places at
+	   the same time. The agents' clocks are lined up with this one and the
+	   results of every agent are graphed together, as NAME/ID.
+--agent [ADDRESS:]PORT: Wait for --from to connect on PORT and run the
+	   experiments it asks for, sending back the samples as they arrive.
+	   Only listens on 127.0.0.1 unless ADDRESS is passed (0.0.0.0 for every
+	   address), which needs --secret. Experiments of more than 100000 pings
+	   or 1000 targets are refused, as are --flood and intervals under .2
+	   seconds unless the agent was started with --flood. Default port %i.
+--secret FILE: The secret shared by --agent and --from, the first line of FILE.
+	   Coordinators without it are turned away.
 
 TARGET: Experiment identifier,host or IP to ping,TOS field value[,packet size]
 
@@ -408,7 +3103,30 @@ Examples:
 
 3) Compare the latency to Google with two different DSCP values.
 ./ping-exp.py -t Google0,www.google.com,0 -t Google8,www.google.com,8 -i .2 -c 50 -l
-	""" %(prog_name)
+
+4) Convert old results so they can be memory mapped.
+./ping-exp.py --convert results.data results.pexp
+
+5) Finish a long run which was killed part way through.
+./ping-exp.py -t Google,www.google.com,0 -i 1 -c 86400 -w day.pexp
+./ping-exp.py --resume day.pexp
+
+6) Make PNGs of the graphs of a directory of results.
+./ping-exp.py --render results/*.pexp
+
+7) Monitor Google once a second and scrape the metrics with Prometheus.
+./ping-exp.py -t Google,www.google.com,0 -i 1 --daemon 9427
+
+8) Compare the latency to Google from London and Tokyo.
+./ping-exp.py --secret agents.key --agent 0.0.0.0:9428 (on each of london.example.com and tokyo.example.com)
+./ping-exp.py -t Google,www.google.com,0 --secret agents.key --from London,london.example.com --from Tokyo,tokyo.example.com
+
+9) Ping every host listed in hosts.txt.
+./ping-exp.py -T hosts.txt -i 1 -c 60 -w hosts.pexp
+
+10) Ping every second, but up to 16 times a second while the path is lossy or jittery.
+./ping-exp.py -t Google,www.google.com,0 -e native -i 1 -c 600 --adaptive .0625 --budget 1200
+	""" %(prog_name, prog_name, prog_name, prog_name, prog_name, prog_name, MAX_WORKERS, LIVE_WINDOW, AGENT_PORT)
 
 	return output
 
@@ -420,10 +3138,29 @@ if __name__ == '__main__':
 	write_file = False # Write the results to a file?
 	read_file = False # Read results from a file?
 	image_filename=None
+	engine='ping'
+	convert=False
+	render=False
+	resume_file=None
+	flush_interval=LOG_FLUSH_INTERVAL
+	live=False
+	ping_binary=PING_BINARY
+	max_workers=MAX_WORKERS
+	max_pps=None
+	flood=False
+	daemon_port=None
+	window=None
+	adaptive=None
+	budget=None
+	calibrate=False
+	agents=[]
+	agent_host=None
+	agent_port=None
+	secret_file=None
 
 	# Process the command line options.
 	try:
-		opts,args = getopt.getopt(sys.argv[1:], 't:w:r:c:i:o:l')
+		opts,args = getopt.getopt(sys.argv[1:], 't:T:w:r:c:i:e:o:l', ['convert', 'render', 'resume=', 'flush-interval=', 'live', 'ping=', 'max-workers=', 'max-pps=', 'flood', 'daemon=', 'window=', 'from=', 'agent=', 'secret=', 'adaptive=', 'budget=', 'calibrate'])
 	except getopt.GetoptError:
 		print >> sys.stderr, usage(sys.argv[0])
 		print >> sys.stderr, "Error: Unknown argument."
@@ -441,32 +3178,132 @@ if __name__ == '__main__':
 		elif o == '-i':
 			ping_interval = float(a)
 		elif o == '-t':
-			target_info = a.split(',')
-			# Each target has at least three options. The size is optional.
-			if len(target_info) != 3 and len(target_info) != 4:
+			# Each target has at least three options. The size is optional; if it isn't passed ''
+			# is used which causes the default ping packet size to be used.
+			try:
+				targets.append(pingtargets.parse_target(a))
+			except ValueError:
 				print >> sys.stderr, usage(sys.argv[0])
 				print >> sys.stderr, "Error: Invalid target format."
 				raise SystemExit()
-
-			# If size was not passed (it's optional) add the value ''. This causes the default
-			# ping packet size to be used.
-			if len(target_info) == 3:
-				target_info.append('')
-
-			# Append this target to the list of all targets.
-			targets.append(target_info)
-
-			# It would be slightly nicer if these filters weren't run on the entire target
-			# list for every new target but the overhead is negligible.
-			targets = [(t[0].strip(),t[1].strip(),t[2].strip(),t[3].strip())  for t in targets]
-			targets = [(t[0].rstrip(),t[1].rstrip(),t[2].rstrip(),t[3].rstrip())  for t in targets]
+		elif o == '-T':
+			try:
+				targets.extend(pingtargets.read_targets(a))
+			except (IOError, ValueError), e:
+				print >> sys.stderr, "Error: Cannot read the targets: %s." %(e)
+				raise SystemExit()
+		elif o == '-e':
+			if a not in ('ping', 'native'):
+				print >> sys.stderr, usage(sys.argv[0])
+				print >> sys.stderr, "Error: Unknown engine."
+				raise SystemExit()
+			engine = a
 		elif o == '-o':
 			image_filename = a
 		elif o == '-l':
 			line_graph = True
+		elif o == '--convert':
+			convert = True
+		elif o == '--render':
+			render = True
+		elif o == '--resume':
+			resume_file = a
+		elif o == '--flush-interval':
+			flush_interval = float(a)
+		elif o == '--live':
+			live = True
+		elif o == '--flood':
+			flood = True
+		elif o == '--ping':
+			ping_binary = a
+		elif o == '--max-workers':
+			max_workers = int(a)
+		elif o == '--max-pps':
+			max_pps = float(a)
+		elif o == '--daemon':
+			daemon_port = int(a)
+		elif o == '--window':
+			window = float(a)
+		elif o == '--adaptive':
+			adaptive = float(a)
+		elif o == '--budget':
+			budget = int(a)
+		elif o == '--calibrate':
+			calibrate = True
+		elif o == '--from':
+			agent_info = [x.strip() for x in a.split(',')]
+			if len(agent_info) not in (2, 3):
+				print >> sys.stderr, usage(sys.argv[0])
+				print >> sys.stderr, "Error: Invalid agent format."
+				raise SystemExit()
+			if len(agent_info) == 2:
+				agent_info.append(AGENT_PORT)
+			agents.append((agent_info[0], agent_info[1], int(agent_info[2])))
+		elif o == '--agent':
+			if ':' in a:
+				(agent_host, a) = a.rsplit(':', 1)
+			agent_port = int(a)
+		elif o == '--secret':
+			secret_file = a
 		else:
 			assert(False)
 
+	# The same target can be passed more than once, e.g. by -t and in a target file.
+	try:
+		targets = pingtargets.unique_targets(targets)
+	except ValueError, e:
+		print >> sys.stderr, "Error: Invalid targets: %s." %(e)
+		raise SystemExit()
+
+	# Agents and the coordinators which use them share a secret.
+	secret = None
+	if secret_file:
+		try:
+			f = open(secret_file)
+			secret = f.readline().strip()
+			f.close()
+		except IOError, e:
+			print >> sys.stderr, "Error: Cannot read the secret: %s." %(e)
+			raise SystemExit()
+
+	# An agent only runs the experiments it is sent.
+	if agent_port != None:
+		import pingagent
+		if agent_host == None:
+			agent_host = pingagent.AGENT_HOST
+		if not secret and not (agent_host.startswith('127.') or agent_host == 'localhost'):
+			print >> sys.stderr, usage(sys.argv[0])
+			print >> sys.stderr, "Error: --agent needs --secret FILE to listen on %s." %(agent_host or 'every address')
+			raise SystemExit()
+		try:
+			agent = pingagent.Agent(agent_port, host=agent_host, secret=secret, flood=flood, ping_binary=ping_binary,
+						max_workers=max_workers, max_pps=max_pps)
+		except socket.error, e:
+			print >> sys.stderr, "Error: Cannot start the agent: %s." %(e)
+			raise SystemExit()
+		print "Waiting for experiments on %s port %i" %(agent_host or 'every address', agent.port)
+		signal.signal(signal.SIGTERM, lambda signum, frame: agent.stop())
+		agent.run()
+		raise SystemExit()
+
+	# Converting doesn't run or graph an experiment.
+	if convert:
+		if len(args) != 2:
+			print >> sys.stderr, usage(sys.argv[0])
+			print >> sys.stderr, "Error: --convert needs OLD_FILE and NEW_FILE."
+			raise SystemExit()
+		convert_results(args[0], args[1])
+		raise SystemExit()
+
+	# Neither does rendering the graphs of a batch of results files.
+	if render:
+		if len(args) == 0:
+			print >> sys.stderr, usage(sys.argv[0])
+			print >> sys.stderr, "Error: --render needs at least one FILE."
+			raise SystemExit()
+		render_files(args, line_graph=line_graph)
+		raise SystemExit()
+
 	# It doesn't make sense to pass -r and -w at the same time.
 	if write_file and read_file:
 		print >> sys.stderr, usage(sys.argv[0])
@@ -479,25 +3316,184 @@ if __name__ == '__main__':
 		print >> sys.stderr, "Error: -t and -r cannot be used together."
 		raise SystemExit()
 
-	# But one of -r or -t must be used.
-	if not read_file and not (targets != []):
+	# --resume takes everything from the interrupted run.
+	if resume_file and (read_file or write_file or (targets != [])):
+		print >> sys.stderr, usage(sys.argv[0])
+		print >> sys.stderr, "Error: --resume cannot be used with -t, -r or -w."
+		raise SystemExit()
+
+	# The daemon runs until it is stopped so there are no results to save, graph or resume.
+	if daemon_port != None and (read_file or write_file or resume_file or live or image_filename or engine != 'ping' or flood):
+		print >> sys.stderr, usage(sys.argv[0])
+		print >> sys.stderr, "Error: --daemon cannot be used with -r, -w, -o, -e native, --resume, --live or --flood."
+		raise SystemExit()
+
+	# The agents do the pinging, and only log the samples to send them back.
+	if agents and (read_file or resume_file or live or engine != 'ping' or daemon_port != None):
+		print >> sys.stderr, usage(sys.argv[0])
+		print >> sys.stderr, "Error: --from cannot be used with -r, -e native, --resume, --live or --daemon."
+		raise SystemExit()
+
+	if ping_interval < 0:
+		print >> sys.stderr, usage(sys.argv[0])
+		print >> sys.stderr, "Error: -i INTERVAL cannot be negative."
+		raise SystemExit()
+
+	# Only the native engine can change how often it pings a target as it goes.
+	if adaptive != None and (engine != 'native' or flood or resume_file or agents or daemon_port != None):
 		print >> sys.stderr, usage(sys.argv[0])
-		print >> sys.stderr, "Error: Must pass one of -t or -r."
+		print >> sys.stderr, "Error: --adaptive needs -e native and cannot be used with --flood, --resume, --from or --daemon."
 		raise SystemExit()
 
+	if adaptive != None and halvings(ping_interval, adaptive) == None:
+		print >> sys.stderr, usage(sys.argv[0])
+		print >> sys.stderr, "Error: --adaptive INTERVAL must be -i INTERVAL halved a whole number of times, e.g. %g or %g." \
+			%(ping_interval / 2, ping_interval / 4)
+		raise SystemExit()
+
+	# Calibrating runs the experiment's targets against loopback first.
+	if calibrate and (read_file or resume_file or agents or daemon_port != None):
+		print >> sys.stderr, usage(sys.argv[0])
+		print >> sys.stderr, "Error: --calibrate cannot be used with -r, --resume, --from or --daemon."
+		raise SystemExit()
+
+	if budget != None and adaptive == None:
+		print >> sys.stderr, usage(sys.argv[0])
+		print >> sys.stderr, "Error: --budget can only be used with --adaptive."
+		raise SystemExit()
+
+	# Only ask the ping command for what it can do. Agents check with their own.
+	if engine == 'ping' and not agents and targets:
+		try:
+			check_ping(ping_binary, targets, flood)
+		except ValueError, e:
+			print >> sys.stderr, usage(sys.argv[0])
+			print >> sys.stderr, "Error: %s." %(e)
+			raise SystemExit()
+
+	if adaptive != None:
+		if budget == None:
+			budget = ADAPTIVE_BUDGET * ping_count * len(targets)
+		if budget < ping_count * len(targets):
+			print >> sys.stderr, usage(sys.argv[0])
+			print >> sys.stderr, "Error: --budget must be at least -c COUNT pings for each target (%i)." %(ping_count * len(targets))
+			raise SystemExit()
+
+	# There is nothing to watch when reading results.
+	if read_file and live:
+		print >> sys.stderr, usage(sys.argv[0])
+		print >> sys.stderr, "Error: --live cannot be used with -r."
+		raise SystemExit()
+
+	# But one of -r, -t or --resume must be used.
+	if not read_file and not resume_file and not (targets != []):
+		print >> sys.stderr, usage(sys.argv[0])
+		print >> sys.stderr, "Error: Must pass one of -t, -T, -r or --resume."
+		raise SystemExit()
+
+	if daemon_port != None:
+		import pingdaemon
+		if window == None:
+			window = pingdaemon.DAEMON_WINDOW
+		try:
+			daemon = pingdaemon.Daemon(targets, ping_interval, window=window, port=daemon_port, ping_binary=ping_binary,
+							max_workers=max_workers, max_pps=max_pps)
+		except (ValueError, socket.error), e:
+			print >> sys.stderr, "Error: Cannot start the daemon: %s." %(e)
+			raise SystemExit()
+		print "Serving metrics on http://127.0.0.1:%i/metrics" %(daemon_port)
+		# Stop cleanly when asked to by a service manager.
+		signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+		daemon.run()
+		raise SystemExit()
+
+	# Graph the samples as they arrive with --live. The workers send them more often so it is smooth.
+	live_graph = None
+	batch_interval = BATCH_INTERVAL
+	if live:
+		batch_interval = LIVE_BATCH_INTERVAL
+
+	# Measure how much the tool itself adds under the same load before the experiment.
+	calibration = None
+	if calibrate:
+		calibration = measure_overhead(ping_count, ping_interval, targets, engine=engine, batch_interval=batch_interval,
+						ping_binary=ping_binary, max_workers=max_workers, max_pps=max_pps, flood=flood)
+		report_overhead(calibration)
+
 	# Either get the results from a file or do the experiment.
 	if read_file:
-		f = open(file, 'r')
-		results = pickle.load(f)
-		f.close()
-	else:
-		results = experiment(ping_count, ping_interval, targets)
+		results = read_results(file)
+		if 'calibration' in results:
+			report_overhead(results['calibration'])
+	elif agents:
+		import pingagent
+		try:
+			results = pingagent.run(agents, ping_count, ping_interval, targets, flood=flood, secret=secret)
+		except (socket.error, ValueError), e:
+			print >> sys.stderr, "Error: Cannot reach the agents: %s." %(e)
+			raise SystemExit()
+		if write_file:
+			write_results(results, file)
+	elif resume_file:
+		try:
+			(header, resumed, offset) = read_log(resume_file)
+		except ValueError, e:
+			print >> sys.stderr, "Error: Cannot resume: %s." %(e)
+			raise SystemExit()
+		if header.get('adaptive') != None:
+			print >> sys.stderr, "Error: Cannot resume: runs with --adaptive can't be resumed."
+			raise SystemExit()
 
-	# Save the results if -w was passed (this is mutally exclusive of -r).
-	if write_file:
-		f = open(file, 'w')
-		pickle.dump(results, f)
-		f.close()
+		if live:
+			live_graph = LiveGraph([t[0] for t in header['targets']], header['ping_interval'], line_graph=line_graph,
+						start=header['start-time'])
+			for name in resumed:
+				live_graph.add(name, list(resumed[name]['responses']))
+
+		log = ResultsLog(resume_file, header, flush_interval=flush_interval, offset=offset)
+		results = experiment(header['ping_count'], header['ping_interval'], header['targets'], engine=header['engine'],
+					callback=combine_callbacks([log.samples, live_graph and live_graph.add]), done_callback=log.done,
+					resumed=resumed, batch_interval=batch_interval, ping_binary=header.get('ping', PING_BINARY),
+					max_workers=header.get('max_workers', MAX_WORKERS), max_pps=header.get('max_pps'),
+					flood=header.get('flood', False))
+		log.close()
+		results['start-time'] = header['start-time']
+		if header.get('calibration') != None:
+			results['calibration'] = header['calibration']
+
+		# The log is only replaced once the results are safely written.
+		replace_results(results, resume_file)
+	elif write_file:
+		# Log the samples as they arrive (this is mutally exclusive of -r).
+		header = {'ping_count': ping_count, 'ping_interval': ping_interval, 'engine': engine,
+				'start-time': time.time(), 'targets': targets, 'ping': ping_binary,
+				'max_workers': max_workers, 'max_pps': max_pps, 'flood': flood, 'adaptive': adaptive, 'budget': budget,
+				'calibration': calibration}
+		if live:
+			live_graph = LiveGraph([t[0] for t in targets], ping_interval, line_graph=line_graph, start=header['start-time'])
+		log = ResultsLog(file, header, flush_interval=flush_interval)
+		results = experiment(ping_count, ping_interval, targets, engine=engine,
+					callback=combine_callbacks([log.samples, live_graph and live_graph.add]), done_callback=log.done,
+					batch_interval=batch_interval, ping_binary=ping_binary, max_workers=max_workers, max_pps=max_pps,
+					flood=flood, adaptive=adaptive, budget=budget)
+		log.close()
+		if calibration != None:
+			results['calibration'] = calibration
+
+		# The log is only replaced once the results are safely written.
+		replace_results(results, file)
+	else:
+		if live:
+			live_graph = LiveGraph([t[0] for t in targets], ping_interval, line_graph=line_graph)
+		results = experiment(ping_count, ping_interval, targets, engine=engine,
+					callback=live_graph and live_graph.add, batch_interval=batch_interval, ping_binary=ping_binary,
+					max_workers=max_workers, max_pps=max_pps, flood=flood, adaptive=adaptive, budget=budget)
+		if calibration != None:
+			results['calibration'] = calibration
+
+	# The live graph makes way for the graph of all of the results.
+	if live_graph:
+		live_graph.close()
 
 	# Graph the results.
 	if image_filename:
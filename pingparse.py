@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# Parsers for the output of the ping commands pingexp runs.
+# License: Affero GPLv3
+#
+# A Parser turns what ping prints into a list of events (kind, value) where kind is one of:
+#   'dialect'     - value is the name of the dialect the output was recognised as.
+#   'responses'   - value is a list of (seq, ttl, time) tuples in the order they were printed.
+#                   Sequence numbers start at 1 whatever the ping command starts at. If ping prints
+#                   when each reply arrived (-D) the tuples are (seq, ttl, time, sent) where sent is
+#                   when the ping was sent in seconds since the epoch.
+#   'truncated'   - a reply was truncated so it has no time. value is None.
+#   'summary'     - value is {'transmitted': int, 'received': int, 'packet_loss': int, 'time': float}.
+#                   time (in ms) is left out if ping doesn't print it.
+#   'rtt_summary' - value is {'min': float, 'avg': float, 'max': float, 'mdev': float}.
+
+import os
+import re
+
+import numpy
+
+# The summary lines of iputils, busybox and BSD ping, e.g.:
+#   5 packets transmitted, 4 received, +1 duplicates, 20% packet loss, time 4001ms
+#   5 packets transmitted, 4 packets received, 1 duplicates, 20% packet loss
+#   rtt min/avg/max/mdev = 0.031/0.044/0.058/0.009 ms
+#   round-trip min/avg/max = 0.031/0.044/0.058 ms
+SUMMARY_RE = re.compile('(?P<transmitted>\d+) packets transmitted, (?P<received>\d+) (packets |)received, '
+			'(\+?(?P<duplicates>\d+) duplicates, |)(\+(?P<errors>\d+) errors, |)'
+			'(?P<packet_loss>\d+(\.\d+|))% packet loss(, time (?P<time>\d+(\.\d+|))ms|)')
+RTT_SUMMARY_RE = re.compile('(rtt|round-trip) min/avg/max(/mdev|/stddev|) = (?P<min>\d+(\.\d+|))/(?P<avg>\d+(\.\d+|))/'
+			'(?P<max>\d+(\.\d+|))(/(?P<mdev>\d+(\.\d+|))|) ms')
+
+def format_interval(interval):
+	"""Function to format an interval in seconds for ping's -i, to the ms unless it is shorter than 1 ms."""
+	if 0 < interval < 0.001:
+		return '%.6f' %(interval)
+	return '%.3f' %(interval)
+
+
+class Dialect(object):
+	"""Class which parses the output of one ping command. Subclasses fill in the details.
+
+	Reply lines such as '64 bytes from 127.0.0.1: icmp_seq=1 ttl=64 time=0.045 ms' are split on
+	seq_mark and spaces. reply_re is only tried if that doesn't work, e.g. for the lines of older
+	versions. Once a reply has been seen the text before the sequence number is known. From then on
+	text in which every line is a reply with that text is parsed as a whole (see parse_fast()), which
+	is much quicker than a line at a time.
+
+	Lines may start with the time they were printed, e.g. '[1700000000.123456] 64 bytes from ...', as
+	ping -D does. That is when the reply arrived so the time it was sent is that less the round trip
+	time.
+	"""
+	name = None
+	seq_mark = None # The text just before the sequence number of a reply.
+	seq_base = 1 # The first sequence number ping uses.
+	reply_re = None # Has the groups seq, ttl and time.
+	tos = True # Whether ping can set the TOS.
+	floods = False # Whether ping can send each ping once the reply to the last arrives.
+
+	def __init__(self):
+		self.prefix = None # The text before the sequence number of every reply line.
+		self.stamped = False # Whether the reply lines start with the time they arrived.
+
+	@classmethod
+	def detect(cls, line):
+		"""Function to return True if line, from the start of the output, shows it is this dialect."""
+		return False
+
+	@classmethod
+	def arguments(cls, binary, host, qos=0, interval=1, count=5, size='', flood=False):
+		"""Function to return the arguments to run binary with. If count is None binary pings until it
+		is killed. If flood is True, and binary can, each ping is sent as soon as the reply to the one
+		before arrives, with interval as the shortest time between them."""
+		raise NotImplementedError
+
+	@classmethod
+	def check(cls, qos=0, flood=False):
+		"""Function to raise ValueError if binary can't ping with qos or flood, so that results aren't
+		labelled with a TOS they weren't sent with or as a flood they weren't."""
+		if int(qos) != 0 and not cls.tos:
+			raise ValueError('%s can not set the TOS (%s), only TOS 0 can be used with it' %(cls.name, qos))
+		if flood and not cls.floods:
+			raise ValueError('%s can not flood' %(cls.name))
+
+	def parse(self, text):
+		"""Function to parse text, which must be whole lines. Returns a list of events."""
+		events = self.parse_fast(text)
+		if events != None:
+			return events
+
+		events = []
+		responses = []
+		for line in text.splitlines():
+			response = self.parse_reply(line)
+			if response != None:
+				responses.append(response)
+				continue
+
+			others = self.parse_other(line)
+			if others:
+				if responses:
+					events.append(('responses', responses))
+					responses = []
+				events.extend(others)
+		if responses:
+			events.append(('responses', responses))
+		return events
+
+	def parse_fast(self, text):
+		"""Function to parse text in one go if every line of it is a plain reply line with the known
+		prefix. Returns a list of events or None if text has any other lines."""
+		if self.prefix == None:
+			return None
+		pieces = text.split(self.prefix)
+		count = len(pieces) - 1
+		if count == 0 or text.count('\n') != count:
+			return None
+		if self.stamped:
+			# The time of the first line is before the first prefix and the rest are at the ends of
+			# the pieces, before the next prefix.
+			if pieces[0][:1] != '[':
+				return None
+			(columns, delete) = (4, 'tlime=s[]')
+		elif pieces[0]:
+			return None
+		else:
+			(columns, delete) = (3, 'tlime=s')
+
+		# Each piece is now 'SEQ ttl=TTL time=TIME ms\n'. Deleting the letters and '=' leaves just the
+		# numbers for fromstring() to convert. Anything else on a line, e.g. '(DUP!)', stops it early.
+		values = numpy.fromstring(''.join(pieces).translate(None, delete), dtype=numpy.float64, sep=' ')
+		if len(values) != columns * count:
+			return None
+		values = values.reshape(-1, columns)
+		if self.stamped:
+			(arrived, values) = (values[:, 0], values[:, 1:])
+		seq = values[:, 0].astype(numpy.int64) + (1 - self.seq_base)
+		columns = [seq.tolist(), values[:, 1].astype(numpy.int64).tolist(), values[:, 2].tolist()]
+		if self.stamped:
+			columns.append((arrived - values[:, 2] / 1000.0).tolist())
+		return [('responses', zip(*columns))]
+
+	def parse_reply(self, line):
+		"""Function to return the (seq, ttl, time) of a reply line, or (seq, ttl, time, sent) if the line
+		starts with the time it was printed, or None if line isn't a reply."""
+		arrived = None
+		if line[:1] == '[':
+			(stamp, mark, rest) = line[1:].partition('] ')
+			try:
+				arrived = float(stamp)
+				line = rest
+			except ValueError:
+				pass
+
+		known = self.prefix != None
+		response = self.parse_response(line)
+		if response == None or arrived == None:
+			return response
+		if not known and self.prefix != None:
+			self.stamped = True
+		return response + (arrived - response[2] / 1000.0,)
+
+	def parse_response(self, line):
+		"""Function to return the (seq, ttl, time) of a reply line, without the time it was printed, or
+		None if line isn't one."""
+		(head, mark, tail) = line.partition(self.seq_mark)
+		if mark:
+			fields = tail.split(' ', 3)
+			if len(fields) >= 3 and fields[1][:4] == 'ttl=' and fields[2][:5] == 'time=':
+				try:
+					response = (int(fields[0]) + 1 - self.seq_base, int(fields[1][4:]), float(fields[2][5:]))
+				except ValueError:
+					response = None
+				if response != None:
+					if self.prefix == None and fields[3:] == ['ms']:
+						self.prefix = head + mark
+					return response
+
+		m = self.reply_re.search(line)
+		if m != None:
+			return (int(m.group('seq')) + 1 - self.seq_base, int(m.group('ttl')), float(m.group('time')))
+		return None
+
+	def parse_other(self, line):
+		"""Function to return the list of events for a line which isn't a reply."""
+		if '(truncated)' in line:
+			return [('truncated', None)]
+
+		m = SUMMARY_RE.search(line)
+		if m != None:
+			summary = {'transmitted': int(m.group('transmitted')),
+					'received': int(m.group('received')),
+					'packet_loss': int(float(m.group('packet_loss')))}
+			if m.group('time') != None:
+				summary['time'] = float(m.group('time'))
+			return [('summary', summary)]
+
+		m = RTT_SUMMARY_RE.search(line)
+		if m != None:
+			return [('rtt_summary', {'min': float(m.group('min')),
+						'avg': float(m.group('avg')),
+						'max': float(m.group('max')),
+						'mdev': float(m.group('mdev') or 0.0)})]
+		return []
+
+
+class IputilsDialect(Dialect):
+	"""Class which parses the output of Linux's (iputils) ping."""
+	name = 'iputils'
+	seq_mark = ' icmp_seq='
+	reply_re = re.compile('icmp_[rs]eq=(?P<seq>\d+) ttl=(?P<ttl>\d+) time=(?P<time>\d+(\.\d+|)) ms')
+	floods = True
+
+	@classmethod
+	def detect(cls, line):
+		# PING 127.0.0.1 (127.0.0.1) 56(84) bytes of data.
+		return line.startswith('PING ') and line.rstrip().endswith(' bytes of data.')
+
+	@classmethod
+	def arguments(cls, binary, host, qos=0, interval=1, count=5, size='', flood=False):
+		args = [binary]
+		args.append('-i %s'%(format_interval(interval)))
+		args.append('-Q %i'%(int(qos)))
+		if count != None:
+			args.append('-c %i'%(count))
+		if size != '':
+			args.append('-s %i' %(int(size)))
+		if flood:
+			# -f prints a dot per ping instead of the replies. -A sends the same way (once the last
+			# reply is in) but prints them.
+			args.append('-A')
+		# Print when each reply arrived.
+		args.append('-D')
+		args.append(host)
+		return args
+
+
+class BusyboxDialect(Dialect):
+	"""Class which parses the output of busybox's ping. Its sequence numbers start at 0."""
+	name = 'busybox'
+	seq_mark = ' seq='
+	seq_base = 0
+	reply_re = re.compile('(icmp_|)seq=(?P<seq>\d+) ttl=(?P<ttl>\d+) time=(?P<time>\d+(\.\d+|)) ms')
+	tos = False
+
+	@classmethod
+	def detect(cls, line):
+		# PING 127.0.0.1 (127.0.0.1): 56 data bytes
+		return line.startswith('PING ') and line.rstrip().endswith(' data bytes')
+
+	@classmethod
+	def arguments(cls, binary, host, qos=0, interval=1, count=5, size='', flood=False):
+		cls.check(qos, flood)
+		args = [binary]
+		if os.path.basename(binary) == 'busybox':
+			args.append('ping')
+		args.extend(['-i', format_interval(interval)])
+		if count != None:
+			args.extend(['-c', '%i' %(count)])
+		if size != '':
+			args.extend(['-s', '%i' %(int(size))])
+		args.append(host)
+		return args
+
+
+class FpingDialect(Dialect):
+	"""Class which parses the output of fping -c. Its sequence numbers start at 0 and it doesn't print
+	the TTL so it is recorded as 0. The summary, which goes to standard error, has no mdev or time."""
+	name = 'fping'
+	seq_base = 0
+	# 127.0.0.1 : [0], 84 bytes, 0.05 ms (0.05 avg, 0% loss)
+	reply_re = re.compile(' : \[(?P<seq>\d+)\], \d+ bytes, (?P<time>\d+(\.\d+|)) ms')
+	# 127.0.0.1 : xmt/rcv/%loss = 5/5/0%, min/avg/max = 0.03/0.05/0.07
+	summary_re = re.compile(' : xmt/rcv/%loss = (?P<transmitted>\d+)/(?P<received>\d+)/(?P<packet_loss>\d+)%'
+				'(, min/avg/max = (?P<min>\d+(\.\d+|))/(?P<avg>\d+(\.\d+|))/(?P<max>\d+(\.\d+|))|)')
+
+	@classmethod
+	def detect(cls, line):
+		return cls.reply_re.search(line) != None
+
+	@classmethod
+	def arguments(cls, binary, host, qos=0, interval=1, count=5, size='', flood=False):
+		cls.check(qos, flood)
+		# fping's period is in ms. -l is the same as -c but without an end.
+		if count != None:
+			args = [binary, '-c', '%i' %(count)]
+		else:
+			args = [binary, '-l']
+		args.extend(['-p', '%i' %(max(int(interval * 1000), 1)), '-O', '%i' %(int(qos))])
+		if size != '':
+			args.extend(['-b', '%i' %(int(size))])
+		# Print when each reply arrived.
+		args.append('-D')
+		args.append(host)
+		return args
+
+	def parse_fast(self, text):
+		return None
+
+	def parse_response(self, line):
+		(head, mark, tail) = line.partition(' : [')
+		if mark:
+			# The fields are '0]', '84 bytes', '0.05 ms (0.05 avg' and '0% loss)'.
+			fields = tail.split(', ', 3)
+			if len(fields) >= 3 and fields[0][-1:] == ']' and ' ms' in fields[2]:
+				try:
+					return (int(fields[0][:-1]) + 1 - self.seq_base, 0, float(fields[2].split(' ', 1)[0]))
+				except ValueError:
+					pass
+
+		m = self.reply_re.search(line)
+		if m != None:
+			return (int(m.group('seq')) + 1 - self.seq_base, 0, float(m.group('time')))
+		return None
+
+	def parse_other(self, line):
+		m = self.summary_re.search(line)
+		if m == None:
+			return []
+
+		# Both summaries are on one line. The times are left out if nothing came back.
+		events = [('summary', {'transmitted': int(m.group('transmitted')),
+					'received': int(m.group('received')),
+					'packet_loss': int(m.group('packet_loss'))})]
+		if m.group('min') != None:
+			events.append(('rtt_summary', {'min': float(m.group('min')),
+							'avg': float(m.group('avg')),
+							'max': float(m.group('max')),
+							'mdev': 0.0}))
+		return events
+
+
+# The dialects in the order they are tried when picking one from the output.
+DIALECTS = (IputilsDialect, BusyboxDialect, FpingDialect)
+
+def dialect_class(name):
+	"""Function to return the Dialect subclass called name."""
+	for dialect in DIALECTS:
+		if dialect.name == name:
+			return dialect
+	raise ValueError('Unknown ping dialect %s' %(name))
+
+
+def binary_dialect(binary):
+	"""Function to guess the Dialect subclass of the ping command binary from its name, which decides the
+	arguments it is run with. The output is parsed with the dialect it turns out to be."""
+	name = os.path.basename(binary)
+	if name.startswith('fping'):
+		return FpingDialect
+	if name == 'busybox':
+		return BusyboxDialect
+	return IputilsDialect
+
+
+class Parser(object):
+	"""Class which turns the output of a ping command into events (see the top of this file).
+
+	Pass what is read from ping to feed() as it arrives, in any sized pieces, and call close() at the
+	end. Unless a dialect is passed it is picked from the output and reported with a 'dialect' event.
+	Until then lines are parsed as iputils output.
+	"""
+	def __init__(self, dialect=None):
+		self.dialect = None
+		if dialect != None:
+			self.dialect = dialect_class(dialect)()
+		self.default = IputilsDialect()
+		self.partial = '' # The start of a line which hasn't been finished yet.
+
+	def feed(self, data):
+		"""Function to parse the next data output by ping. Returns a list of events."""
+		data = self.partial + data
+		end = data.rfind('\n') + 1
+		self.partial = data[end:]
+		if end == 0:
+			return []
+		return self.parse(data[:end])
+
+	def close(self):
+		"""Function to parse anything left over at the end of the output. Returns a list of events."""
+		events = []
+		if self.partial:
+			events = self.parse(self.partial + '\n')
+			self.partial = ''
+		if self.dialect == None:
+			# Nothing showed which it was so it was parsed as the default.
+			self.dialect = self.default
+			events.append(('dialect', self.dialect.name))
+		return events
+
+	def parse(self, text):
+		"""Function to parse text, which must be whole lines. Returns a list of events."""
+		if self.dialect != None:
+			return self.dialect.parse(text)
+
+		lines = text.splitlines(True)
+		for (num, line) in enumerate(lines):
+			for dialect in DIALECTS:
+				if dialect.detect(line):
+					events = self.default.parse(''.join(lines[:num]))
+					self.dialect = dialect()
+					events.append(('dialect', self.dialect.name))
+					return events + self.dialect.parse(''.join(lines[num:]))
+		return self.default.parse(text)
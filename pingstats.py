@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# Statistics for pingexp.
+# License: Affero GPLv3
+
+import sys
+import math
+import time
+
+import numpy
+
+# The percentiles which are calculated for every experiment.
+PERCENTILES = (50, 95, 99, 99.9)
+
+# RFC 3550 jitter is a running average where each new value has a weight of 1/16.
+JITTER_GAIN = 1 / 16.0
+# Older differences have a weight of at most (15/16)^JITTER_HISTORY which is far below the precision of
+# a float64 so they can be left out.
+JITTER_HISTORY = 1024
+
+# Histograms record round trip times in units of SKETCH_UNIT ms (1 us) to SKETCH_DIGITS significant
+# decimal digits, up to SKETCH_HIGHEST ms. Longer times are recorded as SKETCH_HIGHEST.
+SKETCH_UNIT = 0.001
+SKETCH_DIGITS = 2
+SKETCH_HIGHEST = 3600000.0
+
+def percentile_name(p):
+	"""Function to return the key the percentile p is stored under, e.g. 'p99.9'."""
+	return 'p%s' %(('%f' %(p)).rstrip('0').rstrip('.'))
+
+
+def jitter(rtt):
+	"""Function to calculate the RFC 3550 interarrival jitter of the samples in rtt (in send order).
+
+	The RFC uses the difference in the one way transit time of consecutive packets, D. With only round
+	trip times the difference of consecutive round trip times is used instead. The running estimate
+	J = J + (|D| - J) / 16 started from 0 works out to be the sum of |D(i)| * (1/16) * (15/16)^(n - i)
+	so it can be done with a dot product instead of a loop.
+	"""
+	if len(rtt) < 2:
+		return 0.0
+
+	d = numpy.abs(numpy.diff(rtt[-(JITTER_HISTORY + 1):]))
+	weights = JITTER_GAIN * (1 - JITTER_GAIN) ** numpy.arange(len(d) - 1, -1, -1)
+	return float(numpy.dot(d, weights))
+
+
+def loss_bursts(seq, transmitted):
+	"""Function to return the lengths of the bursts of consecutive lost packets as a NumPy array.
+	seq must be the sorted sequence numbers (1 to transmitted) of the received packets; duplicates are
+	allowed."""
+	seq = numpy.asarray(seq, dtype=numpy.int64)
+	if len(seq) == 0:
+		if transmitted > 0:
+			return numpy.array([transmitted])
+		return numpy.array([], dtype=numpy.int64)
+
+	# A gap between two received sequence numbers, or before the first or after the last, is a burst.
+	edges = numpy.concatenate(([0], seq, [transmitted + 1]))
+	gaps = numpy.diff(edges) - 1
+	return gaps[gaps > 0]
+
+
+def weighted_percentiles(values, weights, percentiles):
+	"""Function to return the percentiles of values where each value counts weights times, as a NumPy
+	array. Like numpy.percentile() they are interpolated between the two nearest values; with equal
+	weights the results are the same."""
+	order = numpy.argsort(values, kind='mergesort')
+	values = values[order]
+	weights = weights[order]
+	# The rank of each value is the middle of its share of the weights, scaled so that the first is at
+	# 0 and the last at 1.
+	cumulative = numpy.cumsum(weights) - weights / 2.0
+	if len(values) == 1 or cumulative[-1] == cumulative[0]:
+		return numpy.repeat(values[0], len(percentiles))
+	ranks = (cumulative - cumulative[0]) / (cumulative[-1] - cumulative[0])
+	return numpy.interp(numpy.asarray(percentiles, dtype=numpy.float64) / 100.0, ranks, values)
+
+
+def compute(seq, rtt, transmitted=None, weights=()):
+	"""Function to calculate the statistics of one experiment.
+
+	seq and rtt are the columns of the responses sorted by sequence number (see Samples.columns()).
+	transmitted is the number of pings which were sent; if it is not passed losses after the last
+	received sequence number are not counted.
+
+	weights is how long (in seconds) each ping, from sequence number 1 to transmitted, stands for when
+	the pings were not sent at a steady rate (see pingexp.IcmpEngine's adaptive targets). The round trip
+	time statistics (but not the jitter, which is between consecutive pings) are then weighted by them,
+	so that where the pings were sent more often doesn't count for more, and 'time_loss' is the
+	percentage of the time which the lost pings stand for.
+
+	Returns: {'count': int, 'min': float, 'max': float, 'avg': float, 'mdev': float,
+	          'p50': float, 'p95': float, 'p99': float, 'p99.9': float, 'jitter': float,
+	          'loss_bursts': int, 'loss_burst_max': int, 'loss_burst_avg': float}
+	plus {'time_loss': float} if weights is passed.
+	"""
+	rtt = numpy.asarray(rtt, dtype=numpy.float64)
+	if transmitted == None:
+		transmitted = 0
+		if len(seq):
+			transmitted = int(seq[-1])
+
+	weights = numpy.asarray(weights, dtype=numpy.float64)
+	if len(weights):
+		index = numpy.clip(numpy.asarray(seq, dtype=numpy.int64) - 1, 0, len(weights) - 1)
+		received_weights = weights[index]
+
+	stats = {'count': len(rtt)}
+	if len(rtt) and len(weights):
+		avg = numpy.average(rtt, weights=received_weights)
+		stats['min'] = float(rtt.min())
+		stats['max'] = float(rtt.max())
+		stats['avg'] = float(avg)
+		stats['mdev'] = float(numpy.sqrt(max(numpy.average(rtt * rtt, weights=received_weights) - avg * avg, 0.0)))
+		for p, value in zip(PERCENTILES, weighted_percentiles(rtt, received_weights, PERCENTILES)):
+			stats[percentile_name(p)] = float(value)
+	elif len(rtt):
+		avg = rtt.mean()
+		stats['min'] = float(rtt.min())
+		stats['max'] = float(rtt.max())
+		stats['avg'] = float(avg)
+		# The same as ping's mdev.
+		stats['mdev'] = float(numpy.sqrt(max(numpy.dot(rtt, rtt) / len(rtt) - avg * avg, 0.0)))
+		for p, value in zip(PERCENTILES, numpy.percentile(rtt, PERCENTILES)):
+			stats[percentile_name(p)] = float(value)
+	else:
+		for key in ('min', 'max', 'avg', 'mdev') + tuple([percentile_name(p) for p in PERCENTILES]):
+			stats[key] = 0.0
+	stats['jitter'] = jitter(rtt)
+
+	bursts = loss_bursts(seq, transmitted)
+	stats['loss_bursts'] = len(bursts)
+	stats['loss_burst_max'] = 0
+	stats['loss_burst_avg'] = 0.0
+	if len(bursts):
+		stats['loss_burst_max'] = int(bursts.max())
+		stats['loss_burst_avg'] = float(bursts.mean())
+
+	if len(weights):
+		lost = numpy.ones(len(weights), dtype=bool)
+		lost[index] = False
+		stats['time_loss'] = 0.0
+		if weights.sum() > 0:
+			stats['time_loss'] = float(weights[lost].sum() * 100.0 / weights.sum())
+
+	return stats
+
+
+def timing(seq, sent, interval=None):
+	"""Function to calculate how well the pings kept to their schedule from when they were actually sent.
+
+	seq is the sorted sequence numbers of the responses and sent when each of their pings was sent, in
+	seconds since the epoch (NaN where it isn't known). interval is the configured seconds between pings.
+
+	Returns: {'send_interval': float, 'send_drift_avg': float, 'send_drift_max': float} in ms, where
+	send_interval is the average time between pings and the drifts are how far behind a schedule of one
+	ping every interval (lined up with the ping which was furthest ahead of it) the pings were sent. The
+	drifts are left out if interval isn't passed. Returns {} if fewer than two send times are known.
+	"""
+	sent = numpy.asarray(sent, dtype=numpy.float64)
+	known = ~numpy.isnan(sent)
+	seq = numpy.asarray(seq, dtype=numpy.float64)[known]
+	sent = sent[known]
+	if len(seq) < 2 or seq[-1] == seq[0]:
+		return {}
+
+	stats = {'send_interval': float((sent[-1] - sent[0]) / (seq[-1] - seq[0]) * 1000.0)}
+	if interval != None:
+		late = sent - seq * interval
+		late -= late.min()
+		stats['send_drift_avg'] = float(late.mean() * 1000.0)
+		stats['send_drift_max'] = float(late.max() * 1000.0)
+	return stats
+
+
+class Histogram(object):
+	"""Class which is a streaming sketch of round trip times: an HDR histogram.
+
+	Times of less than 2 * 10^digits units each have their own bucket. Above that the buckets double in
+	width every time the times double in size, so every bucket is narrower than 10^-digits of the times
+	in it. The number of buckets only depends on digits and highest (about 3300, 26 KB, with the defaults)
+	however many times are added, and histograms with the same digits and highest are merged by
+	adding their counts. The count, min, max, avg and mdev are exact; the percentiles are to within the
+	width of a bucket.
+	"""
+	def __init__(self, digits=SKETCH_DIGITS, highest=SKETCH_HIGHEST):
+		self.digits = digits
+		self.highest = highest
+		self.sub_bits = int(math.ceil(math.log(2 * 10 ** digits, 2)))
+		self.top = int(highest / SKETCH_UNIT) # The largest time in units.
+		self.counts = numpy.zeros(int(self.index([highest])[0]) + 1, dtype=numpy.int64)
+
+		self.count = 0
+		self.min = 0.0
+		self.max = 0.0
+		self.sum = 0.0
+		self.sum2 = 0.0
+
+	def index(self, rtt):
+		"""Function to return the buckets of the times in rtt (ms) as a NumPy array."""
+		units = numpy.clip(numpy.asarray(rtt, dtype=numpy.float64) / SKETCH_UNIT + 0.5, 0, self.top).astype(numpy.int64)
+		# How many bits have to be dropped to leave sub_bits; the exponent from frexp is the bit length.
+		shift = numpy.maximum(numpy.frexp(units)[1] - self.sub_bits, 0)
+		sub = 1 << self.sub_bits
+		half = sub >> 1
+		return numpy.where(shift == 0, units, sub + (shift - 1) * half + (units >> shift) - half)
+
+	def bounds(self):
+		"""Function to return the (lowest, highest) times (ms) of every bucket as NumPy arrays."""
+		sub = 1 << self.sub_bits
+		half = sub >> 1
+		buckets = numpy.arange(len(self.counts), dtype=numpy.int64)
+		shift = numpy.maximum((buckets - sub) // half + 1, 0)
+		lowest = numpy.where(shift == 0, buckets, ((buckets - sub) % half + half) << shift)
+		return (lowest * SKETCH_UNIT, (lowest + (1 << shift)) * SKETCH_UNIT)
+
+	def add(self, rtt, counts=()):
+		"""Function to add the times in rtt (ms). If counts is passed each time is added that many times."""
+		rtt = numpy.asarray(rtt, dtype=numpy.float64)
+		if len(rtt) == 0:
+			return
+		if self.count == 0:
+			(self.min, self.max) = (float(rtt.min()), float(rtt.max()))
+		else:
+			(self.min, self.max) = (min(self.min, float(rtt.min())), max(self.max, float(rtt.max())))
+		if len(counts):
+			counts = numpy.asarray(counts, dtype=numpy.int64)
+			self.counts += numpy.bincount(self.index(rtt), weights=counts, minlength=len(self.counts)).astype(numpy.int64)
+			self.count += int(counts.sum())
+			self.sum += float(numpy.dot(rtt, counts))
+			self.sum2 += float(numpy.dot(rtt * rtt, counts))
+		else:
+			self.counts += numpy.bincount(self.index(rtt), minlength=len(self.counts))
+			self.count += len(rtt)
+			self.sum += float(rtt.sum())
+			self.sum2 += float(numpy.dot(rtt, rtt))
+
+	def merge(self, other):
+		"""Function to add the times of the Histogram other, e.g. from another run or worker."""
+		if (other.digits, other.highest) != (self.digits, self.highest):
+			raise ValueError('can not merge histograms with different precision')
+		if other.count == 0:
+			return
+		self.counts += other.counts
+		if self.count == 0:
+			(self.min, self.max) = (other.min, other.max)
+		else:
+			(self.min, self.max) = (min(self.min, other.min), max(self.max, other.max))
+		self.count += other.count
+		self.sum += other.sum
+		self.sum2 += other.sum2
+
+	def values(self):
+		"""Function to return the (time, count) of the buckets with times in them, as NumPy arrays.
+		The time is the middle of the bucket, but never outside min..max."""
+		(lowest, highest) = self.bounds()
+		used = self.counts > 0
+		return (numpy.clip((lowest[used] + highest[used]) / 2.0, self.min, self.max), self.counts[used])
+
+	def cumulative(self, limits):
+		"""Function to return how many of the times are at most each of limits (ms), to within the width
+		of a bucket, as a NumPy array."""
+		(times, counts) = self.values()
+		cumulative = numpy.concatenate(([0], numpy.cumsum(counts)))
+		return cumulative[times.searchsorted(limits, side='right')]
+
+	def percentiles(self, percentiles):
+		"""Function to return the percentiles of the times as a list. Like numpy.percentile() they are
+		interpolated between the two nearest times."""
+		if self.count == 0:
+			return [0.0] * len(percentiles)
+		(times, counts) = self.values()
+		cumulative = numpy.cumsum(counts)
+		# The lowest and highest times are known exactly.
+		(times[0], times[-1]) = (self.min, self.max)
+
+		position = numpy.asarray(percentiles, dtype=numpy.float64) / 100.0 * (self.count - 1)
+		below = numpy.floor(position)
+		# The buckets of the times with (0 based) ranks below and below + 1.
+		lower = times[cumulative.searchsorted(below + 1)]
+		upper = times[cumulative.searchsorted(numpy.minimum(below + 2, self.count))]
+		return [float(v) for v in lower + (upper - lower) * (position - below)]
+
+	def stats(self):
+		"""Function to return the statistics of the times. The same keys as the round trip time
+		statistics of compute()."""
+		stats = {'count': self.count, 'min': 0.0, 'max': 0.0, 'avg': 0.0, 'mdev': 0.0}
+		if self.count:
+			avg = self.sum / self.count
+			stats.update({'min': self.min, 'max': self.max, 'avg': avg,
+					'mdev': math.sqrt(max(self.sum2 / self.count - avg * avg, 0.0))})
+		for p, value in zip(PERCENTILES, self.percentiles(PERCENTILES)):
+			stats[percentile_name(p)] = value
+		return stats
+
+	def state(self):
+		"""Function to return the histogram as (info, counts) where info is a dict which can be stored
+		as JSON and counts is a NumPy array. The counts after the last used bucket are left out."""
+		used = numpy.flatnonzero(self.counts)
+		end = 0
+		if len(used):
+			end = used[-1] + 1
+		info = {'digits': self.digits, 'highest': self.highest, 'count': self.count, 'min': self.min,
+			'max': self.max, 'sum': self.sum, 'sum2': self.sum2}
+		return (info, self.counts[:end])
+
+	@classmethod
+	def from_state(cls, info, counts):
+		"""Function to create a Histogram from what state() returned."""
+		histogram = cls(digits=info['digits'], highest=info['highest'])
+		histogram.counts[:len(counts)] = counts
+		for key in ('count', 'min', 'max', 'sum', 'sum2'):
+			setattr(histogram, key, info[key])
+		return histogram
+
+
+def benchmark(samples=10000000, loss=0.01):
+	"""Function to time compute() on samples synthetic samples with loss of them lost."""
+	random = numpy.random.RandomState(0)
+	seq = numpy.arange(1, samples + 1, dtype=numpy.uint32)
+	seq = seq[random.random_sample(samples) >= loss]
+	rtt = 20 + random.gamma(2.0, 2.0, len(seq))
+
+	start = time.time()
+	stats = compute(seq, rtt, transmitted=samples)
+	return (time.time() - start, stats)
+
+
+if __name__ == '__main__':
+	samples = 10000000
+	if len(sys.argv) > 1:
+		samples = int(sys.argv[1])
+	(elapsed, stats) = benchmark(samples)
+	print "%i samples in %.3f seconds" %(samples, elapsed)
+	for key in sorted(stats):
+		print "%s: %s" %(key, stats[key])
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# Targets for pingexp: parsing them from the command line and from target files, and looking up the
+# addresses of their hosts. Every host is looked up once, before anything is pinged, with many lookups
+# running at once, so that a slow resolver neither delays the pings nor is counted in their round trip
+# times. The addresses are kept for a while so the daemon and agents don't look the same hosts up again
+# every time they start ping.
+# License: Affero GPLv3
+
+import time
+import socket
+import threading
+
+# How many seconds an address is used for before the host is looked up again. The system resolver
+# doesn't say how long the DNS records are good for so this is a fixed time.
+RESOLVE_TTL = 300.0
+# The most lookups which run at once.
+RESOLVE_THREADS = 32
+
+
+def parse_target(text):
+	"""Function to parse a target, 'ID,FQDN,TOS[,SIZE]', into a tuple of (id, host, qos, size). size is
+	'' if it wasn't passed, which means ping's default. Raises ValueError if text isn't a target."""
+	target = [field.strip() for field in text.split(',')]
+	if len(target) not in (3, 4) or not target[0] or not target[1]:
+		raise ValueError('invalid target %r' %(text))
+	if len(target) == 3:
+		target.append('')
+	return tuple(target)
+
+
+def read_targets(filename):
+	"""Function to read the targets in a target file. Each line is either a target, as passed to -t, or
+	just a host, which is pinged with TOS 0 and uses the host as its ID. Blank lines and anything after
+	a # are ignored. Raises ValueError, naming the line, if one isn't a target."""
+	targets = []
+	f = open(filename)
+	try:
+		for (num, line) in enumerate(f):
+			line = line.split('#', 1)[0].strip()
+			if not line:
+				continue
+			if ',' not in line:
+				line = '%s,%s,0' %(line, line)
+			try:
+				targets.append(parse_target(line))
+			except ValueError, e:
+				raise ValueError('%s line %i: %s' %(filename, num + 1, e))
+	finally:
+		f.close()
+	return targets
+
+
+def unique_targets(targets):
+	"""Function to return targets, in order, without the ones which are repeated. Raises ValueError if
+	the same ID is used for two different targets."""
+	seen = {}
+	unique = []
+	for target in targets:
+		target = tuple(target)
+		if target[0] in seen:
+			if seen[target[0]] != target:
+				raise ValueError('the ID %s is used for two different targets' %(target[0]))
+			continue
+		seen[target[0]] = target
+		unique.append(target)
+	return unique
+
+
+class Resolver(object):
+	"""Class which looks up the addresses of hosts, many at once, and remembers each one for ttl
+	seconds. A host's IPv4 address is used if it has one, else its IPv6 address. Thread safe.
+
+	clock is the function the expiry times are worked out with. It is only passed in tests.
+	"""
+	def __init__(self, ttl=RESOLVE_TTL, threads=RESOLVE_THREADS, clock=time.time):
+		self.ttl = ttl
+		self.threads = threads
+		self.clock = clock
+		self.cache = {} # host -> (address, when it expires)
+		self.lock = threading.Lock()
+
+	def _lookup(self, host):
+		"""Function to look up host. Returns a dict of its 'address' and how long, in ms, the lookup took
+		('time'), or of the 'error' if it failed."""
+		started = time.time()
+		try:
+			found = socket.getaddrinfo(host, None, 0, socket.SOCK_DGRAM)
+		except socket.error, e:
+			return {'error': str(e), 'time': (time.time() - started) * 1000.0}
+		found = [info for info in found if info[0] in (socket.AF_INET, socket.AF_INET6)]
+		if not found:
+			return {'error': 'no IPv4 or IPv6 address', 'time': (time.time() - started) * 1000.0}
+		found.sort(key=lambda info: info[0] != socket.AF_INET)
+		return {'address': found[0][4][0], 'time': (time.time() - started) * 1000.0}
+
+	def resolve(self, hosts):
+		"""Function to look up each of hosts. Returns {host: lookup} where each lookup is a dict of the
+		'address', how long in ms it took to find ('time', 0 if it was cached) and whether it was
+		'cached', or of the 'error' and 'time' if the host wasn't found. Failed lookups aren't cached."""
+		now = self.clock()
+		lookups = {}
+		missing = []
+		self.lock.acquire()
+		try:
+			for host in set(hosts):
+				cached = self.cache.get(host)
+				if cached != None and cached[1] > now:
+					lookups[host] = {'address': cached[0], 'time': 0.0, 'cached': True}
+				else:
+					missing.append(host)
+		finally:
+			self.lock.release()
+
+		# Each thread takes the next host which hasn't been looked up until there are none left.
+		found = [None] * len(missing)
+		remaining = iter(range(len(missing)))
+		def lookup():
+			for i in remaining:
+				found[i] = self._lookup(missing[i])
+		threads = [threading.Thread(target=lookup) for i in range(min(self.threads, len(missing)))]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		expires = self.clock() + self.ttl
+		self.lock.acquire()
+		try:
+			for (host, lookup) in zip(missing, found):
+				if 'address' in lookup:
+					lookup['cached'] = False
+					self.cache[host] = (lookup['address'], expires)
+				lookups[host] = lookup
+		finally:
+			self.lock.release()
+		return lookups
+
+	def address(self, host):
+		"""Function to return the address of host. Raises socket.error if it can't be found."""
+		lookup = self.resolve([host])[host]
+		if 'error' in lookup:
+			raise socket.error(lookup['error'])
+		return lookup['address']
+
+
+def is_ipv6(address):
+	"""Function to return whether address, as returned by Resolver, is an IPv6 address."""
+	return ':' in address
+
+
+# The Resolver pingexp uses unless it is passed another.
+resolver = Resolver()
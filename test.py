@@ -1,9 +1,30 @@
 #!/usr/bin/env python
 # Some tests for pingexp.
 
+import json
+import os
+import pickle
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
+import urllib2
+from StringIO import StringIO
 
+import numpy
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import bench
+import pingagent
+import pingcatalog
+import pingdaemon
 import pingexp
+import pingparse
+import pingstats
+import pingtargets
 
 
 class TestLostSequenceNumbers(unittest.TestCase):
@@ -88,5 +109,1109 @@ class TestLostSequenceNumbers(unittest.TestCase):
         self.assertTrue(r == [1,4,7,10,11,12])
 
 
+class TestPingResults(unittest.TestCase):
+    def test_1(self):
+        """Test collecting streamed events into a results dict."""
+        events = [('response', (1, 64, 0.5)),
+                  ('response', (3, 64, 0.7)),
+                  ('summary', {'transmitted': 3, 'received': 2, 'packet_loss': 33, 'time': 400.0}),
+                  ('rtt_summary', {'min': 0.5, 'avg': 0.6, 'max': 0.7, 'mdev': 0.1}),
+                  ]
+
+        r = pingexp.ping_results(iter(events))
+
+        self.assertTrue(r['responses'] == [(1, 64, 0.5), (3, 64, 0.7)])
+        self.assertTrue(r['summary']['transmitted'] == 3)
+        self.assertTrue(r['rtt_summary']['max'] == 0.7)
+
+
+    def test_2(self):
+        """Test that a failed ping gives no results."""
+        events = [('response', (1, 64, 0.5)), ('error', ['ping: unknown host'])]
+
+        r = pingexp.ping_results(iter(events))
+
+        self.assertTrue(r == None)
+
+
+class TestIcmpEngine(unittest.TestCase):
+    def setUp(self):
+        try:
+            pingexp.IcmpEngine()._open_socket(0).close()
+        except socket.error:
+            self.skipTest('No ICMP datagram or raw sockets available.')
+
+
+    def test_1(self):
+        """Test keeping up with 1000 loopback targets."""
+        engine = pingexp.IcmpEngine(timeout=0.5)
+        for i in range(1000):
+            engine.add(i, '127.0.%i.%i' %(i // 250, i % 250 + 1), qos=(i % 2) * 16, interval=0.2, count=5)
+
+        start = time.time()
+        r = engine.run()
+        elapsed = time.time() - start
+
+        self.assertTrue(len(r) == 1000)
+        for result in r.values():
+            self.assertTrue(result['summary']['transmitted'] == 5)
+            self.assertTrue(result['summary']['received'] == 5)
+            self.assertTrue([response[0] for response in result['responses']] == [1, 2, 3, 4, 5])
+            self.assertTrue(result['rtt_summary']['max'] >= result['rtt_summary']['min'])
+        # 5 pings .2 seconds apart plus the reply timeout. Falling behind would stretch this out.
+        self.assertTrue(elapsed < 2.5)
+
+
+    def test_2(self):
+        """Test that an adaptive target pings faster while its pings are lost, within the budget."""
+        engine = pingexp.IcmpEngine(timeout=0.3, budget=90)
+        engine.add('Loopback', '127.0.0.1', interval=0.1, count=30, fast_interval=0.0125)
+        # Sending to the broadcast address fails, which counts as a loss.
+        engine.add('Lost', '255.255.255.255', interval=0.1, count=30, fast_interval=0.0125)
+        r = engine.run()
+
+        self.assertTrue(r['Loopback']['summary']['transmitted'] + r['Lost']['summary']['transmitted'] <= 90)
+        self.assertTrue(r['Lost']['summary']['transmitted'] > 30)
+        intervals = r['Lost']['intervals']
+        self.assertTrue(intervals[0] == [1, 0.1] and [0.05, 0.025, 0.0125] == [i for (seq, i) in intervals[1:4]])
+        self.assertTrue(all([0.0125 <= i <= 0.1 for (seq, i) in intervals]))
+
+
+    def test_3(self):
+        """Test that an adaptive target speeds up on alarms, slows down once calm and keeps to the budget."""
+        engine = pingexp.IcmpEngine()
+        target = engine.add('A', '127.0.0.1', interval=1.0, count=100, fast_interval=0.25)
+        engine.spare = float('inf')
+        gaps = []
+        for (now, alarm) in [(0.0, True), (0.5, True), (0.75, True), (1.0, False), (10.75, False), (11.0, False),
+                             (20.75, False), (30.75, False)]:
+            target.alarm = alarm
+            gaps.append(engine._adapt(target, now))
+        self.assertTrue(gaps == [0.5, 0.25, 0.25, 0.25, 0.5, 0.5, 1.0, 1.0])
+
+        engine.spare = 0.6
+        target.alarm = True
+        self.assertTrue(engine._adapt(target, 40.0) == 0.5)
+        target.alarm = True
+        self.assertTrue(engine._adapt(target, 40.5) == 1.0)
+        self.assertAlmostEqual(engine.spare, 0.1)
+
+        # Every interval has to stand for a whole number of fast intervals.
+        self.assertTrue(pingexp.halvings(1.0, 0.125) == 3 and pingexp.halvings(0.1, 0.0125) == 3)
+        self.assertTrue(pingexp.halvings(1.0, 0.3) == None and pingexp.halvings(1.0, 2.0) == None)
+        self.assertRaises(ValueError, engine.add, 'B', '127.0.0.1', interval=1.0, fast_interval=0.3)
+
+
+    def test_4(self):
+        """Test that raw sockets for several TOS values don't count each other's copies of the replies as duplicates."""
+        engine = pingexp.IcmpEngine(timeout=0.3)
+        engine.raw = True
+        try:
+            engine._open_socket(0).close()
+        except socket.error:
+            self.skipTest('No raw sockets available.')
+        for (key, qos) in (('A', 0), ('B', 16), ('C', 32)):
+            engine.add(key, '127.0.0.1', qos=qos, interval=0.05, count=10)
+        r = engine.run()
+
+        for result in r.values():
+            self.assertTrue(result['summary']['received'] == 10 and result['responses'].duplicates == 0)
+
+
+class TestSamples(unittest.TestCase):
+    def test_1(self):
+        """Test the read-only tuple view."""
+        s = pingexp.Samples([(2, 64, 1.5), (1, 63, 2.5)])
+
+        self.assertTrue(len(s) == 2)
+        self.assertTrue(s[0] == (2, 64, 1.5))
+        self.assertTrue(list(s) == [(2, 64, 1.5), (1, 63, 2.5)])
+        def assign():
+            s[0] = (3, 64, 0)
+        self.assertRaises(TypeError, assign)
+
+
+    def test_2(self):
+        """Test sorting by sequence number."""
+        s = pingexp.Samples([(3, 64, 0.3), (1, 64, 0.1), (2, 64, 0.2)])
+        s.sort()
+
+        self.assertTrue(s == [(1, 64, 0.1), (2, 64, 0.2), (3, 64, 0.3)])
+
+
+    def test_3(self):
+        """Test lost sequence numbers from the bitmap."""
+        results = {'responses': pingexp.Samples([(2, 64, 0), (3, 64, 0), (5, 64, 0), (6, 64, 0), (8,64,0), (9,64,0)]),
+                    'summary': {'transmitted': 12, 'received': 6},
+                    }
+
+        r = pingexp.find_lost_sequence_numbers(results)
+
+        self.assertTrue(r == [1,4,7,10,11,12])
+
+
+    def test_4(self):
+        """Test the memory used per sample."""
+        s = pingexp.Samples((seq, 64, seq * 0.001) for seq in xrange(1, 100001))
+
+        size = (s.seq.itemsize + s.ttl.itemsize + s.rtt.itemsize) * len(s) + len(s.received)
+
+        self.assertTrue(size < 14 * len(s))
+
+
+    def test_5(self):
+        """Test the times the pings were sent, through sorting, a results file and lost pings."""
+        s = pingexp.Samples([(3, 64, 1.0, 1000.4), (1, 64, 1.0, 1000.0), (6, 64, 1.0, 1001.0)])
+        s.sort()
+        experiment = {'responses': s, 'summary': {'transmitted': 7, 'received': 3}, 'interval': 0.2}
+        pingexp.finish_experiment(experiment)
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'results')
+            pingexp.write_results({'experiments': {'A': experiment}}, filename)
+            r = pingexp.read_results(filename)['experiments']['A']
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertTrue(r['responses'].sent_times().tolist() == [1000.0, 1000.4, 1001.0])
+        times = pingexp.send_times(r, [2, 4, 7], 0.2, start=1000.0)
+        self.assertTrue(numpy.allclose(times, [0.2, 0.6, 1.2]))
+        self.assertTrue(pingexp.send_times({'responses': [(1, 64, 1.0)]}, [2], 0.2).tolist() == [0.4])
+        self.assertAlmostEqual(r['stats']['send_interval'], 200.0)
+        self.assertAlmostEqual(r['stats']['send_drift_max'], 0.0)
+
+
+    def test_6(self):
+        """Test that adding batches at once gives the same samples as adding them one by one."""
+        batches = [[(seq & 0xffff, 64, seq * 0.001) for seq in xrange(65000, 65100)],
+                   [(seq, 64, 0.5) for seq in (65099, 65101, 65100, 65098)],
+                   [(seq & 0xffff, 63, seq * 0.001, seq * 0.2) for seq in xrange(65102, 65200, 2)]]
+        a = pingexp.Samples()
+        b = pingexp.Samples()
+        for batch in batches:
+            a.extend(batch)
+            for response in batch:
+                b.append(response)
+
+        self.assertTrue(list(a) == list(b) and a.seq[-1] == 65198)
+        self.assertTrue(numpy.isnan(a.sent_times()[:102]).all())
+        self.assertTrue(a.sent_times()[102:].tolist() == b.sent_times()[102:].tolist())
+        self.assertTrue(a.duplicates == b.duplicates == 2 and a.loss_runs(65198).tolist() == b.loss_runs(65198).tolist())
+
+
+    def test_7(self):
+        """Test passing samples through a shared memory file, growing it, instead of the queue."""
+        batches = [[(seq & 0xffff, 64, seq * 0.001, seq * 0.2) for seq in xrange(1, 3001)],
+                   [(seq, 64, 0.5) for seq in (2999, 3001)],
+                   [(seq & 0xffff, 63, seq * 0.001) for seq in xrange(3002, 70000)]]
+        q = pingexp.ThreadQueue()
+        writer = pingexp.SegmentWriter(q, 'A', 'pingexp-test-')
+        expected = pingexp.Samples()
+        segment = None
+        stored = []
+        for batch in batches:
+            writer.put(batch)
+            expected.extend(batch)
+            (name, kind, message) = q.get()
+            if segment == None:
+                segment = pingexp.SharedSegment(message['path'])
+            stored.append(len(segment.update(message)))
+        results = {}
+        writer.close(results)
+        s = segment.samples(results['shared'])
+        segment.close()
+
+        self.assertTrue(stored == [3000, 1, 66998])
+        self.assertTrue(not os.path.exists(message['path']))
+        self.assertTrue(list(s) == list(expected) and s.duplicates == 1)
+        self.assertTrue(s.sent_times()[2999] == 600.0 and numpy.isnan(s.sent_times()[3000:]).all())
+        self.assertTrue(s.loss_runs(70000).tolist() == expected.loss_runs(70000).tolist())
+
+
+class TestResultsFile(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        experiment = {'responses': [(2, 64, 1.5), (3, 64, 2.5), (5, 63, 3.5), (6, 64, 4.5)],
+                      'summary': {'transmitted': 6, 'received': 4, 'packet_loss': 33, 'time': 1000.0},
+                      'rtt_summary': {'min': 1.5, 'avg': 3.0, 'max': 4.5, 'mdev': 1.1},
+                      'host': 'localhost', 'qos': '16',
+                      }
+        pingexp.finish_experiment(experiment)
+        self.results = {'experiments': {'A': experiment}, 'start-time': 1.0, 'end-time': 2.0,
+                        'ping_count': 6, 'ping_interval': 0.2}
+
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+    def test_1(self):
+        """Test writing and reading back results."""
+        filename = os.path.join(self.dir, 'results')
+        pingexp.write_results(self.results, filename)
+
+        r = pingexp.read_results(filename)
+
+        self.assertTrue(r['ping_interval'] == 0.2)
+        self.assertTrue(list(r['experiments']) == ['A'])
+        self.assertTrue(r['experiments']['A']['qos'] == '16')
+        self.assertTrue(r['experiments']['A']['responses'] == self.results['experiments']['A']['responses'])
+        self.assertTrue(r['experiments']['A']['loss_runs'].tolist() == [[1, 1], [4, 1]])
+        self.assertTrue(pingexp.find_lost_sequence_numbers(r['experiments']['A']) == [1, 4])
+        self.assertTrue(r['experiments']['A']['sketch'].stats() == self.results['experiments']['A']['sketch'].stats())
+
+
+    def test_2(self):
+        """Test reading a range of sequence numbers."""
+        filename = os.path.join(self.dir, 'results')
+        pingexp.write_results(self.results, filename)
+
+        r = pingexp.ResultsFile(filename).experiment('A', first=3, last=5)
+
+        self.assertTrue(r['responses'] == [(3, 64, 2.5), (5, 63, 3.5)])
+        self.assertTrue(r['loss_runs'].tolist() == [[4, 1]])
+        self.assertTrue('sketch' not in r)
+
+
+    def test_3(self):
+        """Test converting a pickle file."""
+        old = os.path.join(self.dir, 'old')
+        new = os.path.join(self.dir, 'new')
+        self.results['experiments']['A']['responses'] = list(self.results['experiments']['A']['responses'])
+        f = open(old, 'wb')
+        pickle.dump(self.results, f)
+        f.close()
+
+        pingexp.convert_results(old, new)
+
+        self.assertTrue(pingexp.read_results(new)['experiments']['A']['responses'] == pingexp.read_results(old)['experiments']['A']['responses'])
+
+
+    def test_4(self):
+        """Test rendering a batch of files in parallel."""
+        filenames = [os.path.join(self.dir, 'results%i' %(i)) for i in range(3)]
+        for filename in filenames:
+            pingexp.write_results(self.results, filename)
+
+        failed = pingexp.render_files(filenames + [os.path.join(self.dir, 'missing')], processes=2)
+
+        self.assertTrue(failed == 1)
+        for filename in filenames:
+            self.assertTrue(open(filename + '.png', 'rb').read(8) == '\x89PNG\r\n\x1a\n')
+
+
+    def test_5(self):
+        """Test that empty and truncated files are reported and the files next to them still render."""
+        good = os.path.join(self.dir, 'results')
+        pingexp.write_results(self.results, good)
+        empty = os.path.join(self.dir, 'empty')
+        open(empty, 'wb').close()
+        header = os.path.join(self.dir, 'header')
+        open(header, 'wb').write(open(good, 'rb').read(12))
+        truncated = os.path.join(self.dir, 'truncated')
+        open(truncated, 'wb').write(open(good, 'rb').read()[:-10])
+
+        failed = pingexp.render_files([empty, header, truncated, good], processes=1)
+
+        self.assertTrue(failed == 3)
+        self.assertTrue(open(good + '.png', 'rb').read(8) == '\x89PNG\r\n\x1a\n')
+        self.assertRaises(ValueError, pingexp.read_results, header)
+        self.assertRaises(ValueError, pingexp.read_results, truncated)
+
+
+    def test_6(self):
+        """Test that derived data is kept next to the results file and only worked out again when stale."""
+        filename = os.path.join(self.dir, 'results')
+        pingexp.write_results(self.results, filename)
+        data = open(filename, 'rb').read()
+        r = pingexp.read_results(filename)
+        pingexp.graph(r, image_file=StringIO())
+        self.assertTrue(open(filename, 'rb').read() == data)
+
+        r = pingexp.read_results(filename)
+        kinds = sorted([json.loads(key)[0] for key in r['experiments']['A']['derived']])
+        self.assertTrue(kinds == ['histogram', 'loss_times', 'points'])
+        fail = lambda: self.fail('worked out again')
+        for key in r['experiments']['A']['derived']:
+            (kind, params) = json.loads(key)
+            self.assertTrue(len(pingexp.derived(r['experiments']['A'], kind, params, fail)))
+
+        # Other parameters are worked out and kept alongside.
+        pingexp.derived(r['experiments']['A'], 'histogram', {'bins': 1, 'range': 1.0}, lambda: {'counts': numpy.ones(1)})
+        pingexp.save_derived(r)
+        r = pingexp.read_results(filename)
+        self.assertTrue(len(r['experiments']['A']['derived']) == 4)
+        self.assertTrue(r['experiments']['A']['responses'] == self.results['experiments']['A']['responses'])
+
+        # Once the samples change the entries are stale.
+        r['experiments']['A']['digest'] = 'changed'
+        pingexp.save_derived(r)
+        self.assertTrue(pingexp.read_results(filename)['experiments']['A']['derived'] == {})
+        self.assertTrue(open(filename, 'rb').read() == data)
+
+
+    def test_7(self):
+        """Test that the derived data of a results file viewed over and over with different parameters doesn't keep growing."""
+        filename = os.path.join(self.dir, 'results')
+        pingexp.write_results(self.results, filename)
+        sizes = []
+        for bins in range(1, 21):
+            r = pingexp.read_results(filename)
+            pingexp.derived(r['experiments']['A'], 'histogram', {'bins': bins}, lambda: {'counts': numpy.ones(1000)})
+            pingexp.save_derived(r)
+            sizes.append(os.path.getsize(filename + pingexp.DERIVED_SUFFIX))
+
+        r = pingexp.read_results(filename)
+        self.assertTrue(len(r['experiments']['A']['derived']) == pingexp.DERIVED_KEEP)
+        self.assertTrue(max(sizes) < (pingexp.DERIVED_KEEP + 1) * 8000)
+        self.assertTrue(r['experiments']['A']['responses'] == self.results['experiments']['A']['responses'])
+        self.assertTrue(sorted(os.listdir(self.dir)) == ['results', 'results' + pingexp.DERIVED_SUFFIX])
+
+        # Stale entries are dropped from the file, not just from the index.
+        size = os.path.getsize(filename + pingexp.DERIVED_SUFFIX)
+        r['experiments']['A']['digest'] = 'changed'
+        pingexp.save_derived(r)
+        self.assertTrue(os.path.getsize(filename + pingexp.DERIVED_SUFFIX) < size - pingexp.DERIVED_KEEP * 8000)
+
+
+class TestResultsLog(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'log')
+        self.header = {'ping_count': 2000, 'ping_interval': 0.2, 'engine': 'ping', 'start-time': 1.0,
+                       'targets': [['A', 'localhost', '0', ''], ['B', 'localhost', '8', '']]}
+
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+    def test_1(self):
+        """Test reading back what was logged."""
+        log = pingexp.ResultsLog(self.filename, self.header, flush_interval=0.01)
+        log.samples('A', [(seq, 64, seq * 0.5) for seq in range(1, 1001)])
+        log.samples('B', [(1, 60, 2.0)])
+        log.done('B', {'summary': {'transmitted': 1, 'received': 1, 'packet_loss': 0, 'time': 0.0}, 'responses': []})
+        log.close()
+
+        (header, experiments, offset) = pingexp.read_log(self.filename)
+
+        self.assertTrue(header['ping_count'] == 2000)
+        self.assertTrue(list(experiments['A']['responses']) == [(seq, 64, seq * 0.5) for seq in range(1, 1001)])
+        self.assertTrue('summary' not in experiments['A'])
+        self.assertTrue(experiments['B']['responses'] == [(1, 60, 2.0)])
+        self.assertTrue(experiments['B']['summary']['transmitted'] == 1)
+        self.assertTrue(offset == os.path.getsize(self.filename))
+
+
+    def test_2(self):
+        """Test that an incomplete record is dropped and resuming carries on after the last good one."""
+        log = pingexp.ResultsLog(self.filename, self.header, flush_interval=0.01)
+        log.samples('A', [(1, 64, 1.0), (2, 64, 2.0)])
+        log.close()
+        good = os.path.getsize(self.filename)
+        f = open(self.filename, 'ab')
+        f.write('SMPL\0\0\0\0\x05\0\0\0garbage')
+        f.close()
+
+        (header, experiments, offset) = pingexp.read_log(self.filename)
+        self.assertTrue(offset == good)
+        self.assertTrue(experiments['A']['responses'] == [(1, 64, 1.0), (2, 64, 2.0)])
+
+        log = pingexp.ResultsLog(self.filename, header, flush_interval=0.01, offset=offset)
+        log.samples('A', [(3, 64, 3.0)])
+        log.close()
+
+        (header, experiments, offset) = pingexp.read_log(self.filename)
+        self.assertTrue(experiments['A']['responses'] == [(1, 64, 1.0), (2, 64, 2.0), (3, 64, 3.0)])
+
+
+class TestStats(unittest.TestCase):
+    def test_1(self):
+        """Test the latency statistics."""
+        rtt = [float(x) for x in range(1, 1001)]
+
+        s = pingstats.compute(range(1, 1001), rtt)
+
+        self.assertTrue(s['count'] == 1000)
+        self.assertTrue(s['min'] == 1.0 and s['max'] == 1000.0 and s['avg'] == 500.5)
+        self.assertAlmostEqual(s['mdev'], 288.6749902572095)
+        self.assertAlmostEqual(s['p50'], 500.5)
+        self.assertAlmostEqual(s['p99.9'], 999.001)
+
+
+    def test_2(self):
+        """Test that the jitter matches the RFC 3550 running estimate."""
+        rtt = [10.0, 12.0, 11.0, 15.0, 10.0, 10.5]
+        j = 0.0
+        for i in range(1, len(rtt)):
+            j += (abs(rtt[i] - rtt[i-1]) - j) / 16
+
+        self.assertAlmostEqual(pingstats.compute(range(1, 7), rtt)['jitter'], j)
+
+
+    def test_3(self):
+        """Test loss bursts at the start, middle and end."""
+        s = pingstats.compute([3, 4, 7, 8], [1.0] * 4, transmitted=12)
+
+        self.assertTrue(s['loss_bursts'] == 3)
+        self.assertTrue(s['loss_burst_max'] == 4)
+        self.assertAlmostEqual(s['loss_burst_avg'], 8 / 3.0)
+
+
+    def test_4(self):
+        """Test 100% loss."""
+        s = pingstats.compute([], [], transmitted=5)
+
+        self.assertTrue(s['count'] == 0 and s['max'] == 0.0)
+        self.assertTrue(s['loss_bursts'] == 1 and s['loss_burst_max'] == 5)
+
+
+    def test_5(self):
+        """Test that the sketch's percentiles are within its precision and that merging works."""
+        rtt = 20 + numpy.random.RandomState(0).gamma(2.0, 2.0, 100000)
+        rtt[::1000] *= 50
+
+        sketch = pingstats.Histogram()
+        sketch.add(rtt[:50000])
+        other = pingstats.Histogram()
+        other.add(rtt[50000:])
+        sketch.merge(other)
+
+        exact = pingstats.compute(range(1, len(rtt) + 1), rtt)
+        stats = sketch.stats()
+        self.assertTrue(stats['count'] == 100000 and stats['min'] == exact['min'] and stats['max'] == exact['max'])
+        self.assertAlmostEqual(stats['avg'], exact['avg'])
+        self.assertAlmostEqual(stats['mdev'], exact['mdev'])
+        for p in pingstats.PERCENTILES:
+            name = pingstats.percentile_name(p)
+            self.assertTrue(abs(stats[name] - exact[name]) < exact[name] * 0.01)
+
+        (info, counts) = sketch.state()
+        self.assertTrue(pingstats.Histogram.from_state(info, counts).stats() == stats)
+        self.assertRaises(ValueError, sketch.merge, pingstats.Histogram(digits=3))
+
+
+    def test_6(self):
+        """Test how well the pings kept to their schedule."""
+        sent = 1000.0 + numpy.arange(10) * 0.1
+        sent[5:] += 0.05
+
+        s = pingstats.timing(range(1, 11), sent, 0.1)
+
+        self.assertAlmostEqual(s['send_interval'], 950 / 9.0)
+        self.assertAlmostEqual(s['send_drift_avg'], 25.0)
+        self.assertAlmostEqual(s['send_drift_max'], 50.0)
+        self.assertTrue(pingstats.timing([1, 2], [numpy.nan, 1000.0], 0.1) == {})
+
+
+    def test_7(self):
+        """Test weighting the statistics by the time each ping stands for."""
+        # Pings 1-4 every second, then 5-12 every quarter of a second while 5-8 are lost.
+        weights = [1.0] * 4 + [0.25] * 8
+        seq = [1, 2, 3, 4, 9, 10, 11, 12]
+        rtt = [10.0] * 4 + [30.0] * 4
+        s = pingstats.compute(seq, rtt, transmitted=12, weights=weights)
+
+        self.assertAlmostEqual(s['avg'], 14.0)
+        self.assertAlmostEqual(s['p50'], 10.0)
+        self.assertAlmostEqual(s['time_loss'], 100.0 / 6)
+        self.assertTrue(pingstats.compute(seq, rtt, transmitted=12, weights=[0.5] * 12)['p95'] ==
+                        pingstats.compute(seq, rtt, transmitted=12)['p95'])
+
+        sketch = pingstats.Histogram()
+        sketch.add(rtt, [4] * 4 + [1] * 4)
+        self.assertTrue(sketch.count == 20 and sketch.stats()['avg'] == 14.0)
+
+
+class TestLossRuns(unittest.TestCase):
+    def test_1(self):
+        """Test runs at the start, middle and end."""
+        results = {'responses': [(3, 64, 0), (4, 64, 0), (7, 64, 0), (8, 64, 0)],
+                    'summary': {'transmitted': 12, 'received': 4},
+                    }
+
+        r = pingexp.find_loss_runs(results)
+
+        self.assertTrue(r.tolist() == [[1, 2], [5, 2], [9, 4]])
+        self.assertTrue(pingexp.expand_runs(r).tolist() == [1, 2, 5, 6, 9, 10, 11, 12])
+        self.assertTrue(pingexp.collapse_runs([1, 2, 5, 6, 9, 10, 11, 12]).tolist() == r.tolist())
+
+
+    def test_2(self):
+        """Test sequence numbers wrapping at 65535 with a loss across the wrap."""
+        responses = [(seq & 0xffff, 64, 0) for seq in range(65530, 65537) + range(65538, 65545)]
+        results = {'responses': responses,
+                    'summary': {'transmitted': 65544, 'received': 65544 - 65530},
+                    }
+
+        r = pingexp.find_loss_runs(results)
+
+        self.assertTrue(r.tolist() == [[1, 65529], [65537, 1]])
+
+
+    def test_3(self):
+        """Test that duplicates and reordered replies are counted and not lost."""
+        s = pingexp.Samples([(1, 64, 0), (3, 64, 0), (2, 64, 0), (3, 64, 0), (5, 64, 0), (5, 64, 0)])
+
+        self.assertTrue(s.duplicates == 2)
+        self.assertTrue(s.reordered == 1)
+        self.assertTrue(len(s) == 4)
+        self.assertTrue(s.loss_runs(6).tolist() == [[4, 1], [6, 1]])
+
+
+class TestDecimate(unittest.TestCase):
+    def test_1(self):
+        """Test that decimating keeps spikes and dips."""
+        x = numpy.arange(100000) * 0.2
+        y = numpy.ones(100000)
+        y[12345] = 500
+        y[67890] = 0
+
+        (dx, dy) = pingexp.decimate(x, y, 800)
+
+        self.assertTrue(len(dx) <= 1600)
+        self.assertTrue(dy.max() == 500 and dy.min() == 0)
+        self.assertTrue(all(numpy.diff(dx) >= 0))
+
+
+    def test_2(self):
+        """Test that decimating fewer points than buckets changes nothing."""
+        (dx, dy) = pingexp.decimate([1, 2, 3], [4, 5, 6], 800)
+
+        self.assertTrue(list(dx) == [1, 2, 3] and list(dy) == [4, 5, 6])
+
+
+    def test_3(self):
+        """Test marking the buckets covered by runs."""
+        x = pingexp.decimate_runs([0.5, 3.0, 20.0], [0.5, 5.5, 30.0], 0.0, 10.0, 10)
+
+        self.assertTrue(list(x) == [0.5, 3.5, 4.5, 5.5])
+
+
+class TestLiveGraph(unittest.TestCase):
+    def setUp(self):
+        self.fig = Figure(figsize=(10, 10))
+        FigureCanvasAgg(self.fig)
+        self.live = pingexp.LiveGraph(['a', 'b'], 0.5, window=10, fig=self.fig)
+
+
+    def test_1(self):
+        """Test the running totals and histogram counts."""
+        self.live.add('a', [(1, 64, 1.0), (2, 64, 3.0), (5, 64, 3.5)])
+        self.live.add('b', [(1, 64, 10.0)])
+        self.live.draw()
+
+        a = self.live.series['a']
+        self.assertTrue(a.count == 3 and a.seq_max == 5)
+        self.assertTrue(list(a.hist) == [1, 2])
+        self.assertTrue(list(a.loss_starts) == [1.5] and list(a.loss_ends) == [2.0])
+        self.assertTrue(self.live.series['b'].hist[5] == 1)
+
+
+    def test_2(self):
+        """Test that the window moves on and old samples are dropped."""
+        for seq in range(1, 101):
+            self.live.add('a', [(seq, 64, 1.0)])
+        self.live.draw()
+
+        (left, right) = self.live.ax.get_xlim()
+        a = self.live.series['a']
+        self.assertTrue(left <= 50 <= right and right - left == 10)
+        self.assertTrue(a.count == 100 and a.x.min() >= left)
+
+
+class TestBench(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+    def test_1(self):
+        """Test the made up replies."""
+        (seq, rtt, kind) = bench.synthetic(10000, loss=0.05, burst=4, reorder=0.01, duplicates=0.01, truncated=0.01)
+
+        self.assertTrue(400 < 10000 - len(numpy.unique(seq)) < 600)
+        self.assertTrue(50 < (kind == bench.DUPLICATE).sum() < 150)
+        self.assertTrue(50 < (kind == bench.TRUNCATED).sum() < 150)
+        self.assertTrue(50 < (numpy.diff(seq.astype(int)) < 0).sum() < 150)
+        self.assertTrue(rtt.min() >= bench.RTT_MIN)
+
+
+    def test_2(self):
+        """Test parsing the output of fakeping.py."""
+        os.environ['FAKEPING_LOSS'] = '0.1'
+        os.environ['FAKEPING_DUPLICATES'] = '0.1'
+        try:
+            results = pingexp.ping_results(pingexp.ping('127.0.0.1', count=1000, binary=bench.FAKEPING))
+        finally:
+            del os.environ['FAKEPING_LOSS']
+            del os.environ['FAKEPING_DUPLICATES']
+        (seq, rtt, kind) = bench.synthetic(1000, loss=0.1, duplicates=0.1)
+
+        self.assertTrue(list(results['responses'].columns()[0]) == list(seq[kind == bench.REPLY]))
+        self.assertTrue(results['responses'].duplicates == (kind == bench.DUPLICATE).sum())
+
+
+    def test_3(self):
+        """Test that a --flood experiment keeps up with fakeping.py and records every reply."""
+        os.environ['FAKEPING_REALTIME'] = '1'
+        os.environ['FAKEPING_RTT'] = '0.05,1,0'
+        try:
+            results = pingexp.experiment(20000, 0, [('A', '127.0.0.1', '0', '')], ping_binary=bench.FAKEPING, flood=True)
+        finally:
+            del os.environ['FAKEPING_REALTIME']
+            del os.environ['FAKEPING_RTT']
+        experiment = results['experiments']['A']
+
+        self.assertTrue(results['flood'] and len(experiment['responses']) == 20000)
+        self.assertTrue(experiment['summary']['received'] == 20000)
+        self.assertTrue(experiment['stats']['send_interval'] < 0.5)
+
+
+    def test_4(self):
+        """Test measuring pingexp's own overhead against loopback and keeping it in a results file."""
+        os.environ['FAKEPING_REALTIME'] = '1'
+        try:
+            profile = pingexp.measure_overhead(10, 0.05, [('A', 'x', '0', ''), ('B', 'y', '8', '')], ping_binary=bench.FAKEPING)
+        finally:
+            del os.environ['FAKEPING_REALTIME']
+
+        for phase in ('schedule', 'send', 'read', 'parse', 'ipc', 'stats'):
+            self.assertTrue(profile[phase]['count'] > 0 and 0 <= profile[phase]['avg'] <= profile[phase]['max'])
+        self.assertTrue(profile['targets'] == 2 and profile['count'] == 10)
+        self.assertTrue(profile['rtt']['avg'] <= profile['rtt']['p99'] <= profile['rtt']['max'])
+
+        results = pingexp.experiment(5, 0.01, [('A', '127.0.0.1', '0', '')], ping_binary=bench.FAKEPING)
+        results['calibration'] = profile
+        filename = os.path.join(self.dir, 'results.pexp')
+        pingexp.write_results(results, filename)
+        self.assertTrue(pingexp.read_results(filename)['calibration'] == profile)
+
+        # A flood is cut short by count since there is no interval to go by.
+        os.environ['FAKEPING_REALTIME'] = '1'
+        os.environ['FAKEPING_RTT'] = '0.05,1,0'
+        try:
+            profile = pingexp.measure_overhead(1000000, 0, [('A', 'x', '0', '')], ping_binary=bench.FAKEPING, flood=True)
+        finally:
+            del os.environ['FAKEPING_REALTIME']
+            del os.environ['FAKEPING_RTT']
+        self.assertTrue(profile['count'] == pingexp.CALIBRATION_FLOOD_COUNT)
+
+
+class TestWorkerScheduler(unittest.TestCase):
+    def test_1(self):
+        """Test that the workers are capped and their starts are spread across the interval."""
+        scheduler = pingexp.WorkerScheduler(range(10), 1.0, max_workers=4, start=100.0, seed=1)
+
+        started = scheduler.due(101.0)
+        self.assertTrue([key for (key, when) in started] == [0, 1, 2, 3])
+        self.assertTrue([int(when * 4) for (key, when) in started] == [400, 401, 402, 403])
+        self.assertTrue(scheduler.wait(101.0) == None)
+
+        # A freed slot is used again at its next phase.
+        scheduler.done(2, 103.2)
+        self.assertTrue(scheduler.due(103.2) == [])
+        self.assertTrue(0 < scheduler.wait(103.2) < 1.0)
+        [(key, when)] = scheduler.due(104.0)
+        self.assertTrue(key == 4 and when == started[2][1] + 3)
+
+
+    def test_2(self):
+        """Test the packets per second budget."""
+        scheduler = pingexp.WorkerScheduler(range(10), 0.5, max_pps=5, start=100.0)
+        self.assertTrue(len(scheduler.due(101.0)) == 2)
+
+        scheduler = pingexp.WorkerScheduler(range(10), 0.5, max_pps=0.1, start=100.0)
+        self.assertTrue(len(scheduler.due(101.0)) == 1)
+
+
+    def test_3(self):
+        """Test running more targets than workers with fakeping.py."""
+        targets = [('T%i' %(i), '127.0.0.1', '0', '') for i in range(5)]
+        results = pingexp.experiment(20, 0.2, targets, ping_binary=bench.FAKEPING, max_workers=2)
+
+        self.assertTrue(sorted(results['experiments']) == [t[0] for t in targets])
+        for experiment in results['experiments'].values():
+            self.assertTrue(len(experiment['responses']) == 20)
+            self.assertTrue(experiment['drift']['start'] >= 0)
+
+
+class TestDaemon(unittest.TestCase):
+    def test_1(self):
+        """Test the ring buffer's window across 16 bit wraparound and a restart."""
+        ring = pingdaemon.RingBuffer(1000, 1.0, timeout=2.0, now=0.0)
+        ring.start(0.0)
+        seqs = [s for s in range(1, 70001) if s % 10 != 0]
+        for i in range(0, len(seqs), 100):
+            ring.add([(s & 0xffff, 64, 20.0) for s in seqs[i:i + 100]], float(seqs[i + 99]))
+        ring.add([(69999 & 0xffff, 64, 20.0)], 70000.0)
+
+        stats = ring.stats(70000.0)
+        self.assertTrue(stats['sent'] == 70000)
+        self.assertTrue(stats['transmitted'] == 1000)
+        self.assertTrue(stats['loss'] == 0.1 and stats['loss_burst_max'] == 1)
+        self.assertTrue(ring.duplicates == 1)
+
+        # The next ping command carries on where the last left off.
+        ring.stop(70000.0)
+        ring.start(70010.0)
+        ring.add([(s, 64, 30.0) for s in range(1, 1001)], 71000.0)
+        stats = ring.stats(71002.0)
+        self.assertTrue(stats['transmitted'] == 1000 and stats['loss'] == 0.0 and stats['avg'] == 30.0)
+
+
+    def test_2(self):
+        """Test serving the metrics of fakeping.py."""
+        os.environ['FAKEPING_REALTIME'] = '1'
+        try:
+            # A 1 second window of .1 second pings, after the 2 second reply timeout.
+            daemon = pingdaemon.Daemon([('Loopback', '127.0.0.1', '0', '')], 0.1, window=1, port=0,
+                                       ping_binary=bench.FAKEPING)
+            thread = threading.Thread(target=daemon.run)
+            thread.start()
+            time.sleep(4)
+            text = urllib2.urlopen('http://127.0.0.1:%i/metrics' %(daemon.server.server_address[1])).read()
+            daemon.stop()
+            thread.join()
+        finally:
+            del os.environ['FAKEPING_REALTIME']
+
+        labels = '{target="Loopback",host="127.0.0.1",qos="0"}'
+        self.assertTrue('pingexp_up%s 1.0\n' %(labels) in text)
+        self.assertTrue('pingexp_window_sent%s 10.0\n' %(labels) in text)
+        self.assertTrue('pingexp_loss_ratio%s 0.0\n' %(labels) in text)
+        self.assertTrue('# TYPE pingexp_rtt_seconds summary\n' in text)
+
+
+class TestAgent(unittest.TestCase):
+    def setUp(self):
+        self.agents = []
+        self.threads = []
+
+
+    def tearDown(self):
+        for agent in self.agents:
+            agent.stop()
+        for thread in self.threads:
+            thread.join()
+
+
+    def start(self, **kwargs):
+        agent = pingagent.Agent(port=0, host='127.0.0.1', ping_binary=bench.FAKEPING, **kwargs)
+        thread = threading.Thread(target=agent.run)
+        thread.start()
+        self.agents.append(agent)
+        self.threads.append(thread)
+        return agent
+
+
+    def test_1(self):
+        """Test that an agent's clock is lined up with the coordinator's."""
+        agent = self.start(clock=lambda: time.time() + 100.0)
+        conn = socket.create_connection(('127.0.0.1', agent.port))
+        (rfile, wfile) = (conn.makefile('rb'), conn.makefile('wb'))
+        pingagent.authenticate(rfile, wfile)
+        (offset, error) = pingagent.clock_offset(rfile, wfile)
+        conn.close()
+
+        self.assertTrue(abs(offset - 100.0) <= error + 0.01)
+
+
+    def test_2(self):
+        """Test running the same targets from two agents on localhost and merging the results."""
+        agents = [('X', '127.0.0.1', self.start(secret='key', flood=True).port),
+                  ('Y', '127.0.0.1', self.start(secret='key', flood=True).port)]
+        targets = [('A', '127.0.0.1', '0', ''), ('B', '127.0.0.1', '8', '')]
+        results = pingagent.run(agents, 20, 0.05, targets, secret='key', start_delay=0.5)
+
+        self.assertTrue(sorted(results['experiments']) == ['X/A', 'X/B', 'Y/A', 'Y/B'])
+        for experiment in results['experiments'].values():
+            self.assertTrue(len(experiment['responses']) == 20 and experiment['summary']['received'] == 20)
+            sent = experiment['responses'].sent_times()
+            self.assertTrue(results['start-time'] <= sent[0] < results['start-time'] + 1.0)
+        self.assertTrue(results['experiments']['Y/B']['agent'] == 'Y' and results['experiments']['Y/B']['qos'] == '8')
+        self.assertTrue(abs(results['agents']['X']['clock_offset']) < 10.0)
+        pingexp.graph(results, image_file=StringIO())
+
+
+    def test_3(self):
+        """Test that an agent turns away coordinators without its secret and refuses floods and huge experiments."""
+        agent = self.start(secret='key', max_count=1000)
+        targets = [('A', '127.0.0.1', '0', '')]
+
+        for secret in (None, 'wrong'):
+            self.assertRaises(ValueError, pingagent.run, [('X', '127.0.0.1', agent.port)], 5, 1, targets, secret=secret)
+        for (count, interval, flood) in ((5, 1, True), (5, 0.01, False), (1001, 1, False)):
+            self.assertRaises(ValueError, pingagent.run, [('X', '127.0.0.1', agent.port)], count, interval, targets,
+                              flood=flood, secret='key')
+        agent = pingagent.Agent(port=0)
+        self.assertTrue(agent.server.getsockname()[0] == '127.0.0.1')
+        agent.server.close()
+
+
+    def test_4(self):
+        """Test that an agent answers malformed messages with an error and carries on serving."""
+        agent = self.start()
+        job = {'op': 'run', 'ping_count': 5, 'ping_interval': 1, 'targets': [['A', '127.0.0.1', '0', '']]}
+        for messages in ([5], ['[]'], [{'op': 'auth'}], [{'op': 'auth', 'digest': pingagent.sign(None, 'x')}],
+                         [None, {'op': 'stop'}], [None, job], [None, dict(job, ping_count='5', start=0)],
+                         [None, dict(job, targets=[['A', '127.0.0.1']], start=0)],
+                         [None, dict(job, targets=[['A', '127.0.0.1', 'x', '']], start=0)]):
+            conn = socket.create_connection(('127.0.0.1', agent.port))
+            (rfile, wfile) = (conn.makefile('rb'), conn.makefile('wb'))
+            challenge = pingagent.read_message(rfile)['challenge']
+            for message in messages:
+                if message == None:
+                    message = {'op': 'auth', 'digest': pingagent.sign(None, challenge)}
+                pingagent.write_message(wfile, message)
+                reply = pingagent.read_message(rfile)
+            self.assertTrue('error' in reply and pingagent.read_message(rfile) == None)
+            conn.close()
+
+        conn = socket.create_connection(('127.0.0.1', agent.port))
+        (rfile, wfile) = (conn.makefile('rb'), conn.makefile('wb'))
+        pingagent.authenticate(rfile, wfile)
+        self.assertTrue(pingagent.clock_offset(rfile, wfile, samples=1)[0] < 1.0)
+        conn.close()
+
+
+class TestTargets(unittest.TestCase):
+    def test_1(self):
+        """Test reading a target file with repeated targets."""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'targets')
+            f = open(filename, 'w')
+            f.write('# Every line is a target\nwww.example.com\n\nBig, www.example.com, 8, 1400  # Large\n'
+                    'www.example.com\nSmall,www.example.com,8\n')
+            f.close()
+            targets = pingtargets.read_targets(filename)
+            self.assertTrue(targets[1] == ('Big', 'www.example.com', '8', '1400'))
+            self.assertTrue(pingtargets.unique_targets(targets) == [('www.example.com', 'www.example.com', '0', ''),
+                            ('Big', 'www.example.com', '8', '1400'), ('Small', 'www.example.com', '8', '')])
+            self.assertRaises(ValueError, pingtargets.unique_targets, targets + [('Big', 'www.example.org', '8', '')])
+
+            f = open(filename, 'a')
+            f.write('Bad,www.example.com\n')
+            f.close()
+            self.assertRaises(ValueError, pingtargets.read_targets, filename)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+    def test_2(self):
+        """Test that the resolver only looks a host up again once its address expires."""
+        now = [0.0]
+        resolver = pingtargets.Resolver(ttl=60, clock=lambda: now[0])
+        lookups = resolver.resolve(['localhost', '127.0.0.2', 'localhost', 'nonexistent.invalid'])
+        self.assertTrue(sorted(lookups) == ['127.0.0.2', 'localhost', 'nonexistent.invalid'])
+        self.assertTrue(lookups['127.0.0.2']['address'] == '127.0.0.2' and not lookups['127.0.0.2']['cached'])
+        self.assertTrue('error' in lookups['nonexistent.invalid'])
+
+        now[0] = 59.0
+        self.assertTrue(resolver.resolve(['localhost'])['localhost']['cached'])
+        now[0] = 61.0
+        self.assertTrue(not resolver.resolve(['localhost'])['localhost']['cached'])
+        self.assertRaises(socket.error, resolver.address, 'nonexistent.invalid')
+
+
+    def test_3(self):
+        """Test that each target of a host pings the address it was looked up as."""
+        targets = [('A', 'localhost', '0', ''), ('B', 'localhost', '8', '')]
+        results = pingexp.experiment(5, 0.01, targets, ping_binary=bench.FAKEPING)
+        for name in ('A', 'B'):
+            experiment = results['experiments'][name]
+            self.assertTrue(experiment['host'] == 'localhost' and experiment['address'] == '127.0.0.1')
+            self.assertTrue(experiment['resolve_time'] >= 0.0 and experiment['summary']['received'] == 5)
+        self.assertTrue(results['resolve_time'] >= 0.0)
+
+
+    def test_4(self):
+        """Test that a host with only an IPv6 address is left to ping to look up, and refused by the native engine."""
+        self.assertTrue(pingtargets.Resolver().address('::1') == '::1')
+        results = pingexp.experiment(5, 0.01, [('A', '::1', '0', '')], ping_binary=bench.FAKEPING)
+        experiment = results['experiments']['A']
+        self.assertTrue(experiment['address'] == '::1' and experiment['summary']['received'] == 5)
+        self.assertRaises(socket.error, pingexp.IcmpEngine().add, 'A', '::1', address='::1')
+
+
+class TestParser(unittest.TestCase):
+    def parse(self, text, pieces=1):
+        """Feed text to a Parser in pieces and return {kind: [value, ...]}."""
+        parser = pingparse.Parser()
+        events = []
+        size = len(text) // pieces + 1
+        for start in range(0, len(text), size):
+            events.extend(parser.feed(text[start:start + size]))
+        events.extend(parser.close())
+
+        kinds = {}
+        for kind, value in events:
+            kinds.setdefault(kind, []).append(value)
+        return kinds
+
+
+    def test_1(self):
+        """Test parsing iputils output in any sized pieces."""
+        (seq, rtt, kind) = bench.synthetic(5000, loss=0.05, reorder=0.01, duplicates=0.01, truncated=0.01)
+        text = '\n'.join(bench.ping_output(5000, loss=0.05, reorder=0.01, duplicates=0.01, truncated=0.01)) + '\n'
+
+        for pieces in (1, 7, 1000):
+            kinds = self.parse(text, pieces)
+            responses = sum(kinds['responses'], [])
+
+            self.assertTrue(kinds['dialect'] == ['iputils'])
+            self.assertTrue([r[0] for r in responses] == list(seq[kind != bench.TRUNCATED]))
+            self.assertTrue(len(kinds['truncated']) == (kind == bench.TRUNCATED).sum())
+            self.assertTrue(kinds['summary'][0]['transmitted'] == 5000)
+
+
+    def test_2(self):
+        """Test parsing iputils output with the times the replies arrived (ping -D)."""
+        (seq, rtt, kind) = bench.synthetic(5000, loss=0.05, duplicates=0.01)
+        text = '\n'.join(bench.ping_output(5000, interval=0.01, start=1000.0, loss=0.05, duplicates=0.01)) + '\n'
+
+        for pieces in (1, 7, 1000):
+            kinds = self.parse(text, pieces)
+            responses = sum(kinds['responses'], [])
+
+            self.assertTrue([r[0] for r in responses] == list(seq))
+            sent = numpy.array([r[3] for r in responses])
+            self.assertTrue(numpy.allclose(sent, 1000.0 + (seq - 1) * 0.01, atol=1e-4))
+
+
+    def test_3(self):
+        """Test parsing busybox output, which counts from 0."""
+        text = ('PING 127.0.0.1 (127.0.0.1): 56 data bytes\n'
+                '64 bytes from 127.0.0.1: seq=0 ttl=64 time=0.080 ms\n'
+                '64 bytes from 127.0.0.1: seq=2 ttl=63 time=1.25 ms\n'
+                '\n'
+                '--- 127.0.0.1 ping statistics ---\n'
+                '3 packets transmitted, 2 packets received, 33% packet loss\n'
+                'round-trip min/avg/max = 0.080/0.665/1.250 ms\n')
+
+        kinds = self.parse(text)
+
+        self.assertTrue(kinds['dialect'] == ['busybox'])
+        self.assertTrue(kinds['responses'] == [[(1, 64, 0.08), (3, 63, 1.25)]])
+        self.assertTrue(kinds['summary'] == [{'transmitted': 3, 'received': 2, 'packet_loss': 33}])
+        self.assertTrue(kinds['rtt_summary'][0]['max'] == 1.25 and kinds['rtt_summary'][0]['mdev'] == 0.0)
+
+
+    def test_4(self):
+        """Test parsing fping output."""
+        text = ('127.0.0.1 : [0], 84 bytes, 0.05 ms (0.05 avg, 0% loss)\n'
+                '127.0.0.1 : [1], timed out (NaN avg, 50% loss)\n'
+                '127.0.0.1 : [2], 84 bytes, 0.10 ms (0.07 avg, 33% loss)\n'
+                '127.0.0.1 : xmt/rcv/%loss = 3/2/33%, min/avg/max = 0.05/0.07/0.10\n')
+
+        kinds = self.parse(text)
+
+        self.assertTrue(kinds['dialect'] == ['fping'])
+        self.assertTrue(kinds['responses'] == [[(1, 0, 0.05), (3, 0, 0.1)]])
+        self.assertTrue(kinds['summary'] == [{'transmitted': 3, 'received': 2, 'packet_loss': 33}])
+        self.assertTrue(kinds['rtt_summary'][0]['avg'] == 0.07)
+
+
+    def test_5(self):
+        """Test that a TOS busybox ping can't set is refused rather than recorded."""
+        self.assertTrue(pingparse.BusyboxDialect.arguments('busybox', 'localhost', qos='0')[:2] == ['busybox', 'ping'])
+        self.assertRaises(ValueError, pingparse.BusyboxDialect.arguments, 'busybox', 'localhost', qos='16')
+        self.assertRaises(ValueError, pingexp.experiment, 5, 0.2, [('A', '127.0.0.1', '16', '')], ping_binary='/bin/busybox')
+        pingexp.check_ping('ping', [('A', '127.0.0.1', '16', '')])
+
+
+    def test_6(self):
+        """Test that --flood is refused for ping commands which can't flood."""
+        self.assertRaises(ValueError, pingparse.FpingDialect.arguments, 'fping', 'localhost', flood=True)
+        self.assertRaises(ValueError, pingparse.BusyboxDialect.arguments, 'busybox', 'localhost', flood=True)
+        self.assertRaises(ValueError, pingexp.experiment, 5, 0, [('A', '127.0.0.1', '0', '')], ping_binary='fping', flood=True)
+        self.assertTrue('-A' in pingparse.IputilsDialect.arguments('ping', 'localhost', flood=True))
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.results_dir = os.path.join(self.dir, 'results')
+        os.mkdir(self.results_dir)
+        self.catalog = pingcatalog.Catalog(os.path.join(self.dir, 'catalog.db'))
+
+        for (name, start, qos, received) in (('day1', 86400.0, '0', 6), ('day2', 2 * 86400.0, '16', 3)):
+            experiment = {'responses': [(seq, 64, float(seq)) for seq in range(1, received + 1)],
+                          'summary': {'transmitted': 6, 'received': received, 'packet_loss': 100 - received * 100 / 6},
+                          'host': 'localhost', 'qos': qos, 'size': 100,
+                          }
+            pingexp.finish_experiment(experiment)
+            results = {'experiments': {'A': experiment}, 'start-time': start, 'end-time': start + 6,
+                       'ping_count': 6, 'ping_interval': 1.0}
+            pingexp.write_results(results, os.path.join(self.results_dir, name))
+
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.dir)
+
+
+    def test_1(self):
+        """Test scanning a directory and querying the catalog."""
+        open(os.path.join(self.results_dir, 'notes.txt'), 'w').write('Not results.')
+
+        (updated, removed, errors) = self.catalog.scan([self.results_dir])
+
+        self.assertTrue((updated, removed, len(errors)) == (2, 0, 1))
+        self.assertTrue(len(self.catalog.query(host='localhost')) == 2)
+        rows = self.catalog.query(qos=16)
+        self.assertTrue([row['path'] for row in rows] == [os.path.join(self.results_dir, 'day2')])
+        self.assertTrue(rows[0]['size'] == 100 and rows[0]['packet_loss'] == 50 and rows[0]['max'] == 3.0)
+        self.assertTrue([row['qos'] for row in self.catalog.query(since=1.5 * 86400)] == [16])
+        self.assertTrue([row['qos'] for row in self.catalog.query(max_loss=0)] == [0])
+
+
+    def test_2(self):
+        """Test that rescanning only reads new and changed files, and forgets deleted ones."""
+        self.catalog.scan([self.results_dir])
+        shutil.copy(os.path.join(self.results_dir, 'day1'), os.path.join(self.results_dir, 'day3'))
+        os.remove(os.path.join(self.results_dir, 'day2'))
+
+        (updated, removed, errors) = self.catalog.scan()
+
+        self.assertTrue((updated, removed, errors) == (1, 1, []))
+        self.assertTrue([os.path.basename(row['path']) for row in self.catalog.query()] == ['day1', 'day3'])
+
+
+    def test_3(self):
+        """Test that pickles are only loaded when asked for, and that rejected files are skipped until they change."""
+        experiment = {'responses': [(1, 64, 1.0)], 'summary': {'transmitted': 1, 'received': 1, 'packet_loss': 0},
+                      'host': 'localhost', 'qos': '0', 'size': 100,
+                      }
+        legacy = os.path.join(self.results_dir, 'old.pickle')
+        pickle.dump({'experiments': {'A': experiment}, 'start-time': 0.0}, open(legacy, 'wb'))
+        notes = os.path.join(self.results_dir, 'notes.txt')
+        open(notes, 'w').write('Not results.')
+
+        (updated, removed, errors) = self.catalog.scan([self.results_dir])
+        self.assertTrue((updated, sorted([path for (path, error) in errors])) == (2, [notes, legacy]))
+        self.assertTrue(self.catalog.scan() == (0, 0, []))
+
+        (updated, removed, errors) = self.catalog.scan(legacy=True)
+        self.assertTrue((updated, [path for (path, error) in errors]) == (1, [notes]))
+        self.assertTrue(self.catalog.scan(legacy=True) == (0, 0, []))
+        self.assertTrue(len(self.catalog.query()) == 3)
+
+        open(notes, 'a').write(' Still not results.')
+        self.assertTrue([path for (path, error) in self.catalog.scan()[2]] == [notes])
+        os.remove(notes)
+        self.catalog.scan()
+        self.assertTrue(list(self.catalog.db.execute('SELECT path FROM rejected')) == [])
+
+        other = pingcatalog.Catalog(os.path.join(self.dir, 'other.db'))
+        self.assertTrue(other.scan([legacy])[:2] == (1, 0))
+        other.close()
+
+
 if __name__ == '__main__':
     unittest.main()